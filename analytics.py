@@ -0,0 +1,496 @@
+import os
+import time
+import copy
+import asyncio
+from datetime import date, datetime, timedelta
+from html import escape
+import numpy as np
+from dotenv import load_dotenv
+from http_session import graph_client
+from singleflight import report_flights
+from structure import load_account_structure, structure_cache, structure_mirror
+from warehouse import sync_account_range, warehouse
+
+# --- Конфигурация ---
+load_dotenv()
+# За сколько дней хранится и анализируется дневная история объявлений
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "90"))
+# «Последний период», который сравнивается с базовым, и длина базового периода, в днях
+ANALYTICS_RECENT_DAYS = 7
+ANALYTICS_BASELINE_DAYS = 28
+# Сколько рекомендаций показывать
+ANALYTICS_TOP = int(os.getenv("ANALYTICS_TOP", "10"))
+# Сколько кабинетов докачивается одновременно
+ANALYTICS_SYNC_CONCURRENCY = int(os.getenv("ANALYTICS_SYNC_CONCURRENCY", "4"))
+# История считается свежей, если день "вчера" скачивался не раньше стольких секунд назад
+ANALYTICS_SYNC_TTL = int(os.getenv("ANALYTICS_SYNC_TTL", str(6 * 3600)))
+
+# Пороги сигналов
+Z_THRESHOLD = 3.0          # |z| дневного значения против базового периода, начиная с которого это аномалия
+COST_GROWTH = 1.5          # CPL/CPC последнего периода во столько раз выше базового
+MIN_RESULTS = 3            # лидов/кликов за базовый период, чтобы сравнивать стоимость
+MIN_ACTIVE_DAYS = 7        # дней с расходом в базовом периоде для z-оценки
+FATIGUE_WINDOW = 14        # дней, по которым считается тренд CTR
+FATIGUE_DROP = 0.25        # CTR упал хотя бы на столько относительно базового периода
+MIN_IMPRESSIONS = 1000     # показов за последний период для сигнала усталости
+PACING_HIGH = 1.5          # расходы кампании за период выросли во столько раз
+PACING_LOW = 0.5           # или упали до такой доли
+MIN_PACING_SPEND = 20.0    # расход кампании ($ за период), ниже которого темп не анализируется
+SCALE_RATIO = 0.6          # стоимость результата не выше такой доли средней по кабинету
+SCALE_MIN_RESULTS = 5      # результатов за последний период у кандидата на масштабирование
+
+# Разовые сигналы (один день) умножаются на длину периода, чтобы сравнивать их с недельными по деньгам
+ONE_DAY_WEIGHT = ANALYTICS_RECENT_DAYS
+
+# Названия кабинетов с последней докачки: account_id -> имя
+account_names = {}
+# История в памяти и блокировка её обновления
+_history = None
+_history_lock = asyncio.Lock()
+
+
+class AdHistory:
+    """
+    Дневная история объявлений всех кабинетов в матрицах NumPy.
+
+    Строка — объявление, столбец — день (последний столбец — until).
+    Матрицы: spend, leads, link_clicks, clicks, impressions. После reindex()
+    для каждой строки известны кабинет, кампания и названия (из локальной
+    копии структуры).
+    """
+
+    FIELDS = ("spend", "leads", "link_clicks", "clicks", "impressions")
+
+    def __init__(self, since: date, days: int):
+        self.since = since
+        self.days = days
+        self.until = since + timedelta(days=days - 1)
+        # Версия хранилища, которой соответствуют данные в памяти
+        self.version = None
+        self.index = {}
+        self.ad_ids = []
+        self.ad_accounts = []
+        self.matrices = {name: np.zeros((0, days)) for name in self.FIELDS}
+        # {account_id: {ad_id: (название, id кампании, название кампании, objective)}}
+        self.catalog = {}
+        self.reindex()
+
+    @property
+    def spend(self) -> np.ndarray:
+        return self.matrices["spend"]
+
+    @property
+    def leads(self) -> np.ndarray:
+        return self.matrices["leads"]
+
+    @property
+    def link_clicks(self) -> np.ndarray:
+        return self.matrices["link_clicks"]
+
+    @property
+    def clicks(self) -> np.ndarray:
+        return self.matrices["clicks"]
+
+    @property
+    def impressions(self) -> np.ndarray:
+        return self.matrices["impressions"]
+
+    def __len__(self) -> int:
+        return len(self.ad_ids)
+
+    def load(self, rows: list) -> None:
+        """Кладёт строки InsightsWarehouse.read_daily (дни от since) в матрицы, добавляя новые объявления."""
+        if not rows:
+            return
+        account_col, ad_col, day_col, *value_cols = zip(*rows)
+        index = self.index
+        known = len(index)
+        row_index = np.fromiter((index.setdefault(ad_id, len(index)) for ad_id in ad_col), np.intp, len(rows))
+        if len(index) > known:
+            new_rows, first = np.unique(row_index[row_index >= known], return_index=True)
+            positions = np.flatnonzero(row_index >= known)[first]
+            self.ad_ids.extend(ad_col[pos] for pos in positions.tolist())
+            self.ad_accounts.extend(account_col[pos] for pos in positions.tolist())
+            grow = np.zeros((len(new_rows), self.days))
+            for name in self.FIELDS:
+                self.matrices[name] = np.vstack([self.matrices[name], grow])
+        day_index = np.array(day_col, dtype=np.intp)
+        for name, column in zip(self.FIELDS, value_cols):
+            self.matrices[name][row_index, day_index] = np.array(column, dtype=float)
+
+    def copy(self) -> "AdHistory":
+        """Независимая копия для обновления, пока читатели работают со старой."""
+        history = copy.copy(self)
+        history.index = dict(self.index)
+        history.ad_ids = list(self.ad_ids)
+        history.ad_accounts = list(self.ad_accounts)
+        history.matrices = {name: matrix.copy() for name, matrix in self.matrices.items()}
+        history.catalog = dict(self.catalog)
+        return history
+
+    def clear(self, account_id: str, first_day: int, last_day: int) -> None:
+        """Обнуляет дни [first_day, last_day] всех объявлений кабинета перед перечитыванием."""
+        rows = np.flatnonzero(np.array(self.ad_accounts, dtype=object) == account_id)
+        for matrix in self.matrices.values():
+            matrix[rows, first_day:last_day + 1] = 0
+
+    def reindex(self) -> None:
+        """Пересчитывает кабинет, кампанию, названия и тип результата каждой строки по catalog."""
+        accounts, account_index = np.unique(np.array(self.ad_accounts, dtype=object), return_inverse=True)
+        self.accounts = accounts.tolist()
+        self.account_index = account_index.astype(np.intp)
+        self.ad_names = []
+        self.campaign_names = []
+        campaign_keys = []
+        traffic = []
+        for account_id, ad_id in zip(self.ad_accounts, self.ad_ids):
+            name, campaign_id, campaign_name, objective = self.catalog.get(account_id, {}).get(ad_id, (None, None, None, ""))
+            self.ad_names.append(name or f"#{ad_id}")
+            campaign_keys.append((account_id, campaign_id or "?"))
+            self.campaign_names.append(campaign_name or "без кампании")
+            traffic.append("TRAFFIC" in (objective or ""))
+        # Кампания каждой строки индексом; для трафиковых кампаний результат — клик, иначе лид
+        keys = {}
+        self.campaign_index = np.array([keys.setdefault(key, len(keys)) for key in campaign_keys], dtype=np.intp)
+        self.campaign_count = len(keys)
+        self.is_traffic = np.array(traffic, dtype=bool)
+
+
+# --- Загрузка ---
+
+def load_catalog(account_ids) -> dict:
+    """Названия объявлений и кампаний из локальной копии структуры (зеркала или кэша)."""
+    catalog = {}
+    for account_id in account_ids:
+        mirror, _ = structure_mirror.get(account_id)
+        if mirror is not None:
+            campaigns, ads = mirror["campaigns"], mirror["ads"].values()
+        else:
+            cached = structure_cache.get(account_id)
+            if cached is None:
+                continue
+            campaigns, ads = cached["campaigns"], cached["ads"]
+        entries = catalog[account_id] = {}
+        for ad in ads:
+            campaign = campaigns.get(ad.get("campaign_id"), {})
+            entries[ad["id"]] = (ad.get("name"), ad.get("campaign_id"), campaign.get("name"), campaign.get("objective", ""))
+    return catalog
+
+def load_history(since: date, days: int) -> AdHistory:
+    """Читает всю историю за days дней с since из хранилища."""
+    history = AdHistory(since, days)
+    history.load(warehouse.read_daily(since, history.until))
+    return history
+
+def apply_changes(history: AdHistory, changes: list) -> AdHistory:
+    """
+    Перечитывает из хранилища отрезки (кабинет, since, until) из журнала изменений, попавшие в окно истории.
+
+    Изменения применяются к копии: исходная история остаётся нетронутой
+    для тех, кто читает её в это время.
+    """
+    history = history.copy()
+    for _, account_id, since, until in changes:
+        since, until = max(since, history.since), min(until, history.until)
+        if since > until:
+            continue
+        history.clear(account_id, (since - history.since).days, (until - history.since).days)
+        history.load(warehouse.read_daily(since, until, account_id, origin=history.since))
+    return history
+
+async def get_history(until: date, days: int = ANALYTICS_DAYS) -> AdHistory:
+    """
+    История за days дней по until из хранилища дневной статистики.
+
+    Матрицы держатся в памяти: после записей в хранилище перечитываются
+    только изменённые кабинеты и дни, целиком история читается заново
+    лишь при сдвиге окна. Чтение идёт в отдельном потоке, чтобы не
+    задерживать бота. Обновлённая история собирается отдельно и заменяет
+    _history целиком, так что уже выданная вызывающим не меняется.
+    """
+    global _history
+    since = until - timedelta(days=days - 1)
+    async with _history_lock:
+        history = _history
+        changes = None
+        if history is not None and history.since == since and history.days == days:
+            changes = warehouse.changes_since(history.version)
+        # Версию запоминаем до чтения: записи, сделанные во время чтения, перечитаются в следующий раз
+        version = warehouse.version
+        if changes is None:
+            history = await asyncio.to_thread(load_history, since, days)
+            history.catalog = load_catalog(set(history.ad_accounts))
+        elif changes:
+            history = await asyncio.to_thread(apply_changes, history, changes)
+            history.catalog.update(load_catalog({account_id for _, account_id, _, _ in changes}))
+        if changes is None or changes:
+            history.reindex()
+            history.version = version
+            _history = history
+    return history
+
+def history_is_fresh(until: date) -> bool:
+    return time.time() - warehouse.synced_at(until) < ANALYTICS_SYNC_TTL
+
+async def refresh_history(until: date, days: int = ANALYTICS_DAYS) -> None:
+    """
+    Докачивает в хранилище недостающие дни истории и структуру всех кабинетов.
+
+    Одновременные вызовы (кнопка в нескольких чатах, плановый расчёт)
+    присоединяются к одной докачке.
+    """
+    async def sync() -> None:
+        client = graph_client()
+        accounts = await client.get_ad_accounts("name,account_id")
+        since = until - timedelta(days=days - 1)
+        semaphore = asyncio.Semaphore(ANALYTICS_SYNC_CONCURRENCY)
+
+        async def sync_account(acc: dict):
+            async with semaphore:
+                await load_account_structure(client, acc["account_id"])
+                await sync_account_range(client, acc["account_id"], since, until)
+
+        results = await asyncio.gather(*(sync_account(acc) for acc in accounts), return_exceptions=True)
+        for acc, result in zip(accounts, results):
+            account_names[acc["account_id"]] = acc["name"]
+            if isinstance(result, Exception):
+                print(f"Не удалось обновить историю кабинета {acc['name']}: {type(result).__name__}: {result}")
+
+    await report_flights.do(("history", until.isoformat(), days), sync, ttl=0)
+
+async def warm_up_history(until: date = None) -> None:
+    """Докачивает историю и держит матрицы в памяти, чтобы кнопка отвечала сразу (после дневного отчёта)."""
+    until = until or (datetime.now() - timedelta(days=1)).date()
+    await refresh_history(until)
+    await get_history(until)
+
+
+# --- Сигналы ---
+
+def _ratio(numerator, denominator):
+    """Поэлементное деление; там, где делить не на что, — nan."""
+    numerator = np.asarray(numerator, dtype=float)
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, np.nan), where=np.asarray(denominator) > 0)
+
+def _window(cumulative: np.ndarray, start: int, end: int) -> np.ndarray:
+    """Сумма по дням [start, end) для всех строк по накопленной сумме с нулевым первым столбцом."""
+    return cumulative[:, end] - cumulative[:, start]
+
+def _trend(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Наклон линейной регрессии по дням для каждой строки, только по точкам mask; делённый на среднее."""
+    t = np.arange(values.shape[1], dtype=float)
+    n = mask.sum(axis=1)
+    safe_n = np.maximum(n, 1)
+    t_mean = (mask * t).sum(axis=1) / safe_n
+    y_mean = (mask * values).sum(axis=1) / safe_n
+    dt = (t - t_mean[:, None]) * mask
+    slope = _ratio((dt * (values - y_mean[:, None])).sum(axis=1), (dt * dt).sum(axis=1))
+    slope[n < 3] = np.nan
+    return _ratio(slope, y_mean)
+
+def compute_signals(history: AdHistory) -> dict:
+    """
+    Считает все сигналы разом для всех объявлений всех кабинетов.
+
+    Возвращает словарь массивов по строкам истории (и по кампаниям для темпа
+    расходов): стоимость результата (CPL для лидов, CPC для трафика) в
+    последнем и базовом периодах по скользящему окну, z-оценки вчерашних
+    расходов и результатов, тренд CTR и темп расходов кампаний.
+    """
+    days = history.days
+    recent = min(ANALYTICS_RECENT_DAYS, days)
+    baseline = max(0, min(ANALYTICS_BASELINE_DAYS, days - recent))
+    results = np.where(history.is_traffic[:, None], history.link_clicks, history.leads)
+
+    # Накопленные суммы с нулевым первым столбцом: сумма за любое окно — разность двух столбцов
+    def cumulative(matrix):
+        out = np.zeros((matrix.shape[0], days + 1))
+        np.cumsum(matrix, axis=1, out=out[:, 1:])
+        return out
+
+    cum_spend, cum_results = cumulative(history.spend), cumulative(results)
+    cum_clicks, cum_impressions = cumulative(history.clicks), cumulative(history.impressions)
+    recent_start, base_start = days - recent, days - recent - baseline
+
+    signals = {
+        "spend_recent": _window(cum_spend, recent_start, days),
+        "spend_base": _window(cum_spend, base_start, recent_start),
+        "results_recent": _window(cum_results, recent_start, days),
+        "results_base": _window(cum_results, base_start, recent_start),
+        "impressions_recent": _window(cum_impressions, recent_start, days),
+    }
+    # Скользящая стоимость результата за recent дней на каждый день; базовая — медиана по базовому периоду
+    rolling_cost = _ratio(cum_spend[:, recent:] - cum_spend[:, :-recent], cum_results[:, recent:] - cum_results[:, :-recent])
+    signals["cost_recent"] = rolling_cost[:, -1]
+    # Окна, целиком лежащие в базовом периоде: начинаются с base_start и заканчиваются не позже recent_start
+    base_rolling = rolling_cost[:, base_start:max(base_start, recent_start - recent + 1)]
+    with np.errstate(all="ignore"):
+        signals["cost_base"] = _ratio(signals["spend_base"], signals["results_base"])
+        if base_rolling.shape[1]:
+            has_values = ~np.isnan(base_rolling).all(axis=1)
+            signals["cost_base"][has_values] = np.nanmedian(base_rolling[has_values], axis=1)
+
+    # z-оценки вчерашнего дня против базового периода (дни до вчерашнего)
+    window = slice(max(0, days - 1 - ANALYTICS_BASELINE_DAYS), days - 1)
+    for name, matrix in (("spend", history.spend), ("results", results)):
+        past = matrix[:, window]
+        if past.shape[1] >= 2:
+            mean, std = past.mean(axis=1), past.std(axis=1)
+        else:
+            # Слишком короткая история: без базового периода z-оценки не считаются
+            mean = std = np.full(len(history), np.nan)
+        signals[f"{name}_yesterday"] = matrix[:, -1]
+        signals[f"{name}_mean"] = mean
+        signals[f"{name}_std"] = std
+        signals[f"{name}_z"] = _ratio(matrix[:, -1] - mean, std)
+    signals["active_days"] = (history.spend[:, window] > 0).sum(axis=1)
+
+    # Усталость: CTR последнего периода против базового и тренд дневного CTR
+    signals["ctr_recent"] = _ratio(_window(cum_clicks, recent_start, days), signals["impressions_recent"]) * 100
+    signals["ctr_base"] = _ratio(_window(cum_clicks, base_start, recent_start),
+                                 _window(cum_impressions, base_start, recent_start)) * 100
+    fatigue_window = min(FATIGUE_WINDOW, days)
+    impressions = history.impressions[:, -fatigue_window:]
+    daily_ctr = _ratio(history.clicks[:, -fatigue_window:], impressions)
+    signals["ctr_trend"] = _trend(np.nan_to_num(daily_ctr), impressions > 0)
+
+    # Темп расходов кампаний: последний период против предыдущего такой же длины
+    previous_start = max(0, recent_start - recent)
+    campaign = history.campaign_index
+    signals["campaign_spend_recent"] = np.bincount(campaign, signals["spend_recent"], history.campaign_count)
+    signals["campaign_spend_previous"] = np.bincount(
+        campaign, _window(cum_spend, previous_start, recent_start), history.campaign_count)
+
+    # Средняя стоимость результата по кабинету отдельно для лидов и кликов
+    account_cost = np.full(len(history), np.nan)
+    for traffic in (False, True):
+        rows = history.is_traffic == traffic
+        accounts = history.account_index[rows]
+        spend = np.bincount(accounts, signals["spend_recent"][rows], len(history.accounts))
+        count = np.bincount(accounts, signals["results_recent"][rows], len(history.accounts))
+        account_cost[rows] = _ratio(spend, count)[accounts]
+    signals["account_cost"] = account_cost
+    return signals
+
+
+# --- Рекомендации ---
+
+def rank_candidates(history: AdHistory, signals: dict) -> list:
+    """
+    Отбирает срабатывания всех правил и сортирует их по деньгам, которые они затрагивают.
+
+    Возвращает список (вид, индекс строки или кампании, оценка в $) по
+    убыванию оценки; по каждому объявлению и кампании остаётся одно,
+    самое дорогое срабатывание.
+    """
+    s = signals
+    with np.errstate(invalid="ignore"):
+        cost_up = (s["results_base"] >= MIN_RESULTS) & (s["cost_recent"] >= COST_GROWTH * s["cost_base"])
+        # Нет результатов вовсе, хотя потрачено больше двух обычных стоимостей результата
+        no_results = (s["results_base"] >= MIN_RESULTS) & (s["results_recent"] == 0) & (s["spend_recent"] >= 2 * s["cost_base"])
+        stable = s["active_days"] >= MIN_ACTIVE_DAYS
+        spend_spike = stable & (s["spend_z"] >= Z_THRESHOLD)
+        results_drop = (stable & (s["results_z"] <= -Z_THRESHOLD) & (s["results_mean"] >= 1)
+                        & (s["spend_yesterday"] >= 0.5 * s["spend_mean"]))
+        fatigue = ((s["impressions_recent"] >= MIN_IMPRESSIONS) & (s["ctr_recent"] <= (1 - FATIGUE_DROP) * s["ctr_base"])
+                   & (s["ctr_trend"] < 0))
+        scale = ((s["results_recent"] >= SCALE_MIN_RESULTS) & (s["cost_recent"] <= SCALE_RATIO * s["account_cost"])
+                 & (s["spend_yesterday"] > 0) & ~fatigue)
+        pacing_base = s["campaign_spend_previous"]
+        pacing_ratio = _ratio(s["campaign_spend_recent"], pacing_base)
+        pacing_active = np.maximum(s["campaign_spend_recent"], pacing_base) >= MIN_PACING_SPEND
+        pacing_high = pacing_active & (pacing_ratio >= PACING_HIGH)
+        pacing_low = pacing_active & (pacing_ratio <= PACING_LOW)
+
+    # Оценка — сколько денег затрагивает сигнал за последний период
+    scores = {
+        "no_results": (no_results, s["spend_recent"]),
+        "cost_up": (cost_up & ~no_results, s["spend_recent"] - s["results_recent"] * s["cost_base"]),
+        "spend_spike": (spend_spike, (s["spend_yesterday"] - s["spend_mean"]) * ONE_DAY_WEIGHT),
+        "results_drop": (results_drop, s["spend_yesterday"] * ONE_DAY_WEIGHT),
+        "fatigue": (fatigue, s["spend_recent"] * (1 - _ratio(s["ctr_recent"], s["ctr_base"]))),
+        "scale": (scale, s["results_recent"] * (s["account_cost"] - s["cost_recent"])),
+        "pacing_high": (pacing_high, s["campaign_spend_recent"] - pacing_base),
+        "pacing_low": (pacing_low, pacing_base - s["campaign_spend_recent"]),
+    }
+    kinds, indices, values = [], [], []
+    for kind, (mask, score) in scores.items():
+        hit = np.flatnonzero(mask)
+        kinds.extend([kind] * len(hit))
+        indices.append(hit)
+        values.append(np.nan_to_num(score[hit]))
+    if not kinds:
+        return []
+    indices, values = np.concatenate(indices), np.concatenate(values)
+    order = np.argsort(-values, kind="stable")
+
+    ranked, seen = [], set()
+    for pos in order.tolist():
+        kind, index = kinds[pos], int(indices[pos])
+        subject = ("campaign", index) if kind.startswith("pacing") else ("ad", index)
+        if subject in seen:
+            continue
+        seen.add(subject)
+        ranked.append((kind, index, float(values[pos])))
+    return ranked
+
+def _money(value: float) -> str:
+    return f"${value:,.2f}".replace(",", " ")
+
+def describe(kind: str, index: int, history: AdHistory, signals: dict) -> str:
+    """Текст одной рекомендации."""
+    s = signals
+    if kind.startswith("pacing"):
+        row = int(np.flatnonzero(history.campaign_index == index)[0])
+        account_id = history.accounts[history.account_index[row]]
+        where = f"Кампания <b>{escape(history.campaign_names[row])}</b> ({escape(account_names.get(account_id, account_id))})"
+        recent, previous = s["campaign_spend_recent"][index], s["campaign_spend_previous"][index]
+        period = f"за {ANALYTICS_RECENT_DAYS} дн. {_money(recent)} против {_money(previous)} неделей раньше"
+        if kind == "pacing_high":
+            return f"💸 {where}: расходы ускорились — {period}. Проверьте бюджеты и ставки."
+        return f"🐢 {where}: расходы упали — {period}. Проверьте, не упёрлась ли кампания в ставку, аудиторию или оплату."
+
+    account_id = history.accounts[history.account_index[index]]
+    where = (f"<b>{escape(history.ad_names[index])}</b> ({escape(history.campaign_names[index])}, "
+             f"{escape(account_names.get(account_id, account_id))})")
+    metric, unit = ("CPC", "кликов") if history.is_traffic[index] else ("CPL", "лидов")
+    if kind == "no_results":
+        return (f"🛑 {where}: {_money(s['spend_recent'][index])} за {ANALYTICS_RECENT_DAYS} дн. без {unit} "
+                f"при обычном {metric} {_money(s['cost_base'][index])}. Остановите объявление или замените креатив.")
+    if kind == "cost_up":
+        growth = (s["cost_recent"][index] / s["cost_base"][index] - 1) * 100
+        return (f"📉 {where}: {metric} вырос с {_money(s['cost_base'][index])} до {_money(s['cost_recent'][index])} "
+                f"(+{growth:.0f}%) за {ANALYTICS_RECENT_DAYS} дн. Снизьте бюджет или обновите креатив.")
+    if kind == "spend_spike":
+        return (f"⚠️ {where}: вчера потрачено {_money(s['spend_yesterday'][index])} при обычных "
+                f"{_money(s['spend_mean'][index])} ± {_money(s['spend_std'][index])} (z={s['spend_z'][index]:.1f}). "
+                f"Проверьте ставки и бюджет.")
+    if kind == "results_drop":
+        return (f"⚠️ {where}: вчера {s['results_yesterday'][index]:.0f} {unit} при обычных "
+                f"{s['results_mean'][index]:.1f} (z={s['results_z'][index]:.1f}), а расход прежний. "
+                f"Проверьте объявление, форму и посадочную страницу.")
+    if kind == "fatigue":
+        return (f"😴 {where}: CTR падает — {s['ctr_base'][index]:.2f}% → {s['ctr_recent'][index]:.2f}%. "
+                f"Креатив выгорает, подготовьте замену.")
+    return (f"🚀 {where}: {metric} {_money(s['cost_recent'][index])} против {_money(s['account_cost'][index])} "
+            f"в среднем по кабинету. Можно поднять бюджет.")
+
+def recommendations(history: AdHistory, top: int = ANALYTICS_TOP) -> list:
+    """Тексты top рекомендаций по убыванию затронутых денег."""
+    if not len(history):
+        return []
+    signals = compute_signals(history)
+    return [describe(kind, index, history, signals) for kind, index, _ in rank_candidates(history, signals)[:top]]
+
+async def build_recommendations_text(until: date = None) -> str:
+    """Рекомендации по истории до until (по умолчанию вчера) в HTML для Telegram."""
+    until = until or (datetime.now() - timedelta(days=1)).date()
+    history = await get_history(until)
+    if not len(history):
+        return "❌ Нет истории статистики для анализа."
+    lines = recommendations(history)
+    header = (f"<b>💡 Рекомендации</b> по статистике {len(history)} объявлений за {history.days} дн. "
+              f"(по {until.strftime('%d.%m.%Y')}):")
+    if not lines:
+        return header + "\n\n✅ Заметных проблем и точек роста не найдено."
+    return header + "\n\n" + "\n\n".join(f"{i}. {line}" for i, line in enumerate(lines, 1))
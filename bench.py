@@ -0,0 +1,748 @@
+"""
+Офлайн-бенчмарк отчётов на локальном стенде Graph API.
+
+Поднимает в отдельном процессе aiohttp-сервер, который изображает
+graph.facebook.com на синтетических кабинетах (кампании, группы,
+объявления, статистика), с постраничной выдачей, задержками, ошибками 429
+и заголовками использования квоты. Затем прогоняет отчёт по активным
+кампаниям и дневной отчёт с поддельным Telegram-ботом и печатает время,
+число запросов к API, объём ответов и пиковый RSS. С --memory пиковая
+память Python меряется отдельным прогоном: tracemalloc искажает время.
+
+Пример:
+    python bench.py --accounts 50 --ads 1000 --latency-ms 80 --error-rate 0.01 --runs 2
+"""
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import multiprocessing
+from collections import deque
+from datetime import date, timedelta
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from aiohttp import web
+import aiohttp
+
+API_VERSION = "v19.0"
+UPDATED_TIME = "2025-06-01T00:00:00+0000"
+LEAD_ACTION_TYPE = "onsite_conversion.messaging_conversation_started_7d"
+# Предел, при котором стенд ещё успевает сгенерировать данные за разумное время
+MAX_TOTAL_ADS = 50_000
+
+
+# --- Синтетические данные ---
+
+def stable_random(*parts) -> random.Random:
+    """Генератор, зависящий только от parts (hash() строк между процессами не стабилен)."""
+    return random.Random(zlib.crc32(":".join(map(str, parts)).encode()))
+
+def effective_status(*statuses) -> str:
+    campaign, adset, ad = (list(statuses) + ["ACTIVE"] * 3)[:3]
+    if campaign != "ACTIVE":
+        return "CAMPAIGN_PAUSED"
+    if adset != "ACTIVE":
+        return "ADSET_PAUSED"
+    return ad
+
+
+class SyntheticGraph:
+    """Кабинеты, кампании, группы и объявления, детерминированно построенные по seed."""
+
+    def __init__(self, accounts: int, campaigns: int, adsets: int, ads: int, seed: int = 1):
+        self.accounts = []
+        self.campaigns = {}
+        self.adsets = {}
+        self.ads = {}
+        rng = random.Random(seed)
+        for a in range(accounts):
+            account_id = str(100000 + a)
+            self.accounts.append({"id": f"act_{account_id}", "account_id": account_id, "name": f"Bench account {a + 1}"})
+            campaigns_list, adsets_list, ads_list = [], [], []
+            for c in range(campaigns):
+                status = "ACTIVE" if rng.random() < 0.85 else "PAUSED"
+                objective = rng.choice(["OUTCOME_LEADS", "OUTCOME_LEADS", "OUTCOME_TRAFFIC"])
+                campaign_id = f"2{a:04d}{c:05d}"
+                campaigns_list.append({
+                    "id": campaign_id, "name": f"Campaign {c + 1}", "status": status,
+                    "effective_status": status, "objective": objective, "updated_time": UPDATED_TIME,
+                })
+                for s in range(adsets):
+                    adset_status = "ACTIVE" if rng.random() < 0.9 else "PAUSED"
+                    adsets_list.append({
+                        "id": f"3{a:04d}{c:05d}{s:02d}", "name": f"Ad set {c + 1}.{s + 1}", "campaign_id": campaign_id,
+                        "status": adset_status, "effective_status": effective_status(status, adset_status),
+                        "updated_time": UPDATED_TIME,
+                    })
+            # Объявления раскладываются по группам по кругу
+            for n in range(ads):
+                adset = adsets_list[n % len(adsets_list)]
+                campaign = self._campaign_of(campaigns_list, adset)
+                ad_status = "ACTIVE" if rng.random() < 0.8 else "PAUSED"
+                ad_id = f"4{a:04d}{n:06d}"
+                ads_list.append({
+                    "id": ad_id, "name": f"Ad {n + 1}", "adset_id": adset["id"], "campaign_id": adset["campaign_id"],
+                    "status": ad_status, "effective_status": effective_status(campaign["status"], adset["status"], ad_status),
+                    "updated_time": UPDATED_TIME,
+                    "creative": {"id": f"5{a:04d}{n:06d}", "thumbnail_url": f"https://example.com/thumb/{ad_id}.jpg"},
+                })
+            self.campaigns[account_id] = campaigns_list
+            self.adsets[account_id] = adsets_list
+            self.ads[account_id] = ads_list
+
+    @staticmethod
+    def _campaign_of(campaigns_list: list, adset: dict) -> dict:
+        # ID кампании зашит в ID группы: 2 + счётчики, без поиска по списку
+        index = int(adset["campaign_id"][5:])
+        return campaigns_list[index]
+
+    def delivering_ads(self, account_id: str) -> list:
+        """Объявления, у которых есть показы (effective_status ACTIVE)."""
+        return [ad for ad in self.ads[account_id] if ad["effective_status"] == "ACTIVE"]
+
+    def campaign_by_id(self, account_id: str) -> dict:
+        return {c["id"]: c for c in self.campaigns[account_id]}
+
+    @staticmethod
+    def day_stats(object_id: str, day: date) -> dict:
+        rng = stable_random(object_id, day.isoformat())
+        impressions = rng.randint(200, 5000)
+        clicks = int(impressions * rng.uniform(0.005, 0.03))
+        return {
+            "spend": round(rng.uniform(0.5, 40), 2),
+            "impressions": impressions,
+            "clicks": clicks,
+            "link_clicks": int(clicks * rng.uniform(0.5, 0.9)),
+            "leads": rng.randint(0, 6),
+        }
+
+
+def preset_range(preset: str, today: date) -> tuple:
+    if preset == "today":
+        return today, today
+    if preset == "last_7d":
+        return today - timedelta(days=7), today - timedelta(days=1)
+    if preset == "last_30d":
+        return today - timedelta(days=30), today - timedelta(days=1)
+    yesterday = today - timedelta(days=1)
+    return yesterday, yesterday
+
+def days_between(since: date, until: date):
+    day = since
+    while day <= until:
+        yield day
+        day += timedelta(days=1)
+
+def insight_row(stats: dict, since: date, until: date) -> dict:
+    actions = [{"action_type": "link_click", "value": str(stats["link_clicks"])}]
+    if stats["leads"]:
+        actions.append({"action_type": LEAD_ACTION_TYPE, "value": str(stats["leads"])})
+    return {
+        "spend": f"{stats['spend']:.2f}",
+        "impressions": str(stats["impressions"]),
+        "clicks": str(stats["clicks"]),
+        "ctr": f"{stats['clicks'] / stats['impressions'] * 100:.4f}" if stats["impressions"] else "0",
+        "actions": actions,
+        "date_start": since.isoformat(),
+        "date_stop": until.isoformat(),
+    }
+
+def sum_stats(items: list) -> dict:
+    total = {"spend": 0.0, "impressions": 0, "clicks": 0, "link_clicks": 0, "leads": 0}
+    for stats in items:
+        for key in total:
+            total[key] += stats[key]
+    return total
+
+
+# --- Вложенное раскрытие полей ---
+
+# Рёбра структуры, которые можно раскрывать внутри fields
+STRUCTURE_EDGES = ("campaigns", "adsets", "ads")
+
+def closing_bracket(text: str, start: int) -> int:
+    """Позиция скобки, закрывающей открытую в text[start]."""
+    depth = 0
+    for pos in range(start, len(text)):
+        if text[pos] in "({[":
+            depth += 1
+        elif text[pos] in ")}]":
+            depth -= 1
+            if depth == 0:
+                return pos
+    raise ValueError(f"Незакрытая скобка в fields: {text}")
+
+def parse_fields(text: str) -> list:
+    """
+    Разбирает fields Graph API в список (имя, модификаторы, вложенные поля).
+
+    "ads.limit(100).filtering([...]){id,name}" -> ("ads", {"limit": "100", "filtering": "[...]"}, "id,name").
+    """
+    items, depth, start = [], 0, 0
+    for pos, char in enumerate(text + ","):
+        if char in "({[":
+            depth += 1
+        elif char in ")}]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            if text[start:pos].strip():
+                items.append(text[start:pos].strip())
+            start = pos + 1
+    fields = []
+    for item in items:
+        name = re.match(r"\w+", item).group()
+        pos = len(name)
+        modifiers, subfields = {}, None
+        while pos < len(item):
+            if item[pos] == ".":
+                opening = item.index("(", pos)
+                end = closing_bracket(item, opening)
+                modifiers[item[pos + 1:opening]] = item[opening + 1:end]
+            elif item[pos] == "{":
+                end = closing_bracket(item, pos)
+                subfields = item[pos + 1:end]
+            else:
+                break
+            pos = end + 1
+        fields.append((name, modifiers, subfields))
+    return fields
+
+def has_nested_edges(fields: list) -> bool:
+    return any(name in STRUCTURE_EDGES for name, _, _ in fields)
+
+
+# --- Стенд Graph API ---
+
+class MockGraphApi:
+    """
+    aiohttp-приложение, отвечающее как Graph API на синтетических данных.
+
+    Поддерживает /me/adaccounts, рёбра campaigns/adsets/ads с фильтрами,
+    insights (синхронно и через report run), batch-запросы, курсоры
+    after/next, задержки, ошибки 429 и заголовки X-App-Usage /
+    X-Ad-Account-Usage. При нескольких токенах кабинеты делятся между
+    ними по кругу, у каждого токена своя квота приложения, а запрос к
+    чужому кабинету получает ошибку доступа. Вложенное раскрытие рёбер
+    в fields (STRUCTURE_LOADER=nested) отдаёт первую страницу каждого ребра
+    с собственным paging.next на /{id родителя}/{ребро}.
+    """
+
+    def __init__(self, graph: SyntheticGraph, base_url: str, latency_ms: float, jitter_ms: float,
+                 error_rate: float, quota_per_minute: int, row_cost_ms: float, seed: int = 1, tokens: list = None):
+        self.graph = graph
+        self.tokens = tokens or []
+        self.base_url = base_url
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.quota_per_minute = quota_per_minute
+        self.row_cost = row_cost_ms / 1000
+        self.rng = random.Random(seed)
+        self.today = date.today()
+        self.runs = {}
+        self.calls = {}
+        # Готовые списки строк по параметрам запроса, чтобы не пересчитывать их для каждой страницы
+        self._results = {}
+        self.reset()
+
+    def reset(self) -> None:
+        self.stats = {"http_requests": 0, "api_calls": 0, "bytes_out": 0, "rate_limited": 0, "endpoints": {}, "tokens": {}}
+
+    # --- HTTP ---
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/__stats", self.handle_stats)
+        app.router.add_post("/__reset", self.handle_reset)
+        app.router.add_route("*", f"/{API_VERSION}/{{path:.*}}", self.handle)
+        return app
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({"ok": True})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats["http_requests"] += 1
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        path = request.match_info["path"].strip("/")
+        token = params.get("access_token", "")
+
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.stats["rate_limited"] += 1
+            return self.respond(429, {"error": {"message": "(#4) Application request limit reached",
+                                                "type": "OAuthException", "code": 4, "is_transient": True}}, {})
+
+        if path == "" and request.method == "POST" and "batch" in params:
+            status, payload, headers = await self.handle_batch(json.loads(params["batch"]), token)
+        else:
+            status, payload, headers = await self.dispatch(request.method, path, params, token)
+        return self.respond(status, payload, headers)
+
+    def respond(self, status: int, payload, headers: dict) -> web.Response:
+        body = json.dumps(payload).encode()
+        self.stats["bytes_out"] += len(body)
+        return web.Response(body=body, status=status, headers=headers, content_type="application/json")
+
+    async def handle_batch(self, requests: list, token: str) -> tuple:
+        results = []
+        for sub in requests:
+            relative = urlsplit(sub["relative_url"])
+            params = dict(parse_qsl(relative.query))
+            if sub.get("body"):
+                params.update(parse_qsl(sub["body"]))
+            status, payload, headers = await self.dispatch(sub.get("method", "GET"), relative.path.strip("/"), params, token)
+            results.append({
+                "code": status,
+                "headers": [{"name": k, "value": v} for k, v in headers.items()],
+                "body": json.dumps(payload),
+            })
+        return 200, results, {}
+
+    # --- Маршрутизация ---
+
+    def visible(self, token: str, account_id: str) -> bool:
+        """Виден ли кабинет токену: при нескольких токенах кабинеты разложены между ними по кругу."""
+        if len(self.tokens) <= 1:
+            return True
+        return token in self.tokens and (int(account_id) - 100000) % len(self.tokens) == self.tokens.index(token)
+
+    def usage_headers(self, account_id: str, token: str) -> dict:
+        """Заголовки квоты: доля вызовов к аккаунту за последнюю минуту от quota_per_minute."""
+        now = time.monotonic()
+        window = self.calls.setdefault(account_id, deque())
+        window.append(now)
+        while window and now - window[0] > 60:
+            window.popleft()
+        # Квота приложения у каждого токена своя
+        app_window = self.calls.setdefault(("app", token), deque())
+        app_window.append(now)
+        while app_window and now - app_window[0] > 60:
+            app_window.popleft()
+        account_pct = min(100, round(len(window) / self.quota_per_minute * 100))
+        app_pct = min(100, round(len(app_window) / (self.quota_per_minute * 10) * 100))
+        headers = {"X-App-Usage": json.dumps({"call_count": app_pct, "total_cputime": app_pct // 2, "total_time": app_pct // 2})}
+        if account_id != "app":
+            headers["X-Ad-Account-Usage"] = json.dumps({"acc_id_util_pct": account_pct, "reset_time_duration": 0})
+        return headers
+
+    async def dispatch(self, method: str, path: str, params: dict, token: str = "") -> tuple:
+        self.stats["api_calls"] += 1
+        self.stats["tokens"][token] = self.stats["tokens"].get(token, 0) + 1
+        parts = path.split("/")
+        endpoint = parts[-1] if len(parts) > 1 else ("node" if parts[0] else "batch")
+        self.stats["endpoints"][endpoint] = self.stats["endpoints"].get(endpoint, 0) + 1
+
+        if parts[0].startswith("act_"):
+            account_id = parts[0][4:]
+        elif parts[0][:1] in ("2", "3") and parts[0] not in self.runs:
+            # Кампания или группа: кабинет зашит в ID
+            account_id = str(100000 + int(parts[0][1:5]))
+        else:
+            account_id = "app"
+        headers = self.usage_headers(account_id, token)
+        fields = parse_fields(params.get("fields", ""))
+
+        if path == "me/adaccounts":
+            rows = [acc for acc in self.graph.accounts if self.visible(token, acc["account_id"])]
+        elif account_id != "app" and account_id not in self.graph.ads:
+            return 404, {"error": {"message": "Unknown account", "code": 100}}, headers
+        elif account_id != "app" and not self.visible(token, account_id):
+            return 400, {"error": {"message": "(#200) Ad account owner has not granted access", "code": 200}}, headers
+        elif len(parts) == 1 and parts[0].startswith("act_"):
+            return 200, self.project(account_id, {"id": parts[0], "account_id": account_id}, fields, token), headers
+        elif len(parts) == 2 and parts[1] in STRUCTURE_EDGES:
+            rows = self.edge_rows(account_id, parts[1], params, parts[0])
+        elif parts[0] in self.runs:
+            if len(parts) == 1:
+                return 200, {"id": parts[0], "async_status": "Job Completed", "async_percent_completion": 100}, headers
+            run_account, run_params = self.runs[parts[0]]
+            rows = self.insights_rows(run_account, {**run_params, **params})
+        elif len(parts) == 2 and parts[1] == "insights" and method == "POST":
+            run_id = f"9{len(self.runs) + 1:08d}"
+            self.runs[run_id] = (account_id, params)
+            return 200, {"report_run_id": run_id}, headers
+        elif len(parts) == 2 and parts[1] == "insights":
+            rows = self.insights_rows(account_id, params)
+        else:
+            return 400, {"error": {"message": f"Unsupported path on bench server: {path}", "code": 100}}, headers
+
+        page, paging = self.page(path, params, rows)
+        if has_nested_edges(fields):
+            page = [self.project(account_id, row, fields, token) for row in page]
+        if self.row_cost:
+            await asyncio.sleep(self.row_cost * len(page))
+        payload = {"data": page}
+        if paging:
+            payload["paging"] = paging
+        return 200, payload, headers
+
+    def page(self, path: str, params: dict, rows: list) -> tuple:
+        limit = int(params.get("limit", 25))
+        offset = int(params.get("after", 0) or 0)
+        page = rows[offset:offset + limit]
+        if offset + limit >= len(rows):
+            return page, {"cursors": {"before": str(offset), "after": str(offset + len(page))}} if page else None
+        after = str(offset + limit)
+        next_params = {k: v for k, v in params.items() if k != "after"}
+        next_params["after"] = after
+        return page, {
+            "cursors": {"before": str(offset), "after": after},
+            "next": f"{self.base_url}/{path}?{urlencode(next_params)}",
+        }
+
+    # --- Данные ---
+
+    @staticmethod
+    def matches(obj: dict, filtering: list) -> bool:
+        for rule in filtering:
+            field, operator, value = rule["field"], rule["operator"], rule["value"]
+            if field in ("effective_status", "ad.effective_status"):
+                actual = obj.get("effective_status")
+            elif field in ("adset.id", "ad.id"):
+                actual = obj.get("adset_id") if field == "adset.id" else obj.get("id")
+            elif field == "updated_time":
+                actual = UPDATED_TIME
+                value = time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(int(value)))
+            else:
+                continue
+            if operator == "IN" and actual not in value:
+                return False
+            if operator == "GREATER_THAN" and not actual > value:
+                return False
+        return True
+
+    def edge_rows(self, account_id: str, edge: str, params: dict, parent: str = None) -> list:
+        """Объекты ребра кабинета или, если parent — кампания/группа, только её потомки."""
+        parent = parent if parent and not parent.startswith("act_") else None
+        key = (parent or account_id, edge, params.get("filtering"))
+        if key not in self._results:
+            source = {"campaigns": self.graph.campaigns, "adsets": self.graph.adsets, "ads": self.graph.ads}[edge][account_id]
+            if parent:
+                parent_field = "campaign_id" if parent.startswith("2") else "adset_id"
+                source = [obj for obj in source if obj.get(parent_field) == parent]
+            filtering = json.loads(params.get("filtering") or "[]")
+            self._results[key] = [obj for obj in source if self.matches(obj, filtering)]
+        return self._results[key]
+
+    def project(self, account_id: str, obj: dict, fields: list, token: str) -> dict:
+        """Оставляет в объекте запрошенные поля, раскрывая вложенные рёбра первой страницей."""
+        result = {}
+        for name, modifiers, subfields in fields:
+            if name in STRUCTURE_EDGES:
+                result[name] = self.nested_edge(account_id, obj["id"], name, modifiers, subfields, token)
+            elif name in obj:
+                value = obj[name]
+                if subfields is not None and isinstance(value, dict):
+                    value = self.project(account_id, value, parse_fields(subfields), token)
+                result[name] = value
+        return result
+
+    def nested_edge(self, account_id: str, parent: str, edge: str, modifiers: dict, subfields: str, token: str) -> dict:
+        params = {"fields": subfields or "id", "limit": modifiers.get("limit", "25"), "access_token": token}
+        if "filtering" in modifiers:
+            params["filtering"] = modifiers["filtering"]
+        rows = self.edge_rows(account_id, edge, params, parent)
+        page, paging = self.page(f"{parent}/{edge}", params, rows)
+        fields = parse_fields(params["fields"])
+        result = {"data": [self.project(account_id, row, fields, token) for row in page]}
+        if paging:
+            result["paging"] = paging
+        return result
+
+    def insights_rows(self, account_id: str, params: dict) -> list:
+        key = (account_id, params.get("level"), params.get("time_range"), params.get("date_preset"),
+               str(params.get("time_increment")), params.get("filtering"))
+        if key in self._results:
+            return self._results[key]
+
+        if params.get("time_range"):
+            time_range = json.loads(params["time_range"])
+            since, until = date.fromisoformat(time_range["since"]), date.fromisoformat(time_range["until"])
+        else:
+            since, until = preset_range(params.get("date_preset", "yesterday"), self.today)
+        days = list(days_between(since, until))
+        daily = str(params.get("time_increment")) == "1"
+        filtering = json.loads(params.get("filtering") or "[]")
+        ads = [ad for ad in self.graph.delivering_ads(account_id) if self.matches(ad, filtering)]
+
+        rows = []
+        if params.get("level") == "campaign":
+            campaigns = self.graph.campaign_by_id(account_id)
+            active = sorted({ad["campaign_id"] for ad in ads})
+            spans = [(day, day) for day in days] if daily else [(since, until)]
+            for span_since, span_until in spans:
+                for campaign_id in active:
+                    stats = sum_stats([self.graph.day_stats(campaign_id, day) for day in days_between(span_since, span_until)])
+                    row = insight_row(stats, span_since, span_until)
+                    row.update(campaign_id=campaign_id, campaign_name=campaigns[campaign_id]["name"],
+                               objective=campaigns[campaign_id]["objective"])
+                    rows.append(row)
+        else:
+            spans = [(day, day) for day in days] if daily else [(since, until)]
+            for span_since, span_until in spans:
+                for ad in ads:
+                    stats = sum_stats([self.graph.day_stats(ad["id"], day) for day in days_between(span_since, span_until)])
+                    row = insight_row(stats, span_since, span_until)
+                    row["ad_id"] = ad["id"]
+                    rows.append(row)
+        self._results[key] = rows
+        return rows
+
+
+def bench_tokens(args: argparse.Namespace) -> list:
+    """Токены стенда; при одном токене — тот же, что в META_ACCESS_TOKEN."""
+    if args.tokens <= 1:
+        return ["bench-token"]
+    return [f"bench-token-{i + 1}" for i in range(args.tokens)]
+
+def run_mock_server(args: argparse.Namespace, port: int) -> None:
+    """Точка входа процесса стенда."""
+    graph = SyntheticGraph(args.accounts, args.campaigns, args.adsets, args.ads, args.seed)
+    api = MockGraphApi(graph, f"http://127.0.0.1:{port}/{API_VERSION}", args.latency_ms, args.jitter_ms,
+                       args.error_rate, args.quota_per_minute, args.row_cost_ms, args.seed, bench_tokens(args))
+    web.run_app(api.app(), host="127.0.0.1", port=port, print=None, handle_signals=True)
+
+
+# --- Поддельный Telegram ---
+
+class FakeBot:
+    """Минимальная замена aiogram.Bot для OutboundDispatcher: считает сообщения и байты."""
+
+    def __init__(self):
+        self.next_id = 1
+        self.reset()
+
+    def reset(self) -> None:
+        self.stats = {"messages": 0, "edits": 0, "deletes": 0, "text_bytes": 0}
+
+    def _message(self, chat_id: int) -> SimpleNamespace:
+        self.next_id += 1
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=self.next_id)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.stats["messages"] += 1
+        self.stats["text_bytes"] += len(text.encode())
+        return self._message(chat_id)
+
+    async def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None, **kwargs):
+        self.stats["edits"] += 1
+        return True
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        self.stats["deletes"] += 1
+        return True
+
+    async def delete_messages(self, chat_id: int, message_ids: list):
+        self.stats["deletes"] += len(message_ids)
+        return True
+
+
+# --- Прогон ---
+
+def reset_local_state(modules: SimpleNamespace) -> None:
+    """Сбрасывает локальные кэши, чтобы прогон был «холодным»."""
+    modules.structure.structure_cache.invalidate()
+    modules.structure.structure_mirror.invalidate()
+    modules.warehouse.warehouse.conn.execute("DELETE FROM ad_insights_daily")
+    modules.warehouse.warehouse.conn.execute("DELETE FROM insights_days")
+    modules.singleflight.report_flights.invalidate()
+    # История рекомендаций в памяти не знает об очистке хранилища мимо store()
+    modules.analytics._history = None
+    # Общий клиент помнит квоты и кабинеты токенов между отчётами
+    modules.http_session._client = None
+
+async def server_request(session: aiohttp.ClientSession, port: int, method: str, path: str) -> dict:
+    async with session.request(method, f"http://127.0.0.1:{port}{path}") as response:
+        return await response.json()
+
+async def wait_for_server(session: aiohttp.ClientSession, port: int, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await server_request(session, port, "GET", "/__stats")
+            return
+        except aiohttp.ClientConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+async def run_benchmark(args: argparse.Namespace, port: int) -> list:
+    # Модули бота читают окружение при импорте, поэтому импортируются только здесь
+    import main as bot_main
+    import analytics, http_session, structure, warehouse, singleflight
+    from metrics import metrics
+    from jobs import Job
+    from http_session import close_graph_session
+
+    modules = SimpleNamespace(analytics=analytics, http_session=http_session, structure=structure, warehouse=warehouse, singleflight=singleflight)
+    fake_bot = FakeBot()
+    bot_main.outbound = bot_main.OutboundDispatcher(fake_bot, chat_interval=0, global_rate=1e9)
+    from daily_report import generate_daily_report_text
+
+    time_range = None
+    if args.preset == "from_june_1":
+        time_range = {"since": "2025-06-01", "until": date.today().isoformat()}
+
+    async def run_report(control: aiohttp.ClientSession, report: str, run) -> tuple:
+        """Один прогон отчёта на чистых счётчиках стенда и метрик; возвращает (wall, cpu)."""
+        modules.singleflight.report_flights.invalidate()
+        await server_request(control, port, "POST", "/__reset")
+        fake_bot.reset()
+        metrics.counters.clear()
+        metrics.gauges.clear()
+        metrics.histograms.clear()
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        if report == "active":
+            job = Job(f"bench{run}", 1, 1, "active_campaigns", {"date_preset": args.preset, "time_range": time_range})
+            await bot_main.build_report(job)
+        elif report == "daily":
+            text = await generate_daily_report_text()
+            await bot_main.send_daily_report(1, text)
+        else:
+            await analytics.warm_up_history()
+            await bot_main.outbound.send_long(1, await analytics.build_recommendations_text())
+        return time.perf_counter() - started, time.process_time() - cpu_started
+
+    results = []
+    async with aiohttp.ClientSession() as control:
+        await wait_for_server(control, port)
+        for run in range(1, args.runs + 1):
+            if run == 1 or args.cold:
+                reset_local_state(modules)
+            for report in args.reports:
+                wall, cpu = await run_report(control, report, run)
+
+                server = await server_request(control, port, "GET", "/__stats")
+                retries = sum(v for (name, _), v in metrics.counters.items() if name == "fb_retries_total")
+                results.append({
+                    "run": run,
+                    "report": report,
+                    "wall_s": round(wall, 3),
+                    "cpu_s": round(cpu, 3),
+                    "http_requests": server["http_requests"],
+                    "api_calls": server["api_calls"],
+                    "bytes_in": server["bytes_out"],
+                    "rate_limited": server["rate_limited"],
+                    "retries": int(retries),
+                    "tg_messages": fake_bot.stats["messages"],
+                    "tg_edits": fake_bot.stats["edits"],
+                    "connections": int(metrics.counters.get(("http_connections_created_total", ()), 0)),
+                    "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                    "endpoints": server["endpoints"],
+                    "tokens": server["tokens"],
+                })
+
+        # Трассировка аллокаций замедляет код в разы, поэтому память меряется отдельным
+        # холодным прогоном, время которого в результаты не попадает
+        if args.memory:
+            reset_local_state(modules)
+            tracemalloc.start()
+            try:
+                for report in args.reports:
+                    tracemalloc.reset_peak()
+                    await run_report(control, report, "memory")
+                    peak = tracemalloc.get_traced_memory()[1]
+                    results.append({"run": "memory", "report": report, "peak_heap_mb": round(peak / 1024 / 1024, 1)})
+            finally:
+                tracemalloc.stop()
+    await close_graph_session()
+    return results
+
+def print_results(results: list) -> None:
+    columns = ["run", "report", "wall_s", "cpu_s", "http_requests", "api_calls", "bytes_in", "rate_limited",
+               "retries", "tg_messages", "tg_edits", "connections", "max_rss_mb"]
+    memory = [row for row in results if row["run"] == "memory"]
+    results = [row for row in results if row["run"] != "memory"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in results)) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for row in results:
+        print("  ".join(str(row[c]).rjust(widths[c]) for c in columns))
+    if memory:
+        peaks = ", ".join(f"{row['report']}={row['peak_heap_mb']} МБ" for row in memory)
+        print(f"Пиковая память Python (отдельный холодный прогон, tracemalloc): {peaks}")
+    for row in results:
+        endpoints = ", ".join(f"{k}={v}" for k, v in sorted(row["endpoints"].items()))
+        print(f"run {row['run']} {row['report']}: {endpoints}")
+        if len(row["tokens"]) > 1:
+            tokens = ", ".join(f"{k}={v}" for k, v in sorted(row["tokens"].items()))
+            print(f"run {row['run']} {row['report']} по токенам: {tokens}")
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк отчётов на локальном стенде Graph API")
+    parser.add_argument("--accounts", type=int, default=10, help="число кабинетов (1–200)")
+    parser.add_argument("--campaigns", type=int, default=10, help="кампаний на кабинет")
+    parser.add_argument("--adsets", type=int, default=3, help="групп на кампанию")
+    parser.add_argument("--ads", type=int, default=200, help="объявлений на кабинет")
+    parser.add_argument("--latency-ms", type=float, default=50, help="средняя задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="разброс задержки")
+    parser.add_argument("--row-cost-ms", type=float, default=0.0, help="доп. задержка на строку ответа")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--quota-per-minute", type=int, default=2000, help="вызовов в минуту на кабинет до 100%% квоты")
+    parser.add_argument("--tokens", type=int, default=1, help="токенов (Business Manager), между которыми делятся кабинеты")
+    parser.add_argument("--preset", default="last_7d",
+                        choices=["today", "yesterday", "last_7d", "last_30d", "from_june_1"])
+    parser.add_argument("--reports", default="active,daily", help="какие отчёты гонять: active, daily, recs")
+    parser.add_argument("--runs", type=int, default=1, help="прогонов; со второго кэши тёплые, если нет --cold")
+    parser.add_argument("--cold", action="store_true", help="сбрасывать локальные кэши перед каждым прогоном")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--memory", action="store_true",
+                        help="после замеров времени отдельно измерить пиковую память Python (tracemalloc)")
+    parser.add_argument("--json", help="дополнительно записать результаты в JSON-файл")
+    args = parser.parse_args(argv)
+
+    args.reports = [r.strip() for r in args.reports.split(",") if r.strip()]
+    if not 1 <= args.accounts <= 200:
+        parser.error("--accounts должен быть от 1 до 200")
+    if args.accounts * args.ads > MAX_TOTAL_ADS:
+        parser.error(f"всего объявлений не больше {MAX_TOTAL_ADS}")
+    if set(args.reports) - {"active", "daily", "recs"}:
+        parser.error("--reports: допустимы active, daily и recs")
+    return args
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="fb-bench-")
+    os.environ.update({
+        "FB_GRAPH_URL": f"http://127.0.0.1:{args.port}/{API_VERSION}",
+        "META_ACCESS_TOKEN": "bench-token",
+        "META_ACCESS_TOKENS": ",".join(f"bm{i + 1}:{token}" for i, token in enumerate(bench_tokens(args))),
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "BOT_DB_PATH": os.path.join(workdir, "bench.sqlite3"),
+    })
+
+    server = multiprocessing.Process(target=run_mock_server, args=(args, args.port), daemon=True)
+    server.start()
+    try:
+        results = asyncio.run(run_benchmark(args, args.port))
+    finally:
+        server.terminate()
+        server.join()
+
+    from fb_api import json_loads
+    print(f"Кабинетов: {args.accounts}, объявлений на кабинет: {args.ads}, период: {args.preset}, "
+          f"задержка {args.latency_ms}±{args.jitter_ms} мс, 429: {args.error_rate:.0%}, токенов: {args.tokens}, JSON: {json_loads.__module__}")
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+from storage import connect
+
+# --- Конфигурация ---
+# Сколько секунд структура кабинета считается свежей
+STRUCTURE_CACHE_TTL = int(os.getenv("STRUCTURE_CACHE_TTL", "3600"))
+# Сколько кабинетов максимум держим в кэше (лишние вытесняются по давности использования)
+STRUCTURE_CACHE_MAX_ENTRIES = int(os.getenv("STRUCTURE_CACHE_MAX_ENTRIES", "500"))
+
+
+class StructureCache:
+    """
+    Дисковый кэш структуры кабинетов (кампании, группы, объявления, превью).
+
+    Записи хранятся в SQLite по ID аккаунта, живут ttl секунд и вытесняются
+    по давности последнего обращения, когда их больше max_entries.
+    """
+
+    def __init__(self, path: str = None, ttl: int = STRUCTURE_CACHE_TTL, max_entries: int = STRUCTURE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS structure_cache ("
+            " account_id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " fetched_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+
+    def get(self, account_id: str):
+        """Возвращает структуру кабинета или None, если её нет или она устарела."""
+        row = self.conn.execute(
+            "SELECT payload, fetched_at FROM structure_cache WHERE account_id = ?", (account_id,)
+        ).fetchone()
+        if not row:
+            return None
+        payload, fetched_at = row
+        now = time.time()
+        if now - fetched_at > self.ttl:
+            return None
+        self.conn.execute("UPDATE structure_cache SET accessed_at = ? WHERE account_id = ?", (now, account_id))
+        return json.loads(payload)
+
+    def put(self, account_id: str, structure: dict) -> None:
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO structure_cache (account_id, payload, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (account_id, json.dumps(structure, ensure_ascii=False), now, now),
+        )
+        self.conn.execute(
+            "DELETE FROM structure_cache WHERE account_id NOT IN"
+            " (SELECT account_id FROM structure_cache ORDER BY accessed_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def invalidate(self, account_id: str = None) -> int:
+        """Сбрасывает кэш одного кабинета или целиком. Возвращает число удалённых записей."""
+        if account_id is None:
+            cursor = self.conn.execute("DELETE FROM structure_cache")
+        else:
+            cursor = self.conn.execute("DELETE FROM structure_cache WHERE account_id = ?", (account_id,))
+        return cursor.rowcount
+
+
+class StructureMirror:
+    """
+    Полная локальная копия структуры кабинета для инкрементальной синхронизации.
+
+    Хранит все кампании, группы и объявления (в том числе на паузе) и отметку
+    времени последней синхронизации, с которой запрашиваются изменения.
+    """
+
+    def __init__(self, path: str = None):
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS structure_mirror ("
+            " account_id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " watermark REAL NOT NULL)"
+        )
+
+    def get(self, account_id: str):
+        """Возвращает (копия, отметка синхронизации) или (None, None)."""
+        row = self.conn.execute(
+            "SELECT payload, watermark FROM structure_mirror WHERE account_id = ?", (account_id,)
+        ).fetchone()
+        if not row:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def put(self, account_id: str, mirror: dict, watermark: float) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO structure_mirror (account_id, payload, watermark) VALUES (?, ?, ?)",
+            (account_id, json.dumps(mirror, ensure_ascii=False), watermark),
+        )
+
+    def invalidate(self, account_id: str = None) -> int:
+        if account_id is None:
+            cursor = self.conn.execute("DELETE FROM structure_mirror")
+        else:
+            cursor = self.conn.execute("DELETE FROM structure_mirror WHERE account_id = ?", (account_id,))
+        return cursor.rowcount
@@ -1,43 +1,67 @@
 import os
 import asyncio
-import aiohttp
 from datetime import datetime, timedelta
 import json
+import html
 from dotenv import load_dotenv
+from fb_api import GRAPH_URL, LEAD_ACTION_TYPE, FbApiClient, extract_actions
+from http_session import graph_client
 
 # --- Конфигурация ---
 load_dotenv()
-API_VERSION = "v19.0"
-META_TOKEN = os.getenv("META_ACCESS_TOKEN")
-LEAD_ACTION_TYPE = "onsite_conversion.messaging_conversation_started_7d"
-LINK_CLICK_ACTION_TYPE = "link_click" # Оставляем на случай, если понадобится в будущем
+# Сколько кабинетов обрабатывается одновременно
+DAILY_REPORT_CONCURRENCY = int(os.getenv("DAILY_REPORT_CONCURRENCY", "8"))
+# Сколько секунд даётся на один кабинет
+DAILY_ACCOUNT_TIMEOUT = float(os.getenv("DAILY_ACCOUNT_TIMEOUT", "60"))
+# Общий срок на сбор всех кабинетов; не успевшие попадают в список опоздавших
+DAILY_REPORT_DEADLINE = float(os.getenv("DAILY_REPORT_DEADLINE", "240"))
+# Дублировать запрос кабинета, который отвечает дольше p95 уже готовых
+DAILY_HEDGE_REQUESTS = os.getenv("DAILY_HEDGE_REQUESTS", "0") == "1"
+# Сколько замеров нужно, прежде чем считать p95 для дублирования
+HEDGE_MIN_SAMPLES = 5
+# Ежедневной сводке из actions нужны только лиды
+DAILY_ACTIONS = {LEAD_ACTION_TYPE: 0}
 
 
 # --- Функции API ---
 
-async def fb_get(session: aiohttp.ClientSession, url: str, params: dict = None):
-    params = params or {}
-    params["access_token"] = META_TOKEN
-    async with session.get(url, params=params) as response:
-        response.raise_for_status()
-        return await response.json()
-
-async def get_insights_for_range(session: aiohttp.ClientSession, account_id: str, time_range: dict):
-    url = f"https://graph.facebook.com/{API_VERSION}/act_{account_id}/insights"
+async def get_insights_for_range(client: FbApiClient, account_id: str, time_range: dict, time_increment: int = None):
+    url = f"{GRAPH_URL}/act_{account_id}/insights"
     params = {
         "fields": "campaign_id,campaign_name,spend,actions,objective",
         "level": "campaign",
         "time_range": json.dumps(time_range),
         "limit": 500
     }
-    data = await fb_get(session, url, params=params)
-    return data.get("data", [])
+    if time_increment:
+        params["time_increment"] = time_increment
+    return await client.get_all(url, params=params)
+
+async def get_insights_for_periods(client: FbApiClient, account_id: str, periods: list):
+    """
+    Получает статистику кампаний сразу за несколько периодов одним запросом.
+
+    Запрашивается весь охватывающий диапазон с разбивкой по дням (time_increment=1),
+    строки раскладываются по периодам по date_start. Возвращает списки строк
+    в порядке periods.
+    """
+    since = min(p['since'] for p in periods)
+    until = max(p['until'] for p in periods)
+    insights = await get_insights_for_range(client, account_id, {'since': since, 'until': until}, time_increment=1)
+
+    buckets = [[] for _ in periods]
+    for row in insights:
+        day = row.get('date_start')
+        for bucket, period in zip(buckets, periods):
+            if period['since'] <= day <= period['until']:
+                bucket.append(row)
+    return buckets
 
 
 # --- Функции обработки и анализа данных ---
 
 def process_insights_data(insights: list):
-    """ИЗМЕНЕНО: Убран подсчет кликов."""
+    """ИЗМЕНЕНО: Убран подсчет кликов. Дневные строки одной кампании суммируются."""
     data = {}
     for campaign in insights:
         spend = float(campaign.get("spend", 0))
@@ -46,11 +70,17 @@ def process_insights_data(insights: list):
         camp_id = campaign.get('campaign_id')
         if not camp_id: continue
 
+        leads = extract_actions(campaign.get("actions"), DAILY_ACTIONS)[0]
+        if camp_id in data:
+            data[camp_id]["spend"] += spend
+            data[camp_id]["leads"] += leads
+            continue
+
         data[camp_id] = {
             "name": campaign.get('campaign_name'),
             "objective": campaign.get('objective', 'N/A'),
             "spend": spend,
-            "leads": sum(int(a["value"]) for a in campaign.get("actions", []) if a.get("action_type") == LEAD_ACTION_TYPE),
+            "leads": leads,
         }
     return data
 
@@ -102,40 +132,100 @@ def format_key_campaigns(data_yesterday: dict):
     best = sorted_campaigns[0]
 
     lines = ["<b>🔑 Ключевые кампании (по CPL):</b>"]
-    lines.append(f"🏆 Лучшая: \"{best['name']}\" (${best['cost']:.2f})")
+    lines.append(f"🏆 Лучшая: \"{html.escape(best['name'] or '')}\" (${best['cost']:.2f})")
     if len(sorted_campaigns) > 1:
         worst = sorted_campaigns[-1]
-        lines.append(f"🐌 Худшая: \"{worst['name']}\" (${worst['cost']:.2f})")
+        lines.append(f"🐌 Худшая: \"{html.escape(worst['name'] or '')}\" (${worst['cost']:.2f})")
             
     return "\n".join(lines)
 
 
+# --- Планировщик запросов ---
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def gather_bounded(items: list, worker, concurrency: int, timeout: float, deadline: float = None, hedge: bool = False):
+    """
+    Выполняет worker(item) для всех items не более чем concurrency одновременно.
+
+    Каждый вызов ограничен timeout секундами и общим сроком deadline (время
+    loop.time()). При hedge=True для вызова, работающего дольше p95 уже
+    завершённых, запускается дубликат, и берётся первый успешный ответ.
+    Возвращает (результаты в порядке items, список (item, причина) для
+    упавших и опоздавших).
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = []
+
+    async def run_one(item):
+        async with semaphore:
+            start = loop.time()
+            item_deadline = start + timeout
+            if deadline is not None:
+                item_deadline = min(item_deadline, deadline)
+            tasks = {asyncio.create_task(worker(item))}
+            hedged = False
+            last_error = None
+            try:
+                while tasks:
+                    wait_until = item_deadline
+                    if hedge and not hedged and len(latencies) >= HEDGE_MIN_SAMPLES:
+                        wait_until = min(wait_until, start + percentile(latencies, 95))
+                    done, _ = await asyncio.wait(tasks, timeout=max(0, wait_until - loop.time()),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        tasks.discard(task)
+                        if task.exception() is None:
+                            latencies.append(loop.time() - start)
+                            return task.result()
+                        last_error = task.exception()
+                    if done:
+                        continue
+                    if loop.time() >= item_deadline:
+                        failed.append((item, "таймаут"))
+                        return None
+                    # Дольше p95 — запускаем дубликат, оригинал продолжает работать
+                    hedged = True
+                    tasks.add(asyncio.create_task(worker(item)))
+                failed.append((item, f"ошибка: {last_error}"))
+                return None
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    results = await asyncio.gather(*(run_one(item) for item in items))
+    return results, failed
+
+
 # --- Главные функции модуля ---
 
-async def process_single_account(session: aiohttp.ClientSession, acc: dict, time_yesterday: dict, time_before_yesterday: dict):
-    try:
-        insights_yesterday = await get_insights_for_range(session, acc['account_id'], time_yesterday)
-        insights_before_yesterday = await get_insights_for_range(session, acc['account_id'], time_before_yesterday)
+async def process_single_account(client: FbApiClient, acc: dict, time_yesterday: dict, time_before_yesterday: dict):
+    # Оба дня приходят одним запросом с разбивкой по дням
+    insights_yesterday, insights_before_yesterday = await get_insights_for_periods(
+        client, acc['account_id'], [time_yesterday, time_before_yesterday]
+    )
 
-        processed_yesterday = process_insights_data(insights_yesterday)
-        if not processed_yesterday: return None
+    processed_yesterday = process_insights_data(insights_yesterday)
+    if not processed_yesterday: return None
 
-        processed_before_yesterday = process_insights_data(insights_before_yesterday)
-        
-        summary_title = f"🏢 Кабинет: <u>{acc['name']}</u>"
-        summary_block = format_summary(summary_title, processed_yesterday, processed_before_yesterday)
-        key_campaigns_block = format_key_campaigns(processed_yesterday)
+    processed_before_yesterday = process_insights_data(insights_before_yesterday)
+    
+    summary_title = f"🏢 Кабинет: <u>{html.escape(acc['name'])}</u>"
+    summary_block = format_summary(summary_title, processed_yesterday, processed_before_yesterday)
+    key_campaigns_block = format_key_campaigns(processed_yesterday)
 
-        report_text = "\n\n".join(filter(None, [summary_block, key_campaigns_block]))
-        
-        return {
-            "text": report_text,
-            "data_y": processed_yesterday,
-            "data_by": processed_before_yesterday,
-        }
-    except Exception as e:
-        print(f"Ошибка при обработке аккаунта {acc['name']}: {e}")
-        return None
+    report_text = "\n\n".join(filter(None, [summary_block, key_campaigns_block]))
+    
+    return {
+        "text": report_text,
+        "data_y": processed_yesterday,
+        "data_by": processed_before_yesterday,
+    }
 
 async def generate_daily_report_text() -> str:
     today = datetime.now()
@@ -145,18 +235,34 @@ async def generate_daily_report_text() -> str:
     time_range_yesterday = {'since': yesterday_str, 'until': yesterday_str}
     time_range_before_yesterday = {'since': before_yesterday_str, 'until': before_yesterday_str}
 
-    timeout = aiohttp.ClientTimeout(total=300)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        accounts_response = await fb_get(session, f"https://graph.facebook.com/{API_VERSION}/me/adaccounts", {"fields": "name,account_id"})
-        accounts = accounts_response.get("data", [])
-        
-        if not accounts: return "❌ Не найдено ни одного рекламного аккаунта."
+    # Время ограничивается сроками на кабинет; клиент и пул соединений общие для всего приложения
+    client = graph_client()
+    accounts = await client.get_ad_accounts("name,account_id")
+    
+    if not accounts: return "❌ Не найдено ни одного рекламного аккаунта."
+
+    async def worker(acc: dict):
+        return await process_single_account(client, acc, time_range_yesterday, time_range_before_yesterday)
+
+    results, failed = await gather_bounded(
+        accounts, worker,
+        concurrency=DAILY_REPORT_CONCURRENCY,
+        timeout=DAILY_ACCOUNT_TIMEOUT,
+        deadline=asyncio.get_running_loop().time() + DAILY_REPORT_DEADLINE,
+        hedge=DAILY_HEDGE_REQUESTS,
+    )
 
-        tasks = [process_single_account(session, acc, time_range_yesterday, time_range_before_yesterday) for acc in accounts]
-        results = await asyncio.gather(*tasks)
+    for acc, reason in failed:
+        print(f"Ошибка при обработке аккаунта {acc['name']}: {reason}")
+    failed_block = ""
+    if failed:
+        failed_lines = [f"● {html.escape(acc['name'])} — {html.escape(str(reason))}" for acc, reason in failed]
+        failed_block = "<b>⚠️ Нет данных по кабинетам:</b>\n" + "\n".join(failed_lines)
 
     valid_results = [res for res in results if res]
     if not valid_results:
+        if failed_block:
+            return "❌ Не удалось получить данные ни по одному кабинету с активностью.\n\n" + failed_block
         return "✅ За вчерашний день не было активности ни в одном из кабинетов."
     
     total_y_data, total_by_data = {}, {}
@@ -177,5 +283,7 @@ async def generate_daily_report_text() -> str:
     
     separator = "\n\n- - - - - - - - - -\n\n"
     final_report = header + "\n\n" + total_summary_block + separator + separator.join(detailed_reports)
+    if failed_block:
+        final_report += separator + failed_block
     
     return final_report
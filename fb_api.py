@@ -0,0 +1,688 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import aiohttp
+from datetime import datetime
+from itertools import zip_longest
+from urllib.parse import parse_qsl, urlencode, urlparse
+from multidict import CIMultiDict
+from dotenv import load_dotenv
+from metrics import ROWS_BUCKETS, metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- Конфигурация ---
+load_dotenv()
+API_VERSION = "v19.0"
+# Базовый адрес Graph API; переопределяется, например, для локального стенда bench.py
+GRAPH_URL = os.getenv("FB_GRAPH_URL", f"https://graph.facebook.com/{API_VERSION}").rstrip("/")
+META_TOKEN = os.getenv("META_ACCESS_TOKEN")
+# Пул токенов (например, по одному на Business Manager) через запятую, можно с именем: "bm1:EAAB...,bm2:EAAC...".
+# У каждого токена своя квота приложения; запросы к кабинету идут через токен, у которого квоты больше всего.
+META_TOKENS = [t.strip() for t in os.getenv("META_ACCESS_TOKENS", "").split(",") if t.strip()]
+LEAD_ACTION_TYPE = "onsite_conversion.messaging_conversation_started_7d"
+LINK_CLICK_ACTION_TYPE = "link_click"
+
+# Коды ошибок Graph API, означающие ограничение частоты запросов
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613, *range(80000, 80015)}
+# Коды временных сбоев на стороне Meta
+TRANSIENT_ERROR_CODES = {1, 2}
+
+# Начиная с этого процента использования квоты запросы к аккаунту замедляются
+THROTTLE_START_PCT = float(os.getenv("FB_THROTTLE_START_PCT", "60"))
+# Максимальная пауза между запросами к одному аккаунту при ~100% использования
+THROTTLE_MAX_SPACING = float(os.getenv("FB_THROTTLE_MAX_SPACING", "5"))
+FB_MAX_RETRIES = int(os.getenv("FB_MAX_RETRIES", "5"))
+# Окно (в секундах), за которое одновременные GET-запросы собираются в один batch.
+# 0 — пакетный режим выключен.
+FB_BATCH_WINDOW = float(os.getenv("FB_BATCH_WINDOW", "0"))
+# Максимум подзапросов в одном batch-запросе Graph API
+BATCH_LIMIT = 50
+# Пороги, начиная с которых статистика запрашивается асинхронным отчётом (report run)
+ASYNC_INSIGHTS_MIN_ADS = int(os.getenv("ASYNC_INSIGHTS_MIN_ADS", "1000"))
+ASYNC_INSIGHTS_MIN_DAYS = int(os.getenv("ASYNC_INSIGHTS_MIN_DAYS", "31"))
+# Интервал опроса статуса асинхронного отчёта: начальный и максимальный
+ASYNC_POLL_INTERVAL = 2.0
+ASYNC_POLL_MAX_INTERVAL = 15.0
+
+# Разбор JSON-ответов: orjson (если установлен) быстрее и строит объекты с меньшим расходом памяти
+json_loads = orjson.loads if orjson is not None else json.loads
+# Какие action_type нужны отчётам и их место в результате extract_actions
+REPORT_ACTIONS = {LEAD_ACTION_TYPE: 0, LINK_CLICK_ACTION_TYPE: 1}
+
+_ACCOUNT_RE = re.compile(r"(?:^|/)act_(\d+)")
+_BATCH_REF_RE = re.compile(r"\{result=([^:}]+):")
+
+
+class FbApiError(Exception):
+    """Ошибка, возвращённая Graph API."""
+
+    def __init__(self, status: int, message: str, code: int = None, subcode: int = None,
+                 is_transient: bool = False, retry_after: float = 0):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.code = code
+        self.subcode = subcode
+        self.is_transient = is_transient
+        self.retry_after = retry_after
+
+    @property
+    def is_rate_limit(self) -> bool:
+        return self.status == 429 or self.code in RATE_LIMIT_ERROR_CODES
+
+    @property
+    def is_retryable(self) -> bool:
+        return self.is_rate_limit or self.is_transient or self.status >= 500 or self.code in TRANSIENT_ERROR_CODES
+
+
+def _parse_json_header(value: str):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+def extract_actions(actions: list, wanted: dict = REPORT_ACTIONS) -> list:
+    """Суммирует значения нужных action_type за один проход по actions: [сумма для каждого типа из wanted]."""
+    totals = [0] * len(wanted)
+    for action in actions or ():
+        slot = wanted.get(action.get("action_type"))
+        if slot is not None:
+            totals[slot] += int(action["value"])
+    return totals
+
+
+class AdStats:
+    """Статистика объявления за период; компактнее словаря на тысячах объявлений."""
+
+    __slots__ = ("spend", "leads", "clicks", "ctr")
+
+    def __init__(self, spend: float = 0.0, leads: int = 0, clicks: int = 0, ctr: float = 0.0):
+        self.spend = spend
+        self.leads = leads
+        self.clicks = clicks
+        self.ctr = ctr
+
+    @classmethod
+    def from_row(cls, row: dict) -> "AdStats":
+        """Строка Insights уровня объявления (spend, actions, ctr)."""
+        leads, clicks = extract_actions(row.get("actions"))
+        return cls(float(row.get("spend", 0)), leads, clicks, float(row.get("ctr", 0)))
+
+def parse_token(value: str, index: int) -> tuple:
+    """(имя, токен) из записи META_ACCESS_TOKENS; без имени токен называется t1, t2, ..."""
+    name, sep, token = (value or "").partition(":")
+    if sep and token:
+        return name.strip(), token.strip()
+    return f"t{index + 1}", value
+
+def should_use_async_insights(ad_count: int = 0, time_range: dict = None) -> bool:
+    """Решает, запрашивать ли статистику асинхронным отчётом: много объявлений или длинный период."""
+    if ad_count >= ASYNC_INSIGHTS_MIN_ADS:
+        return True
+    if time_range:
+        since = datetime.strptime(time_range["since"], '%Y-%m-%d')
+        until = datetime.strptime(time_range["until"], '%Y-%m-%d')
+        return (until - since).days + 1 >= ASYNC_INSIGHTS_MIN_DAYS
+    return False
+
+def account_key_from_url(url: str) -> str:
+    """Возвращает ID аккаунта из URL запроса или "app" для запросов вне аккаунта."""
+    match = _ACCOUNT_RE.search(url)
+    return match.group(1) if match else "app"
+
+def endpoint_from_url(url: str) -> str:
+    """Имя эндпоинта для метрик: последнее ребро пути (insights, ads, ...) или "node"."""
+    segment = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+    if not segment or segment.startswith(API_VERSION):
+        return "batch"
+    if segment.isdigit() or segment.startswith("act_"):
+        return "node"
+    return segment
+
+
+# --- Клиент ---
+
+class TokenState:
+    """Токен пула и его квоты: приложения ("app") и аккаунтов, к которым обращались через этот токен."""
+
+    def __init__(self, name: str, token: str):
+        self.name = name
+        self.token = token
+        # Процент использования квоты: по аккаунтам и "app" для приложения в целом
+        self.usage = {}
+        # Время (monotonic), до которого запросы к ключу заблокированы Meta
+        self.blocked_until = {}
+        # Ближайшее время, когда можно отправить следующий запрос к ключу
+        self.next_slot = {}
+        # Запросов через токен, ожидающих паузы или ответа
+        self.in_flight = 0
+
+    def load(self, key: str, now: float) -> tuple:
+        """Загрузка для выбора токена: заблокирован ли, % квоты, запросов в работе — меньше лучше."""
+        blocked = max(self.blocked_until.get(key, 0), self.blocked_until.get("app", 0)) > now
+        return blocked, max(self.usage.get(key, 0), self.usage.get("app", 0)), self.in_flight
+
+
+class FbApiClient:
+    """
+    Общий клиент Graph API для всех отчётов.
+
+    Читает заголовки X-App-Usage, X-Ad-Account-Usage и X-Business-Use-Case-Usage,
+    заранее разрежает запросы к аккаунту, квота которого подходит к концу,
+    и повторяет временные ошибки и ошибки лимитов с экспоненциальной паузой.
+
+    Может работать с пулом токенов (META_ACCESS_TOKENS): квоты учитываются
+    отдельно по каждому токену, а запрос к кабинету уходит через наименее
+    загруженный из токенов, которым этот кабинет виден (см. get_ad_accounts).
+    Приложение держит один клиент (http_session.graph_client), чтобы квоты и
+    загрузка токенов были общими для всех отчётов и не забывались между ними.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, token: str = None, max_retries: int = FB_MAX_RETRIES,
+                 base_delay: float = 1.0, max_delay: float = 60.0, batch_window: float = FB_BATCH_WINDOW,
+                 loads=json_loads, tokens: list = None):
+        self.session = session
+        # Функция разбора JSON-ответов (по умолчанию orjson, если установлен)
+        self.loads = loads
+        if tokens is None:
+            tokens = [token] if token else META_TOKENS or [META_TOKEN]
+        self.tokens = [TokenState(*parse_token(value, i)) for i, value in enumerate(tokens)]
+        self._by_token = {state.token: state for state in self.tokens}
+        # Какими токенами виден кабинет: account_id -> [TokenState]; заполняет get_ad_accounts
+        self.account_tokens = {}
+        # Последний удачный список кабинетов токена: (TokenState, fields) -> [строки /me/adaccounts]
+        self.token_accounts = {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Накопитель одиночных GET-запросов для пакетной отправки
+        self.batch_window = batch_window
+        self._batch_queue = []
+        self._batch_flush = None
+
+    # --- Учёт квоты ---
+
+    def _update_usage(self, state: TokenState, key: str, headers) -> None:
+        now = time.monotonic()
+
+        app_usage = _parse_json_header(headers.get("X-App-Usage"))
+        if app_usage:
+            state.usage["app"] = max((float(v) for v in app_usage.values() if isinstance(v, (int, float))), default=0)
+
+        # Итоговая загрузка аккаунта — максимум из заголовков этого ответа
+        account_pcts = []
+        account_usage = _parse_json_header(headers.get("X-Ad-Account-Usage"))
+        if account_usage:
+            pct = float(account_usage.get("acc_id_util_pct", 0) or 0)
+            account_pcts.append(pct)
+            reset = float(account_usage.get("reset_time_duration", 0) or 0)
+            if pct >= 100 and reset:
+                state.blocked_until[key] = max(state.blocked_until.get(key, 0), now + reset)
+
+        buc_usage = _parse_json_header(headers.get("X-Business-Use-Case-Usage"))
+        if buc_usage:
+            for entries in buc_usage.values():
+                for entry in entries:
+                    account_pcts.append(max(float(entry.get(k, 0) or 0) for k in ("call_count", "total_cputime", "total_time")))
+                    regain_minutes = float(entry.get("estimated_time_to_regain_access", 0) or 0)
+                    if regain_minutes:
+                        state.blocked_until[key] = max(state.blocked_until.get(key, 0), now + regain_minutes * 60)
+
+        if account_pcts and key != "app":
+            state.usage[key] = max(account_pcts)
+        # Метка token нужна, только если токенов несколько
+        labels = {"token": state.name} if len(self.tokens) > 1 else {}
+        for usage_key in ("app", key):
+            if usage_key in state.usage:
+                metrics.set("fb_usage_percent", state.usage[usage_key], account=usage_key, **labels)
+
+    def _spacing_for(self, state: TokenState, key: str) -> float:
+        """Пауза между запросами к ключу в зависимости от использования квоты."""
+        pct = max(state.usage.get(key, 0), state.usage.get("app", 0))
+        if pct < THROTTLE_START_PCT:
+            return 0.0
+        ratio = min(1.0, (pct - THROTTLE_START_PCT) / (100 - THROTTLE_START_PCT))
+        return THROTTLE_MAX_SPACING * ratio ** 2
+
+    async def _throttle(self, state: TokenState, key: str) -> None:
+        now = time.monotonic()
+        slot = max(now, state.next_slot.get(key, 0), state.blocked_until.get(key, 0), state.blocked_until.get("app", 0))
+        state.next_slot[key] = slot + self._spacing_for(state, key)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # --- Пул токенов ---
+
+    def token_for(self, key: str) -> TokenState:
+        """
+        Токен для запроса к ключу (ID кабинета или "app").
+
+        Из токенов, которым виден кабинет, выбирается незаблокированный с
+        наименьшим процентом квоты (кабинета и приложения), при равенстве —
+        с меньшим числом запросов в работе, чтобы нагрузка расходилась по пулу.
+        """
+        candidates = self.account_tokens.get(key) or self.tokens
+        if len(candidates) == 1:
+            return candidates[0]
+        now = time.monotonic()
+        return min(candidates, key=lambda state: state.load(key, now))
+
+    def _state_for_request(self, url: str, params: dict = None, data: dict = None) -> TokenState:
+        """Токен, с которым уже собран запрос (в params, data или в ссылке paging.next)."""
+        token = (params or {}).get("access_token") or (data or {}).get("access_token")
+        if token is None:
+            token = dict(parse_qsl(urlparse(url).query)).get("access_token")
+        return self._by_token.get(token) or self.tokens[0]
+
+    async def get_ad_accounts(self, fields: str = "name,account_id") -> list:
+        """
+        Рекламные кабинеты, видимые хотя бы одному токену пула, без повторов.
+
+        Запоминает, какими токенами виден каждый кабинет, — по этому списку
+        token_for выбирает токен для запросов к кабинету. Кабинеты разных
+        токенов чередуются, чтобы отчёты, обходящие их по порядку, сразу
+        нагружали все токены. Для токена, запрос которого не удался, берутся
+        его кабинеты с прошлого удачного вызова, если остальные ответили.
+        """
+        url = f"{GRAPH_URL}/me/adaccounts"
+        results = await asyncio.gather(
+            *(self.get_all(url, {"fields": fields, "access_token": state.token}) for state in self.tokens),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+
+        # Клиент живёт всё время работы бота: для токена, который сейчас не ответил,
+        # остаются кабинеты, известные по прошлым вызовам
+        account_tokens = {}
+        visible_lists = []
+        for state, result in zip(self.tokens, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось получить кабинеты токена {state.name}: {type(result).__name__}: {result}")
+                result = self.token_accounts.get((state, fields), [])
+            else:
+                self.token_accounts[(state, fields)] = result
+            visible_lists.append(result)
+            for acc in result:
+                account_tokens.setdefault(acc["account_id"], []).append(state)
+        self.account_tokens = account_tokens
+
+        accounts = []
+        seen = set()
+        for row in zip_longest(*visible_lists):
+            for acc in row:
+                if acc is not None and acc["account_id"] not in seen:
+                    seen.add(acc["account_id"])
+                    accounts.append(acc)
+        return accounts
+
+    def _backoff(self, attempt: int, error: FbApiError = None) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if error is not None and error.retry_after:
+            delay = max(delay, error.retry_after)
+        return delay
+
+    # --- Запросы ---
+
+    @staticmethod
+    def _error_from_payload(status: int, payload, headers, reason: str = None) -> FbApiError:
+        error = payload.get("error", {}) if isinstance(payload, dict) else {}
+        retry_after = float(headers.get("Retry-After", 0) or 0)
+        return FbApiError(
+            status=status,
+            message=error.get("error_user_msg") or error.get("message") or reason or "Нет сообщения",
+            code=error.get("code"),
+            subcode=error.get("error_subcode"),
+            is_transient=bool(error.get("is_transient")),
+            retry_after=retry_after,
+        )
+
+    async def _parse_error(self, response: aiohttp.ClientResponse) -> FbApiError:
+        try:
+            payload = await response.json(content_type=None)
+        except (ValueError, aiohttp.ContentTypeError):
+            payload = None
+        return self._error_from_payload(response.status, payload, response.headers, response.reason)
+
+    async def _request(self, method: str, url: str, params: dict = None, data: dict = None) -> dict:
+        state = self._state_for_request(url, params, data)
+        state.in_flight += 1
+        try:
+            return await self._request_with(state, method, url, params, data)
+        finally:
+            state.in_flight -= 1
+
+    async def _request_with(self, state: TokenState, method: str, url: str, params: dict = None, data: dict = None) -> dict:
+        key = account_key_from_url(url)
+        endpoint = endpoint_from_url(url)
+        for attempt in range(self.max_retries + 1):
+            await self._throttle(state, key)
+            started = time.monotonic()
+            try:
+                async with self.session.request(method, url, params=params, data=data) as response:
+                    self._update_usage(state, key, response.headers)
+                    body = await response.read()
+                    metrics.observe("fb_request_seconds", time.monotonic() - started, endpoint=endpoint)
+                    metrics.inc("fb_requests_total", endpoint=endpoint, status=str(response.status))
+                    metrics.inc("fb_response_bytes_total", len(body), endpoint=endpoint)
+                    if response.status < 400:
+                        # Тело уже прочитано — разбираем байты напрямую, без промежуточной строки
+                        return self.loads(body)
+                    error = await self._parse_error(response)
+            except (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                metrics.inc("fb_retries_total", endpoint=endpoint, reason="network")
+                print(f"Сетевая ошибка Graph API ({e}), повтор {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            if not error.is_retryable or attempt >= self.max_retries:
+                raise error
+            # Для ошибок лимита учитываем ещё и блокировку из заголовков
+            if error.is_rate_limit:
+                blocked = max(state.blocked_until.get(key, 0), state.blocked_until.get("app", 0)) - time.monotonic()
+                error.retry_after = max(error.retry_after, blocked)
+            delay = self._backoff(attempt, error)
+            metrics.inc("fb_retries_total", endpoint=endpoint, reason="rate_limit" if error.is_rate_limit else "transient")
+            print(f"Graph API {error.status}/{error.code}: {error.message}. Повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+    def _with_token(self, url: str, params: dict = None) -> dict:
+        """Копия params с токеном: заданный явно остаётся, иначе выбирается по кабинету из url."""
+        params = dict(params or {})
+        if not params.get("access_token"):
+            params["access_token"] = self.token_for(account_key_from_url(url)).token
+        return params
+
+    async def get(self, url: str, params: dict = None) -> dict:
+        """GET-запрос к Graph API с токеном из пула (или с access_token из params)."""
+        params = self._with_token(url, params)
+        if self.batch_window > 0 and url.startswith(GRAPH_URL):
+            return await self._batched_get(url, params)
+        return await self._request("GET", url, params=params)
+
+    async def get_url(self, url: str) -> dict:
+        """GET по готовой ссылке из paging.next (токен в ней уже есть)."""
+        return await self._request("GET", url)
+
+    async def post(self, url: str, data: dict = None) -> dict:
+        """POST-запрос к Graph API с токеном из пула (или с access_token из data)."""
+        return await self._request("POST", url, data=self._with_token(url, data))
+
+    async def run_async_insights(self, account_id: str, params: dict, on_progress=None) -> "FbPaginator":
+        """
+        Запускает асинхронный отчёт Insights и возвращает итератор по его строкам.
+
+        POST /act_X/insights создаёт report run, статус опрашивается до
+        "Job Completed", процент выполнения передаётся в on_progress(percent).
+        Отчёт создаётся, опрашивается и читается одним и тем же токеном.
+        """
+        params = self._with_token(f"{GRAPH_URL}/act_{account_id}", params)
+        token = params["access_token"]
+        run = await self.post(f"{GRAPH_URL}/act_{account_id}/insights", params)
+        report_run_id = run["report_run_id"]
+        interval = ASYNC_POLL_INTERVAL
+        while True:
+            status = await self.get(f"{GRAPH_URL}/{report_run_id}",
+                                    {"fields": "async_status,async_percent_completion", "access_token": token})
+            state = status.get("async_status")
+            if on_progress is not None:
+                await on_progress(int(status.get("async_percent_completion", 0)))
+            if state == "Job Completed":
+                break
+            if state in ("Job Failed", "Job Skipped"):
+                raise FbApiError(500, f"Асинхронный отчёт {report_run_id}: {state}")
+            await asyncio.sleep(interval)
+            interval = min(ASYNC_POLL_MAX_INTERVAL, interval * 1.5)
+        return self.paginate(f"{GRAPH_URL}/{report_run_id}/insights", {"limit": params.get("limit", 1000), "access_token": token})
+
+    def paginate(self, url: str, params: dict = None, prefetch: bool = True) -> "FbPaginator":
+        return FbPaginator(self, url, params, prefetch)
+
+    async def get_all(self, url: str, params: dict = None) -> list:
+        """Возвращает все строки списочного запроса, проходя по всем страницам."""
+        return await self.paginate(url, params).collect()
+
+    # --- Пакетные запросы ---
+
+    @staticmethod
+    def batch_request(url: str, params: dict = None, method: str = "GET", name: str = None,
+                      depends_on: str = None) -> dict:
+        """
+        Описание подзапроса для batch().
+
+        В params можно ссылаться на результат другого подзапроса через JSONPath,
+        например {"ids": "{result=campaigns:$.data.*.id}"}.
+        """
+        relative_url = url[len(GRAPH_URL):].lstrip("/") if url.startswith(GRAPH_URL) else url.lstrip("/")
+        request = {"method": method}
+        if params and method == "GET":
+            relative_url += "?" + urlencode(params)
+        elif params:
+            request["body"] = urlencode(params)
+        request["relative_url"] = relative_url
+        if name:
+            request["name"] = name
+            # По умолчанию Graph API не возвращает тело именованных подзапросов
+            request["omit_response_on_success"] = False
+        if depends_on:
+            request["depends_on"] = depends_on
+        return request
+
+    @staticmethod
+    def _batch_groups(requests: list) -> list:
+        """Разбивает подзапросы на группы, связанные зависимостями (их нельзя разносить по разным batch)."""
+        parent = list(range(len(requests)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        names = {r["name"]: i for i, r in enumerate(requests) if r.get("name")}
+        for i, request in enumerate(requests):
+            refs = set(_BATCH_REF_RE.findall(request.get("relative_url", "") + request.get("body", "")))
+            if request.get("depends_on"):
+                refs.add(request["depends_on"])
+            for ref in refs:
+                if ref in names:
+                    parent[find(i)] = find(names[ref])
+
+        groups = {}
+        for i in range(len(requests)):
+            groups.setdefault(find(i), []).append(i)
+        return list(groups.values())
+
+    async def _post_batch(self, state: TokenState, requests: list) -> list:
+        """Отправляет до 50 подзапросов одним POST с токеном state и разбирает ответы."""
+        data = {
+            "access_token": state.token,
+            "batch": json.dumps(requests),
+            "include_headers": "true",
+        }
+        responses = await self._request("POST", GRAPH_URL + "/", data=data)
+        results = []
+        for request, response in zip(requests, responses):
+            if response is None:
+                # Подзапрос не выполнен (таймаут или упала зависимость) — пробуем ещё раз
+                results.append(FbApiError(0, "Подзапрос batch не выполнен", is_transient=True))
+                continue
+            headers = CIMultiDict((h["name"], h["value"]) for h in response.get("headers") or [])
+            self._update_usage(state, account_key_from_url(request["relative_url"]), headers)
+            try:
+                body = self.loads(response.get("body") or "null")
+            except ValueError:
+                body = None
+            if response.get("code", 500) < 400:
+                results.append(body)
+            else:
+                results.append(self._error_from_payload(response["code"], body, headers))
+        return results
+
+    async def batch(self, requests: list, return_exceptions: bool = False, token: str = None) -> list:
+        """
+        Выполняет подзапросы через batch API Graph (по 50 в одном HTTP-запросе).
+
+        Возвращает результаты в порядке подзапросов. Временные ошибки и ошибки
+        лимитов повторяются группами вместе с зависимостями. При
+        return_exceptions=True ошибки возвращаются на месте результата, иначе
+        поднимается первая из них. Все подзапросы идут с одним токеном: token
+        или выбранным по кабинету первого подзапроса.
+        """
+        if token is not None:
+            state = self._state_for_request("", {"access_token": token})
+        else:
+            state = self.token_for(account_key_from_url(requests[0]["relative_url"]) if requests else "app")
+        results = [None] * len(requests)
+        todo = self._batch_groups(requests)
+        for group in todo:
+            if len(group) > BATCH_LIMIT:
+                raise ValueError(f"Связанных подзапросов больше {BATCH_LIMIT}, их нельзя отправить одним batch")
+
+        for attempt in range(self.max_retries + 1):
+            # Жадно укладываем группы в batch-запросы по BATCH_LIMIT подзапросов
+            chunks, current = [], []
+            for group in todo:
+                if len(current) + len(group) > BATCH_LIMIT:
+                    chunks.append(current)
+                    current = []
+                current.extend(group)
+            if current:
+                chunks.append(current)
+
+            responses = await asyncio.gather(*(self._post_batch(state, [requests[i] for i in chunk]) for chunk in chunks))
+            for chunk, chunk_results in zip(chunks, responses):
+                for i, result in zip(chunk, chunk_results):
+                    results[i] = result
+
+            retry_groups = [
+                group for group in todo
+                if any(isinstance(results[i], FbApiError) and results[i].is_retryable for i in group)
+            ]
+            if not retry_groups or attempt >= self.max_retries:
+                break
+            errors = [results[i] for group in retry_groups for i in group if isinstance(results[i], FbApiError)]
+            delay = max(self._backoff(attempt, error) for error in errors)
+            metrics.inc("fb_retries_total", len(errors), endpoint="batch", reason="subrequest")
+            print(f"Batch: {len(errors)} подзапросов с ошибкой, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            todo = retry_groups
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, FbApiError):
+                    raise result
+        return results
+
+    async def _batched_get(self, url: str, params: dict) -> dict:
+        """Ставит GET в очередь; очередь уходит batch-запросами (по одному на токен) по таймеру или при заполнении."""
+        state = self._state_for_request(url, params)
+        # Токен передаётся в самом batch-запросе, а не в каждом подзапросе
+        params = {k: v for k, v in params.items() if k != "access_token"}
+        await self._throttle(state, account_key_from_url(url))
+        future = asyncio.get_running_loop().create_future()
+        self._batch_queue.append((state, self.batch_request(url, params), future))
+        if len(self._batch_queue) >= BATCH_LIMIT:
+            self._flush_batch()
+        elif self._batch_flush is None:
+            self._batch_flush = asyncio.get_running_loop().call_later(self.batch_window, self._flush_batch)
+        return await future
+
+    def _flush_batch(self) -> None:
+        if self._batch_flush is not None:
+            self._batch_flush.cancel()
+            self._batch_flush = None
+        queue, self._batch_queue = self._batch_queue, []
+        by_token = {}
+        for state, request, future in queue:
+            by_token.setdefault(state, []).append((request, future))
+        for state, items in by_token.items():
+            asyncio.ensure_future(self._run_batch(state, items))
+
+    async def _run_batch(self, state: TokenState, queue: list) -> None:
+        try:
+            results = await self.batch([request for request, _ in queue], return_exceptions=True, token=state.token)
+        except Exception as e:
+            results = [e] * len(queue)
+        for (_, future), result in zip(queue, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+# --- Пагинация ---
+
+class FbPaginator:
+    """
+    Асинхронный итератор по всем строкам списочного запроса Graph API.
+
+    Следует за paging.cursors.after (или paging.next, если курсоров нет)
+    и заранее запрашивает следующую страницу, пока потребитель обрабатывает
+    текущую. Все страницы запрашиваются одним токеном. После обхода в
+    pages/rows лежит число страниц и строк.
+    """
+
+    def __init__(self, client: FbApiClient, url: str, params: dict = None, prefetch: bool = True):
+        self.client = client
+        self.url = url
+        self.params = client._with_token(url, params)
+        self.prefetch = prefetch
+        self.pages = 0
+        self.rows = 0
+
+    def _next_request(self, page: dict):
+        """Возвращает корутину запроса следующей страницы или None."""
+        paging = page.get("paging", {})
+        if not paging.get("next"):
+            return None
+        after = paging.get("cursors", {}).get("after")
+        if after:
+            return self.client.get(self.url, {**self.params, "after": after})
+        return self.client.get_url(paging["next"])
+
+    async def __aiter__(self):
+        pending = asyncio.ensure_future(self.client.get(self.url, self.params))
+        next_request = None
+        try:
+            while pending is not None:
+                page = await pending
+                pending = None
+                self.pages += 1
+                metrics.observe("fb_page_rows", len(page.get("data", [])), ROWS_BUCKETS,
+                                endpoint=endpoint_from_url(self.url))
+
+                next_request = self._next_request(page)
+                if next_request is not None and self.prefetch:
+                    pending, next_request = asyncio.ensure_future(next_request), None
+
+                for row in page.get("data", []):
+                    self.rows += 1
+                    yield row
+
+                if next_request is not None:
+                    pending, next_request = asyncio.ensure_future(next_request), None
+        finally:
+            if pending is not None:
+                pending.cancel()
+            if next_request is not None:
+                next_request.close()
+
+    async def collect(self) -> list:
+        """Собирает все строки в список."""
+        return [row async for row in self]
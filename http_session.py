@@ -0,0 +1,118 @@
+import os
+import time
+import aiohttp
+from aiohttp.compression_utils import HAS_BROTLI
+from dotenv import load_dotenv
+from fb_api import FbApiClient
+from metrics import metrics
+
+# --- Конфигурация ---
+load_dotenv()
+# Всего соединений в пуле и соединений к одному хосту (graph.facebook.com)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "32"))
+# Сколько секунд держать простаивающее соединение открытым
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+# Сколько секунд кэшировать DNS-ответы
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+# Таймауты одного запроса: установка соединения, ожидание данных, общий на попытку
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "15"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_REQUEST_TIMEOUT = float(os.getenv("HTTP_REQUEST_TIMEOUT", "120"))
+
+# brotli декодируется, только если установлен пакет brotli/brotlicffi
+ACCEPT_ENCODING = "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate"
+
+_session = None
+_client = None
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    """Метрики пула: ожидание свободного соединения, новые и переиспользованные соединения."""
+    trace = aiohttp.TraceConfig()
+
+    async def on_queued_start(session, ctx, params):
+        ctx.queued_at = time.monotonic()
+
+    async def on_queued_end(session, ctx, params):
+        metrics.observe("http_pool_wait_seconds", time.monotonic() - ctx.queued_at)
+
+    async def on_create_end(session, ctx, params):
+        metrics.inc("http_connections_created_total")
+
+    async def on_reuse(session, ctx, params):
+        metrics.inc("http_connections_reused_total")
+
+    trace.on_connection_queued_start.append(on_queued_start)
+    trace.on_connection_queued_end.append(on_queued_end)
+    trace.on_connection_create_end.append(on_create_end)
+    trace.on_connection_reuseconn.append(on_reuse)
+    return trace
+
+def open_graph_session() -> aiohttp.ClientSession:
+    """
+    Создаёт общую HTTP-сессию приложения для запросов к Graph API.
+
+    Соединения (и TLS-сессии) переиспользуются между отчётами; таймауты
+    действуют на каждый запрос, а не на весь отчёт.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_REQUEST_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+            trace_configs=[_trace_config()],
+        )
+    return _session
+
+def graph_session() -> aiohttp.ClientSession:
+    """Общая сессия; если её ещё не открыли (скрипты, бенчмарк), открывается при первом обращении."""
+    return open_graph_session()
+
+def graph_client() -> FbApiClient:
+    """
+    Общий клиент Graph API приложения поверх общей сессии.
+
+    Квоты, блокировки кабинетов, разрежение запросов и загрузка пула токенов
+    живут в клиенте, поэтому все отчёты (в том числе одновременные) работают
+    с одним клиентом и видят состояние друг друга.
+    """
+    global _client
+    if _client is None:
+        _client = FbApiClient(graph_session())
+    else:
+        # Сессию могли закрыть и открыть заново — состояние квот при этом сохраняется
+        _client.session = graph_session()
+    return _client
+
+async def close_graph_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def export_pool_metrics() -> None:
+    """Обновляет значения загрузки пула соединений для /metrics и /stats."""
+    if _session is None or _session.closed:
+        return
+    connector = _session.connector
+    # У TCPConnector нет публичного API для занятых соединений — читаем внутренние счётчики
+    in_use = len(getattr(connector, "_acquired", ()))
+    idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+    metrics.set("http_pool_in_use", in_use)
+    metrics.set("http_pool_idle", idle)
+    metrics.set("http_pool_limit", connector.limit)
+    metrics.set("http_pool_limit_per_host", connector.limit_per_host)
+
+
+metrics.add_collector(export_pool_metrics)
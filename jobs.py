@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+from storage import connect
+
+# --- Конфигурация ---
+# Сколько отчётов строится одновременно, остальные ждут в очереди
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+# Сколько незавершённых отчётов может быть у одного пользователя
+JOBS_PER_USER = int(os.getenv("JOBS_PER_USER", "2"))
+# Сколько секунд хранить записи о завершённых задачах
+FINISHED_JOBS_TTL = 24 * 3600
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobLimitError(Exception):
+    """У пользователя уже максимум незавершённых задач."""
+
+
+class Job:
+    """Задача построения отчёта: параметры для запуска и текущее состояние."""
+
+    def __init__(self, job_id: str, user_id: int, chat_id: int, kind: str, params: dict,
+                 meta: dict = None, status: str = "queued", created_at: float = None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.kind = kind
+        self.params = params
+        # Данные для запуска, не влияющие на то, какой отчёт строится (например, ID сообщения с меню)
+        self.meta = meta or {}
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.progress = ""
+
+
+class JobQueue:
+    """
+    Очередь фоновых отчётов с ограниченным пулом воркеров.
+
+    Задачи и их промежуточные результаты (готовые кабинеты) хранятся в
+    локальной базе: после перезапуска незавершённые задачи снова ставятся в
+    очередь и продолжаются с уже собранных кабинетов. Одинаковые задачи
+    одного пользователя не дублируются, число незавершённых задач на
+    пользователя ограничено.
+    """
+
+    def __init__(self, path: str = None, workers: int = REPORT_WORKERS, per_user_limit: int = JOBS_PER_USER):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.conn = connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS report_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " user_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " meta TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS report_job_checkpoints ("
+            " job_id TEXT NOT NULL,"
+            " item_key TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, item_key));"
+            "CREATE TABLE IF NOT EXISTS report_job_delivered ("
+            " job_id TEXT NOT NULL,"
+            " item_key TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, item_key));"
+        )
+        self._runners = {}
+        self._jobs = {}
+        self._tasks = {}
+        self._queue = None
+        self._workers = []
+        # Выставляется в stop(): отмена воркеров — это остановка бота, а не ошибка задачи
+        self._stopping = False
+
+    def register(self, kind: str, runner) -> None:
+        """runner(job) — корутина, выполняющая задачу данного вида."""
+        self._runners[kind] = runner
+
+    def _save(self, job: Job) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO report_jobs"
+            " (job_id, user_id, chat_id, kind, params, meta, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.job_id, job.user_id, job.chat_id, job.kind, json.dumps(job.params, sort_keys=True),
+             json.dumps(job.meta), job.status, job.created_at, time.time()),
+        )
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.status = status
+        self._save(job)
+        self._jobs.pop(job.job_id, None)
+        self.conn.execute("DELETE FROM report_job_checkpoints WHERE job_id = ?", (job.job_id,))
+        self.conn.execute("DELETE FROM report_job_delivered WHERE job_id = ?", (job.job_id,))
+
+    async def start(self) -> None:
+        """Запускает воркеры и возвращает в очередь задачи, не завершённые до перезапуска."""
+        self._queue = asyncio.Queue()
+        self.conn.execute(
+            "DELETE FROM report_jobs WHERE status NOT IN (?, ?) AND updated_at < ?",
+            (*ACTIVE_STATUSES, time.time() - FINISHED_JOBS_TTL),
+        )
+        rows = self.conn.execute(
+            "SELECT job_id, user_id, chat_id, kind, params, meta, created_at FROM report_jobs"
+            " WHERE status IN (?, ?) ORDER BY created_at",
+            ACTIVE_STATUSES,
+        ).fetchall()
+        for job_id, user_id, chat_id, kind, params, meta, created_at in rows:
+            job = Job(job_id, user_id, chat_id, kind, json.loads(params), json.loads(meta), "queued", created_at)
+            job.progress = "возобновлена после перезапуска"
+            self._jobs[job_id] = job
+            self._queue.put_nowait(job)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id: int, chat_id: int, kind: str, params: dict, meta: dict = None) -> tuple:
+        """
+        Ставит задачу в очередь. Возвращает (задача, True) или (уже идущая такая же задача, False).
+
+        Бросает JobLimitError, если у пользователя уже per_user_limit незавершённых задач.
+        """
+        user_jobs = self.active(user_id)
+        for job in user_jobs:
+            if job.kind == kind and job.params == params:
+                return job, False
+        if len(user_jobs) >= self.per_user_limit:
+            raise JobLimitError(f"не больше {self.per_user_limit} отчётов одновременно")
+
+        job = Job(uuid.uuid4().hex[:8], user_id, chat_id, kind, params, meta)
+        self._jobs[job.job_id] = job
+        self._save(job)
+        self._queue.put_nowait(job)
+        return job, True
+
+    def cancel(self, job_id: str, user_id: int = None) -> bool:
+        """Отменяет задачу (с проверкой владельца, если передан user_id); идущие HTTP-запросы прерываются."""
+        job = self._jobs.get(job_id)
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return False
+        task = self._tasks.get(job_id)
+        self._finish(job, "cancelled")
+        if task is not None:
+            task.cancel()
+        return True
+
+    def active(self, user_id: int = None) -> list:
+        """Незавершённые задачи (все или одного пользователя) в порядке постановки."""
+        return [job for job in self._jobs.values() if user_id is None or job.user_id == user_id]
+
+    def position(self, job: Job) -> int:
+        """Сколько задач стоит в очереди перед данной."""
+        return sum(1 for other in self._jobs.values() if other.status == "queued" and other.created_at < job.created_at)
+
+    def checkpoint(self, job: Job, key: str, data) -> None:
+        """Сохраняет промежуточный результат задачи (например, готовый кабинет)."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO report_job_checkpoints (job_id, item_key, payload) VALUES (?, ?, ?)",
+            (job.job_id, key, json.dumps(data, ensure_ascii=False)),
+        )
+
+    def checkpoints(self, job: Job) -> dict:
+        rows = self.conn.execute("SELECT item_key, payload FROM report_job_checkpoints WHERE job_id = ?", (job.job_id,))
+        return {key: json.loads(payload) for key, payload in rows}
+
+    def mark_delivered(self, job: Job, key: str) -> None:
+        """Отмечает часть результата (например, блок кабинета) отправленной в чат."""
+        self.conn.execute("INSERT OR IGNORE INTO report_job_delivered (job_id, item_key) VALUES (?, ?)", (job.job_id, key))
+
+    def delivered(self, job: Job) -> set:
+        """Части результата, уже отправленные до перезапуска: повторно их слать не нужно."""
+        rows = self.conn.execute("SELECT item_key FROM report_job_delivered WHERE job_id = ?", (job.job_id,))
+        return {row[0] for row in rows}
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.status != "queued":
+                continue
+            job.status = "running"
+            self._save(job)
+            try:
+                # Вид задачи из базы может быть неизвестен (например, после обновления бота) — это ошибка задачи, не воркера
+                task = asyncio.create_task(self._runners[job.kind](job))
+                self._tasks[job.job_id] = task
+                await task
+                self._finish(job, "done")
+            except asyncio.CancelledError:
+                if job.status == "cancelled":
+                    continue
+                if self._stopping:
+                    # Остановка бота: задача останется running и продолжится после перезапуска
+                    raise
+                # Отмену изнутри задачи (например, общего вычисления, которое бросили другие) воркер переживает
+                print(f"Фоновая задача {job.job_id} ({job.kind}) прервана отменой изнутри")
+                self._finish(job, "failed")
+            except Exception as e:
+                print(f"Ошибка фоновой задачи {job.job_id} ({job.kind}): {type(e).__name__}: {e}")
+                self._finish(job, "failed")
+            finally:
+                self._tasks.pop(job.job_id, None)
+
+    async def stop(self, timeout: float) -> None:
+        """Ждёт идущие задачи не дольше timeout и останавливает воркеры; недоделанное продолжится после перезапуска."""
+        running = set(self._tasks.values())
+        if running:
+            print(f"Дожидаюсь {len(running)} идущих отчётов...")
+            await asyncio.wait(running, timeout=timeout)
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+report_jobs = JobQueue()
@@ -1,97 +1,285 @@
 import os
+import time
+import sys
+import signal
 import asyncio
-import aiohttp
 import json
+from html import escape
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (Message, CallbackQuery, BotCommand, BotCommandScopeDefault,
                            ReplyKeyboardMarkup, KeyboardButton)
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
-from daily_report import generate_daily_report_text # <--- ДОБАВЬТЕ ЭТУ СТРОКУ
+from fb_api import (GRAPH_URL, AdStats, FbApiClient, FbApiError, FbPaginator,
+                    should_use_async_insights)
+from structure import load_account_structure, structure_cache, structure_mirror
+from warehouse import INSIGHTS_WAREHOUSE, get_range_insights
+from analytics import ANALYTICS_DAYS, build_recommendations_text, history_is_fresh, refresh_history, warm_up_history
+from singleflight import report_flights
+from message_store import SentMessageStore
+from jobs import Job, JobLimitError, report_jobs
+from metrics import METRICS_HOST, METRICS_PORT, add_metrics_route, metrics
+from http_session import close_graph_session, graph_client, open_graph_session
+from outbound import OutboundDispatcher, split_html_message
+from scheduler import (build_and_store_daily_report, daily_store, parse_time, report_date_for,
+                       run_daily_scheduler, schedule_changed)
 
 # --- Конфигурация и константы ---
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-META_TOKEN = os.getenv("META_ACCESS_TOKEN")
-API_VERSION = "v19.0"
-LEAD_ACTION_TYPE = "onsite_conversion.messaging_conversation_started_7d"
-LINK_CLICK_ACTION_TYPE = "link_click"
+# Сколько кабинетов обрабатывается одновременно при построении отчёта
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "8"))
+# Как запрашивать статистику объявлений: "account" — одним запросом по всем
+# активным объявлениям кабинета, "chunked" — фильтром по ID частями
+INSIGHTS_FILTER_MODE = os.getenv("INSIGHTS_FILTER_MODE", "account")
+INSIGHTS_ID_CHUNK = 200
+INSIGHTS_CHUNK_CONCURRENCY = 4
+# Отправлять блоки кабинетов по мере готовности (в порядке кабинетов), не дожидаясь конца отчёта
+REPORT_STREAMING = os.getenv("REPORT_STREAMING", "1") == "1"
+# Режим получения обновлений: "polling" или "webhook". В обоих режимах бот рассчитан на одну
+# реплику: задания, подписки, ID сообщений и планировщик хранятся в локальной SQLite
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес вебхука без пути, например https://bot.example.com (обязателен для webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (обязателен для webhook)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько секунд при остановке ждать завершения уже запущенных отчётов
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "120"))
+# Telegram ID администраторов через запятую (для /stats); пусто — команда недоступна никому
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 
 # --- Инициализация ---
 bot = Bot(token=TELEGRAM_TOKEN, parse_mode="HTML")
 dp = Dispatcher()
+# Все исходящие отчёты и статусы идут через очередь с лимитами Telegram
+outbound = OutboundDispatcher(bot)
 router = Router()
 
-# Словарь для хранения ID сообщений для последующей очистки
-sent_messages_by_chat = {}
+# ID отправленных сообщений для последующей очистки (в локальной базе)
+sent_messages = SentMessageStore()
+# Все, кто ждёт одного и того же отчёта: ключ отчёта -> слушатели
+report_listeners = {}
+# Отчёты, выполняющиеся в фоне, вне обработки обновлений
+background_reports = set()
 
 # ============================
 # ===         API          ===
 # ============================
 
-async def fb_get(session: aiohttp.ClientSession, url: str, params: dict = None):
-    """Асинхронная функция для выполнения GET-запросов к Graph API."""
-    params = params or {}
-    params["access_token"] = META_TOKEN
-    async with session.get(url, params=params) as response:
-        response.raise_for_status()
-        return await response.json()
-
-async def get_ad_accounts(session: aiohttp.ClientSession):
-    """Получает список рекламных аккаунтов."""
-    url = f"https://graph.facebook.com/{API_VERSION}/me/adaccounts"
-    params = {"fields": "name,account_id"}
-    data = await fb_get(session, url, params)
-    return data.get("data", [])
-
-async def get_campaigns(session: aiohttp.ClientSession, account_id: str):
-    """Получает список кампаний для аккаунта."""
-    url = f"https://graph.facebook.com/{API_VERSION}/act_{account_id}/campaigns"
-    params = {"fields": "id,name,status,objective", "limit": 500}
-    data = await fb_get(session, url, params)
-    return data.get("data", [])
-
-async def get_all_adsets(session: aiohttp.ClientSession, account_id: str):
-    """Получает все группы объявлений для аккаунта."""
-    url = f"https://graph.facebook.com/{API_VERSION}/act_{account_id}/adsets"
-    params = {"fields": "id,name,campaign_id,status", "limit": 500}
-    data = await fb_get(session, url, params)
-    return data.get("data", [])
-
-async def get_all_ads_with_creatives(session: aiohttp.ClientSession, account_id: str, active_adset_ids: list):
-    """Получает все активные объявления для указанных групп с их креативами."""
-    url = f"https://graph.facebook.com/{API_VERSION}/act_{account_id}/ads"
-    filtering = [
-        {'field': 'adset.id', 'operator': 'IN', 'value': active_adset_ids},
-        {'field': 'effective_status', 'operator': 'IN', 'value': ['ACTIVE']}
-    ]
-    params = {
-        "fields": "id,name,adset_id,campaign_id,creative{thumbnail_url}",
-        "filtering": json.dumps(filtering),
-        "limit": 1000
-    }
-    data = await fb_get(session, url, params)
-    return data.get("data", [])
+async def get_ad_accounts(client: FbApiClient):
+    """Получает список рекламных аккаунтов всех токенов пула."""
+    return await client.get_ad_accounts("name,account_id")
+
+async def get_ad_level_insights(client: FbApiClient, account_id: str, filtering: list, ad_count: int, date_preset: str, time_range: dict = None, on_progress=None) -> FbPaginator:
+    """
+    Возвращает постраничный итератор статистики объявлений кабинета за выбранный период.
 
-async def get_ad_level_insights(session: aiohttp.ClientSession, account_id: str, ad_ids: list, date_preset: str, time_range: dict = None):
-    """Получает статистику для конкретных объявлений за выбранный период."""
-    url = f"https://graph.facebook.com/{API_VERSION}/act_{account_id}/insights"
+    Для больших кабинетов и длинных периодов статистика считается асинхронным отчётом.
+    """
+    url = f"{GRAPH_URL}/act_{account_id}/insights"
     params = {
         "fields": "ad_id,spend,actions,ctr",
         "level": "ad",
-        "filtering": f'[{{"field":"ad.id","operator":"IN","value":{ad_ids}}}]',
+        "filtering": json.dumps(filtering),
         "limit": 1000
     }
     if time_range:
         params["time_range"] = json.dumps(time_range)
     else:
         params["date_preset"] = date_preset
+
+    if should_use_async_insights(ad_count, time_range):
+        return await client.run_async_insights(account_id, params, on_progress)
+    return client.paginate(url, params)
+
+def insights_filters(ad_ids: list) -> list:
+    """
+    Список фильтров, по одному на запрос статистики.
+
+    В режиме "account" статистика берётся одним запросом по всем активным
+    объявлениям кабинета и затем сопоставляется с нужными локально; в режиме
+    "chunked" ID объявлений разбиваются на запросы по INSIGHTS_ID_CHUNK штук.
+    """
+    if INSIGHTS_FILTER_MODE == "chunked":
+        return [
+            [{"field": "ad.id", "operator": "IN", "value": ad_ids[i:i + INSIGHTS_ID_CHUNK]}]
+            for i in range(0, len(ad_ids), INSIGHTS_ID_CHUNK)
+        ]
+    return [[{"field": "ad.effective_status", "operator": "IN", "value": ["ACTIVE"]}]]
+
+async def get_live_insights_map(client: FbApiClient, account_id: str, ad_ids: list, date_preset: str, time_range: dict = None, on_progress=None) -> dict:
+    """Запрашивает статистику объявлений у Graph API и сводит её в {ad_id: AdStats}."""
+    wanted = set(ad_ids)
+    insights_map = {}
+    semaphore = asyncio.Semaphore(INSIGHTS_CHUNK_CONCURRENCY)
+
+    async def consume(filtering: list):
+        # Асинхронный отчёт решается по объявлениям в самом запросе, а не во всём кабинете
+        ad_count = len(filtering[0]["value"]) if INSIGHTS_FILTER_MODE == "chunked" else len(ad_ids)
+        async with semaphore:
+            # Строки агрегируются по мере прихода страниц, следующая уже качается
+            async for row in await get_ad_level_insights(client, account_id, filtering, ad_count, date_preset, time_range, on_progress):
+                ad_id = row['ad_id']
+                if ad_id not in wanted:
+                    continue
+                insights_map[ad_id] = AdStats.from_row(row)
+
+    await asyncio.gather(*(consume(filtering) for filtering in insights_filters(ad_ids)))
+    return insights_map
+
+async def collect_account_data(client: FbApiClient, acc: dict, date_preset: str, time_range: dict = None, on_progress=None) -> dict:
+    """
+    Собирает структуру и статистику одного кабинета в формате account_data.
+
+    on_progress(percent) вызывается при опросе асинхронного отчёта Insights.
+    """
+    account_id = acc["account_id"]
+    with metrics.timer("report_phase_seconds", phase="structure"):
+        structure = await load_account_structure(client, account_id)
+    campaigns_map = structure["campaigns"]
+    adsets_map = structure["adsets"]
+    ads = structure["ads"]
+    if not ads: return {}
+
+    ad_ids = [ad['id'] for ad in ads]
+    with metrics.timer("report_phase_seconds", phase="insights"):
+        if time_range and INSIGHTS_WAREHOUSE:
+            # Диапазоны дат считаются из локального хранилища дневной статистики
+            insights_map = await get_range_insights(client, account_id, time_range, ad_ids, on_progress)
+        else:
+            insights_map = await get_live_insights_map(client, account_id, ad_ids, date_preset, time_range, on_progress)
+
+    aggregation_started = time.monotonic()
+    account_data = {}
+    for ad in ads:
+        ad_id = ad['id']
+        adset_id = ad['adset_id']
+        campaign_id = ad.get('campaign_id')
+
+        if adset_id not in adsets_map or campaign_id not in campaigns_map:
+            continue
+
+        stats = insights_map.get(ad_id)
+        if not stats or stats.spend == 0:
+            continue
+        
+        campaign_obj = campaigns_map[campaign_id]
+        objective = campaign_obj.get("objective", "N/A")
+
+        if campaign_id not in account_data:
+            objective_clean = objective.replace('OUTCOME_', '').replace('_', ' ').capitalize()
+            account_data[campaign_id] = {
+                "name": campaign_obj['name'],
+                "objective": objective_clean,
+                "adsets": {}
+            }
         
-    data = await fb_get(session, url, params)
-    return data.get("data", [])
+        if adset_id not in account_data[campaign_id]['adsets']:
+            adset_obj = adsets_map[adset_id]
+            account_data[campaign_id]['adsets'][adset_id] = {
+                "name": adset_obj['name'],
+                "ads": []
+            }
+        
+        ad_info = {
+            "name": ad['name'],
+            "thumbnail_url": ad.get('creative', {}).get('thumbnail_url'),
+            "spend": stats.spend,
+            "ctr": stats.ctr,
+            "objective": objective
+        }
+
+        if "TRAFFIC" in ad_info["objective"]:
+            ad_info["clicks"] = stats.clicks
+            ad_info["cpc"] = (stats.spend / stats.clicks) if stats.clicks > 0 else 0
+        else:
+            ad_info["leads"] = stats.leads
+            ad_info["cpl"] = (stats.spend / stats.leads) if stats.leads > 0 else 0
+
+        account_data[campaign_id]['adsets'][adset_id]['ads'].append(ad_info)
+
+    metrics.observe("report_phase_seconds", time.monotonic() - aggregation_started, phase="aggregation")
+    return account_data
+
+
+async def collect_all_accounts_data(client: FbApiClient, accounts: list, date_preset: str, time_range: dict, progress,
+                                    on_account_ready=None, prefetched: dict = None, on_account_done=None) -> tuple:
+    """
+    Собирает account_data по всем кабинетам пулом из REPORT_CONCURRENCY воркеров.
+
+    progress(text) получает сводный текст прогресса, on_account_ready(acc, account_data)
+    вызывается сразу, как только кабинет готов (account_data пуст, если затрат нет
+    или кабинет не уложился в таймаут). Кабинеты из
+    prefetched ({account_id: account_data}) повторно не запрашиваются;
+    on_account_done(acc, account_data) вызывается для каждого заново собранного кабинета. Возвращает
+    ({account_id: account_data} в порядке accounts, имена кабинетов с таймаутом).
+    Кабинеты различаются по account_id: в разных Business Manager имена могут совпадать.
+    """
+    total = len(accounts)
+    done = 0
+    timed_out = []
+    names = {acc['account_id']: acc['name'] for acc in accounts}
+    # Прогресс асинхронных отчётов Insights: account_id -> процент
+    async_jobs = {}
+    semaphore = asyncio.Semaphore(REPORT_CONCURRENCY)
+
+    def progress_text() -> str:
+        lines = [f"📦 {done}/{total} кабинетов готово"]
+        for account_id, percent in async_jobs.items():
+            lines.append(f"⏳ {names[account_id]}: отчёт Meta {percent}%")
+        return "\n".join(lines)
+
+    await progress(progress_text())
+
+    async def worker(acc: dict):
+        nonlocal done
+
+        async def on_progress(percent: int):
+            if async_jobs.get(acc['account_id']) != percent:
+                async_jobs[acc['account_id']] = percent
+                await progress(progress_text())
+
+        if prefetched and acc['account_id'] in prefetched:
+            account_data = prefetched[acc['account_id']]
+        else:
+            async with semaphore:
+                try:
+                    with metrics.timer("report_account_seconds", account=acc['name']):
+                        account_data = await collect_account_data(client, acc, date_preset, time_range, on_progress)
+                except asyncio.TimeoutError:
+                    timed_out.append(acc['name'])
+                    account_data = None
+            if account_data is not None and on_account_done is not None:
+                await on_account_done(acc, account_data)
+        async_jobs.pop(acc['account_id'], None)
+        if on_account_ready is not None:
+            await on_account_ready(acc, account_data)
+        done += 1
+        await progress(progress_text())
+        return account_data
+
+    tasks = [asyncio.create_task(worker(acc)) for acc in accounts]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # gather сохраняет порядок аккаунтов, поэтому отчёт детерминирован
+    all_accounts_data = {}
+    for acc, account_data in zip(accounts, results):
+        if account_data:
+            all_accounts_data[acc['account_id']] = account_data
+    return all_accounts_data, timed_out
 
 
 # ============================
@@ -109,17 +297,51 @@ def cpl_label(value: float, metric: str) -> str:
     if value <= 3: return "🟡 Средний"
     return "🔴 Дорогой"
 
-async def send_and_store(message: Message | CallbackQuery, text: str, *, is_persistent: bool = False, **kwargs):
-    """Отправляет сообщение и сохраняет его ID для последующей очистки."""
-    msg_obj = message.message if isinstance(message, CallbackQuery) else message
+async def send_and_store(message: Message | CallbackQuery | int, text: str, *, is_persistent: bool = False, **kwargs):
+    """Отправляет сообщение (в чат сообщения, колбэка или по ID чата) и сохраняет его ID для последующей очистки."""
+    if isinstance(message, CallbackQuery):
+        chat_id = message.message.chat.id
+    elif isinstance(message, Message):
+        chat_id = message.chat.id
+    else:
+        chat_id = message
     kwargs.setdefault('disable_web_page_preview', True)
-    msg = await msg_obj.answer(text, **kwargs)
-    chat_id = msg.chat.id
-    if chat_id not in sent_messages_by_chat:
-        sent_messages_by_chat[chat_id] = []
-    sent_messages_by_chat[chat_id].append({"id": msg.message_id, "persistent": is_persistent})
+    msg = await outbound.send(chat_id, text, **kwargs)
+    sent_messages.add(msg.chat.id, msg.message_id, is_persistent)
     return msg
 
+async def safe_edit_text(msg: Message, text: str, **kwargs):
+    """
+    Ставит правку сообщения в очередь исходящих и не ждёт её отправки.
+
+    Частые правки одного сообщения склеиваются, ошибки вроде "message is not modified" игнорируются.
+    """
+    return outbound.edit(msg, text, **kwargs)
+
+def run_in_background(coro) -> asyncio.Task:
+    """
+    Запускает долгий отчёт отдельной задачей, чтобы хендлер сразу вернулся.
+
+    Обработка остальных обновлений не ждёт медленных отчётов; при остановке
+    бота такие задачи дожидаются в drain_background_reports.
+    """
+    task = asyncio.create_task(coro)
+    background_reports.add(task)
+    task.add_done_callback(background_reports.discard)
+    return task
+
+async def drain_background_reports(timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+    """Ждёт завершения фоновых отчётов не дольше timeout, остальные отменяет."""
+    if not background_reports:
+        return
+    print(f"Дожидаюсь {len(background_reports)} незавершённых отчётов...")
+    _, pending = await asyncio.wait(set(background_reports), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        print(f"Отменено {len(pending)} отчётов, не успевших завершиться.")
+
 # ============================
 # ===         Меню         ===
 # ============================
@@ -130,6 +352,11 @@ async def set_bot_commands(bot: Bot):
         BotCommand(command="start", description="🚀 Показать главное меню"),
         BotCommand(command="report", description="📊 Создать новый отчёт"),
         BotCommand(command="clear", description="🧹 Очистить временные сообщения"),
+        BotCommand(command="refresh", description="🔄 Сбросить кэш структуры кабинетов"),
+        BotCommand(command="jobs", description="🗂 Строящиеся отчёты"),
+        BotCommand(command="subscribe", description="🔔 Получать дневной отчёт каждый день"),
+        BotCommand(command="unsubscribe", description="🔕 Отписаться от дневного отчёта"),
+        BotCommand(command="schedule", description="🕘 Время расчёта дневного отчёта"),
     ]
     await bot.set_my_commands(commands, BotCommandScopeDefault())
 
@@ -188,38 +415,104 @@ async def help_handler(message: Message):
         "<b>ℹ️ Справка по боту:</b>\n\n"
         "● <b>📊 Активные кампании</b> - формирует детальный отчёт по всем активным кампаниям за выбранный период.\n\n"
         "● <b>/clear</b> - команда для удаления всех временных сообщений (отчётов, статусов загрузки).\n\n"
-        "● <b>📈 Дневной отчёт</b> и <b>💡 Рекомендации (AI)</b> - функции в разработке."
+        "● <b>/jobs</b> - строящиеся отчёты: очередь, прогресс и отмена. Отчёт можно отменить и кнопкой «❌ Отменить» под статусом.\n\n"
+        "● <b>/stats</b> - время запросов к Meta, медленные кабинеты, повторы и квота (для администраторов).\n\n"
+        "● <b>/refresh</b> - сбросить кэш кампаний и объявлений, если в кабинетах что-то поменялось.\n\n"
+        "● <b>📈 Дневной отчёт</b> - сводка за вчера по сравнению с позавчера. Считается заранее по расписанию, кнопка «🔄 Пересчитать» обновляет её.\n\n"
+        "● <b>/subscribe</b>, <b>/unsubscribe</b>, <b>/schedule ЧЧ:ММ</b> - ежедневная рассылка дневного отчёта и её время.\n\n"
+        "● <b>💡 Рекомендации (AI)</b> - что стоит сделать в первую очередь: объявления с выросшей стоимостью лида/клика, "
+        f"аномальные расходы, выгорающие креативы, кандидаты на масштабирование. Считается по дневной статистике за {ANALYTICS_DAYS} дней."
     )
     await message.answer(help_text)
 
 
 
-@router.message(F.text == "📈 Дневной отчёт")
-async def daily_report_handler(message: Message):
-    # Уровень 1 (4 пробела)
-    status_msg = await message.answer("⏳ Собираю дневную сводку, это может занять до минуты...")
+def daily_refresh_menu():
+    """Инлайн-кнопка для пересчёта дневного отчёта."""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Пересчитать", callback_data="daily_report:refresh")
+    return kb.as_markup()
+
+async def send_daily_report(chat_id: int, report_text: str):
+    """Отправляет дневной отчёт в чат, разбивая его по разделам без разрыва HTML-тегов."""
+    await outbound.send_long(chat_id, report_text, reply_markup=daily_refresh_menu())
+
+async def compute_and_send_daily_report(message: Message):
+    """Пересчитывает дневной отчёт, сохраняет его и отправляет в чат."""
+    status_msg = await send_and_store(message, "⏳ Собираю дневную сводку, это может занять до минуты...")
     try:
-        # Уровень 2 (8 пробелов)
-        report_text = await generate_daily_report_text()
-        
-        # Эта строка должна иметь тот же отступ, что и строка выше
-        await bot.delete_message(message.chat.id, status_msg.message_id)
-        
-        # Отправляем готовый отчет
-        if len(report_text) > 4096:
-            # Уровень 3 (12 пробелов)
-            for x in range(0, len(report_text), 4096):
-                # Уровень 4 (16 пробелов)
-                await message.answer(report_text[x:x+4096])
-        else:
-            # Уровень 3 (12 пробелов)
-            await message.answer(report_text)
-            
+        report_text = await build_and_store_daily_report()
+        await outbound.delete(message.chat.id, status_msg.message_id)
+        await send_daily_report(message.chat.id, report_text)
     except Exception as e:
-        # Уровень 2 (8 пробелов)
-        await status_msg.edit_text(f"❌ Произошла ошибка при создании отчёта:\n`{e}`")
+        await safe_edit_text(status_msg, f"❌ Произошла ошибка при создании отчёта:\n`{e}`")
         print(f"Критическая ошибка в daily_report_handler: {e}")
 
+async def compute_and_send_recommendations(message: Message):
+    """Докачивает историю, если она устарела, и отправляет рекомендации."""
+    until = (datetime.now() - timedelta(days=1)).date()
+    status_msg = None
+    try:
+        if not history_is_fresh(until):
+            status_msg = await send_and_store(message, "⏳ Загружаю историю статистики, первый раз это может занять несколько минут...")
+            await refresh_history(until)
+            await outbound.delete(message.chat.id, status_msg.message_id)
+        await outbound.send_long(message.chat.id, await build_recommendations_text(until))
+    except Exception as e:
+        text = f"❌ Произошла ошибка при подготовке рекомендаций:\n`{e}`"
+        if status_msg is not None:
+            await safe_edit_text(status_msg, text)
+        else:
+            await send_and_store(message, text)
+        print(f"Критическая ошибка в recommendations_handler: {e}")
+
+@router.message(F.text == "💡 Рекомендации (AI)")
+async def recommendations_handler(message: Message):
+    """Рекомендации по истории объявлений всех кабинетов."""
+    run_in_background(compute_and_send_recommendations(message))
+
+@router.message(F.text == "📈 Дневной отчёт")
+async def daily_report_handler(message: Message):
+    """Отдаёт готовый дневной отчёт за вчера, а если его ещё нет — считает."""
+    stored = daily_store.get_report(report_date_for())
+    if stored:
+        await send_daily_report(message.chat.id, stored)
+        return
+    run_in_background(compute_and_send_daily_report(message))
+
+@router.callback_query(F.data == "daily_report:refresh")
+async def daily_report_refresh_handler(call: CallbackQuery):
+    """Пересчитывает дневной отчёт по кнопке."""
+    await call.answer()
+    run_in_background(compute_and_send_daily_report(call.message))
+
+@router.message(Command("subscribe"))
+async def subscribe_handler(message: Message):
+    """Подписывает чат на ежедневную рассылку дневного отчёта."""
+    daily_store.subscribe(message.chat.id)
+    await message.answer(f"🔔 Чат подписан на дневной отчёт. Рассылка каждый день в {daily_store.get_schedule()}.")
+
+@router.message(Command("unsubscribe"))
+async def unsubscribe_handler(message: Message):
+    """Отписывает чат от ежедневной рассылки."""
+    daily_store.unsubscribe(message.chat.id)
+    await message.answer("🔕 Чат отписан от дневного отчёта.")
+
+@router.message(Command("schedule"))
+async def schedule_handler(message: Message, command: CommandObject):
+    """Показывает или меняет время ежедневного расчёта: /schedule 09:30."""
+    if not command.args:
+        await message.answer(f"🕘 Дневной отчёт считается каждый день в {daily_store.get_schedule()}.\nИзменить: <code>/schedule ЧЧ:ММ</code>")
+        return
+    try:
+        hours, minutes = parse_time(command.args)
+    except ValueError:
+        await message.answer("❌ Укажите время в формате ЧЧ:ММ, например <code>/schedule 09:30</code>.")
+        return
+    daily_store.set_schedule(f"{hours:02d}:{minutes:02d}")
+    schedule_changed.set()
+    await message.answer(f"✅ Дневной отчёт будет считаться каждый день в {hours:02d}:{minutes:02d}.")
+
 @router.message(Command("clear"))
 async def clear_chat_command_handler(message: Message):
     """Обрабатывает команду /clear."""
@@ -229,235 +522,425 @@ async def clear_chat_logic(message: Message):
     """Удаляет все временные сообщения."""
     chat_id = message.chat.id
     
-    if chat_id in sent_messages_by_chat and sent_messages_by_chat[chat_id]:
-        messages_to_delete = [msg_info["id"] for msg_info in sent_messages_by_chat[chat_id] if not msg_info.get("persistent")]
-        sent_messages_by_chat[chat_id] = [msg_info for msg_info in sent_messages_by_chat[chat_id] if msg_info.get("persistent")]
-        
-        count = 0
-        for msg_id in messages_to_delete:
-            try:
-                await bot.delete_message(chat_id, msg_id)
-                count += 1
-            except TelegramBadRequest:
-                pass
+    messages_to_delete = sent_messages.pop_temporary(chat_id)
+    if messages_to_delete:
+        count = await outbound.delete_many(chat_id, messages_to_delete)
         
-        status_msg = await message.answer(f"✅ Готово! Удалил {count} временных сообщений.")
+        status_msg = await outbound.send(chat_id, f"✅ Готово! Запросил удаление временных сообщений: {count}.")
         await asyncio.sleep(3)
-        await bot.delete_message(chat_id, status_msg.message_id)
+        await outbound.delete(chat_id, status_msg.message_id)
     else:
-        status_msg = await message.answer("ℹ️ Временных сообщений для удаления нет.")
+        status_msg = await outbound.send(chat_id, "ℹ️ Временных сообщений для удаления нет.")
         await asyncio.sleep(3)
-        await bot.delete_message(chat_id, status_msg.message_id)
+        await outbound.delete(chat_id, status_msg.message_id)
+
+@router.message(Command("refresh"))
+async def refresh_cache_handler(message: Message):
+    """Обрабатывает команду /refresh: сбрасывает кэш структуры кабинетов."""
+    count = structure_cache.invalidate()
+    structure_mirror.invalidate()
+    report_flights.invalidate()
+    await message.answer(f"🔄 Кэш структуры сброшен ({count} кабинетов). Следующий отчёт загрузит всё заново.")
+
+def format_seconds(value: float) -> str:
+    return "∞" if value == float("inf") else f"{value:g} с"
+
+@router.message(Command("stats"))
+async def stats_handler(message: Message):
+    """Обрабатывает команду /stats: сводка метрик Graph API и этапов отчёта (для администраторов)."""
+    if not ADMIN_IDS:
+        await message.answer("⛔ /stats выключена: администраторы не заданы (ADMIN_IDS).")
+        return
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    lines = ["<b>📊 Статистика с момента запуска</b>", "", "<b>Graph API по эндпоинтам</b> (запросов, p50/p95):"]
+    for labels, hist in sorted(metrics.series("fb_request_seconds").items(), key=lambda item: -item[1].sum):
+        endpoint = dict(labels)["endpoint"]
+        size = metrics.counters.get(("fb_response_bytes_total", labels), 0)
+        lines.append(f"  {endpoint}: {hist.count}, ≤{format_seconds(hist.quantile(0.5))}/≤{format_seconds(hist.quantile(0.95))},"
+                     f" {size / 1024 / 1024:.1f} МБ")
+
+    lines += ["", "<b>Этапы отчёта</b> (всего, p95):"]
+    for labels, hist in sorted(metrics.series("report_phase_seconds").items(), key=lambda item: -item[1].sum):
+        lines.append(f"  {dict(labels)['phase']}: {hist.sum:.1f} с, ≤{format_seconds(hist.quantile(0.95))}")
+
+    lines += ["", "<b>Самые медленные кабинеты</b> (среднее время сбора):"]
+    accounts = metrics.series("report_account_seconds")
+    for labels, hist in sorted(accounts.items(), key=lambda item: -item[1].sum / item[1].count)[:10]:
+        lines.append(f"  {escape(dict(labels)['account'])}: {hist.sum / hist.count:.1f} с ({hist.count} раз)")
+
+    retries = {}
+    for (name, labels), value in metrics.counters.items():
+        if name == "fb_retries_total":
+            reason = dict(labels)["reason"]
+            retries[reason] = retries.get(reason, 0) + value
+    lines += ["", "<b>Повторы:</b> " + (", ".join(f"{reason} {int(count)}" for reason, count in retries.items()) or "нет")]
+
+    metrics.collect()
+    created = metrics.counters.get(("http_connections_created_total", ()), 0)
+    reused = metrics.counters.get(("http_connections_reused_total", ()), 0)
+    pool_wait = metrics.histograms.get(("http_pool_wait_seconds", ()))
+    lines += ["", f"<b>Пул соединений:</b> занято {metrics.gauges.get(('http_pool_in_use', ()), 0)}"
+                  f" из {metrics.gauges.get(('http_pool_limit', ()), 0)}, свободно {metrics.gauges.get(('http_pool_idle', ()), 0)};"
+                  f" новых {int(created)}, переиспользовано {int(reused)}"
+                  + (f"; ожидали соединение {pool_wait.count} раз, p95 ≤{format_seconds(pool_wait.quantile(0.95))}" if pool_wait else "")]
+
+    usage = sorted(((dict(labels), value) for (name, labels), value in metrics.gauges.items()
+                    if name == "fb_usage_percent"), key=lambda item: -item[1])
+    lines += ["", "<b>Квота Meta</b> (макс. % по заголовкам):"]
+    lines += [f"  {labels['account']}" + (f" ({labels['token']})" if "token" in labels else "") + f": {value:.0f}%"
+              for labels, value in usage[:10]] or ["  нет данных"]
+
+    await outbound.send_long(message.chat.id, "\n".join(lines))
+
+def render_account_report(acc_name: str, campaigns_data: dict) -> str:
+    """Формирует HTML-блок отчёта по одному кабинету."""
+    active_campaign_count = len(campaigns_data)
+    msg_lines = [
+        f"<b>🏢 Рекламный кабинет:</b> <u>{acc_name}</u>",
+        f"<b>📈 Активных кампаний:</b> {active_campaign_count}",
+        "─" * 20
+    ]
+    
+    for camp_id, camp_data in campaigns_data.items():
+        msg_lines.append(f"\n<b>🎯 Кампания:</b> {camp_data['name']}")
+        
+        for adset_id, adset_data in camp_data['adsets'].items():
+            total_spend = sum(ad['spend'] for ad in adset_data['ads'])
+            
+            adset_block = [f"  <b>↳ Группа:</b> <code>{adset_data['name']}</code>"]
+            
+            if adset_data['ads'] and "TRAFFIC" in adset_data['ads'][0]["objective"]:
+                total_clicks = sum(ad['clicks'] for ad in adset_data['ads'])
+                total_cpc = (total_spend / total_clicks) if total_clicks > 0 else 0
+                adset_block.extend([
+                    f"    - <b>Цель:</b> {camp_data['objective']}",
+                    f"    - <b>Клики:</b> {total_clicks}",
+                    f"    - <b>Расход:</b> ${total_spend:.2f}",
+                    f"    - <b>CPC:</b> ${total_cpc:.2f} {cpl_label(total_cpc, 'cpc')}"
+                ])
+            else:
+                total_leads = sum(ad.get('leads', 0) for ad in adset_data['ads'])
+                total_cpl = (total_spend / total_leads) if total_leads > 0 else 0
+                adset_block.extend([
+                    f"    - <b>Цель:</b> {camp_data['objective']}",
+                    f"    - <b>Лиды:</b> {total_leads}",
+                    f"    - <b>Расход:</b> ${total_spend:.2f}",
+                    f"    - <b>CPL:</b> ${total_cpl:.2f} {cpl_label(total_cpl, 'cpl')}"
+                ])
+
+            msg_lines.extend(adset_block)
+            
+            if adset_data['ads']:
+                msg_lines.append("  <b>↳ Объявления:</b>")
+                
+                sort_key = 'cpc' if "TRAFFIC" in adset_data['ads'][0]["objective"] else 'cpl'
+                sorted_ads = sorted(adset_data['ads'], key=lambda x: x.get(sort_key, float('inf')))
+
+                for ad in sorted_ads:
+                    thumb_url = ad.get('thumbnail_url', '#')
+                    if "TRAFFIC" in ad["objective"]:
+                        ad_line = f'    <a href="{thumb_url}">🖼️</a> <b>{ad["name"]}</b> | CPC: ${ad["cpc"]:.2f} | CTR: {ad["ctr"]:.2f}%'
+                    else:
+                        ad_line = f'    <a href="{thumb_url}">🖼️</a> <b>{ad["name"]}</b> | CPL: ${ad["cpl"]:.2f} | CTR: {ad["ctr"]:.2f}%'
+                    msg_lines.append(ad_line)
+
+    return "\n".join(msg_lines)
+
+async def send_account_report(chat_id: int, acc_name: str, campaigns_data: dict):
+    """Отправляет блок кабинета, разбивая его по границам строк без разрыва HTML-тегов."""
+    with metrics.timer("report_phase_seconds", phase="render"):
+        chunks = split_html_message(render_account_report(acc_name, campaigns_data))
+    with metrics.timer("report_phase_seconds", phase="send"):
+        for chunk in chunks:
+            await send_and_store(chat_id, chunk)
+
+def stream_account_report(listener: dict, acc: dict, campaigns_data: dict):
+    """
+    Отмечает кабинет готовым и ставит в очередь отправки блоки, до которых дошла очередь.
+
+    Блоки уходят в порядке кабинетов listener["order"] (account_id), как и в собранном
+    целиком отчёте: готовый кабинет ждёт, пока не будут готовы все кабинеты
+    перед ним. Пустой campaigns_data (нет затрат) только сдвигает очередь.
+    Отправка идёт по одному блоку за раз и не задерживает сбор данных.
+    """
+    listener["ready"].setdefault(acc['account_id'], campaigns_data)
+    order = listener["order"]
+    while listener["position"] < len(order) and order[listener["position"]] in listener["ready"]:
+        account_id = order[listener["position"]]
+        listener["position"] += 1
+        data = listener["ready"][account_id]
+        # Блок, отправленный до перезапуска бота, повторно не шлём
+        if not data or account_id in listener["delivered"]:
+            continue
+
+        async def send(data=data, account_id=account_id):
+            async with listener["lock"]:
+                await send_account_report(listener["chat_id"], listener["names"][account_id], data)
+            listener["delivered"].add(account_id)
+            report_jobs.mark_delivered(listener["job"], account_id)
+
+        listener["pending"].append(asyncio.ensure_future(send()))
+
+def cancel_stream(listener: dict) -> None:
+    """Отменяет ещё не ушедшие блоки отчёта (при отмене или ошибке)."""
+    for task in listener["pending"]:
+        task.cancel()
+
+def job_cancel_menu(job_id: str):
+    """Инлайн-кнопка отмены фонового отчёта."""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="❌ Отменить", callback_data=f"job_cancel:{job_id}")
+    return kb.as_markup()
+
+def describe_period(params: dict) -> str:
+    time_range = params.get("time_range")
+    if time_range:
+        return f"с {time_range['since']} по {time_range['until']}"
+    return params["date_preset"]
+
+@router.message(Command("jobs"))
+async def jobs_handler(message: Message):
+    """Показывает незавершённые отчёты пользователя с кнопками отмены."""
+    jobs = report_jobs.active(message.from_user.id)
+    if not jobs:
+        await message.answer("ℹ️ Сейчас нет строящихся отчётов.")
+        return
+    lines = ["<b>🗂 Ваши отчёты:</b>"]
+    kb = InlineKeyboardBuilder()
+    for job in jobs:
+        if job.status == "running":
+            state = "▶️ строится"
+        else:
+            state = f"🕒 в очереди (перед ним {report_jobs.position(job)})"
+        lines.append(f"\n<code>{job.job_id}</code> — {describe_period(job.params)}: {state}")
+        if job.progress:
+            lines.append(f"<i>{job.progress}</i>")
+        kb.button(text=f"❌ Отменить {job.job_id}", callback_data=f"job_cancel:{job.job_id}")
+    kb.adjust(1)
+    await message.answer("\n".join(lines), reply_markup=kb.as_markup())
+
+@router.callback_query(F.data.startswith("job_cancel:"))
+async def job_cancel_handler(call: CallbackQuery):
+    """Отменяет фоновый отчёт по кнопке."""
+    job_id = call.data.split(":")[1]
+    if report_jobs.cancel(job_id, user_id=call.from_user.id):
+        await call.answer("🚫 Отчёт отменён.")
+    else:
+        await call.answer("Этот отчёт уже завершён или отменён.", show_alert=True)
 
 # ============ Отчёт с лоадером ============
 @router.callback_query(F.data.startswith("build_report:"))
 async def build_report_handler(call: CallbackQuery):
-    """Основной хендлер для построения отчёта."""
+    """Основной хендлер для построения отчёта: ставит сборку в очередь фоновых задач."""
     date_preset = call.data.split(":")[1]
     time_range = None
-    
     if date_preset == "from_june_1":
-        start_date = "2025-06-01"
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        time_range = {"since": start_date, "until": end_date}
-        await call.message.edit_text(f"⏳ Начинаю сбор данных с <b>{start_date}</b> по <b>{end_date}</b>...")
+        time_range = {"since": "2025-06-01", "until": datetime.now().strftime('%Y-%m-%d')}
+
+    params = {"date_preset": date_preset, "time_range": time_range}
+    try:
+        job, created = report_jobs.submit(call.from_user.id, call.message.chat.id, "active_campaigns", params,
+                                          {"menu_message_id": call.message.message_id})
+    except JobLimitError as e:
+        await call.answer(f"⛔ Уже строятся ваши отчёты ({e}). Дождитесь их или отмените через /jobs.", show_alert=True)
+        return
+    if not created:
+        await call.answer("⏳ Такой отчёт уже строится — см. /jobs.", show_alert=True)
+        return
+    await call.answer()
+    ahead = report_jobs.position(job)
+    if ahead:
+        await safe_edit_text(call.message, f"🕒 Отчёт поставлен в очередь, перед ним {ahead}.", reply_markup=job_cancel_menu(job.job_id))
+
+async def build_report(job: Job):
+    """Собирает отчёт по активным кампаниям и отправляет его в чат (задача очереди report_jobs)."""
+    date_preset = job.params["date_preset"]
+    time_range = job.params["time_range"]
+    chat_id = job.chat_id
+    menu_message_id = job.meta.get("menu_message_id")
+
+    if time_range:
+        start_text = f"⏳ Начинаю сбор данных с <b>{time_range['since']}</b> по <b>{time_range['until']}</b>..."
     else:
-        await call.message.edit_text(f"⏳ Начинаю сбор данных за период: <b>{date_preset}</b>...")
+        start_text = f"⏳ Начинаю сбор данных за период: <b>{date_preset}</b>..."
+    if menu_message_id:
+        outbound.edit_by_id(chat_id, menu_message_id, start_text)
 
-    status_msg = await send_and_store(call, "Подключаюсь к API...")
-    all_accounts_data = {}
-    timeout = aiohttp.ClientTimeout(total=180)
+    markup = job_cancel_menu(job.job_id)
+    status_msg = await send_and_store(chat_id, "Подключаюсь к API...", reply_markup=markup)
+    # Слушатель отчёта: куда писать прогресс и потоково слать готовые кабинеты
+    listener = {"job": job, "chat_id": chat_id, "status_msg": status_msg, "markup": markup,
+                "order": [], "names": {}, "ready": {}, "position": 0,
+                "delivered": report_jobs.delivered(job), "lock": asyncio.Lock(), "pending": []}
 
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            accounts = await get_ad_accounts(session)
-            if not accounts:
-                await status_msg.edit_text("❌ Нет доступных рекламных аккаунтов.")
+        # Общий клиент приложения: квоты и блокировки кабинетов общие для всех отчётов
+        client = graph_client()
+        accounts = await get_ad_accounts(client)
+        if not accounts:
+            await safe_edit_text(status_msg, "❌ Нет доступных рекламных аккаунтов.")
+            return
+        listener["order"] = [acc['account_id'] for acc in accounts]
+        listener["names"] = {acc['account_id']: acc['name'] for acc in accounts}
+
+        # Одинаковые одновременные отчёты считаются один раз
+        key = ("active_campaigns", date_preset, json.dumps(time_range),
+               tuple(sorted(acc['account_id'] for acc in accounts)))
+        if report_flights.is_running(key):
+            await safe_edit_text(status_msg, "⏳ Такой же отчёт уже собирается — присоединяюсь к нему...", reply_markup=markup)
+        listeners = report_listeners.setdefault(key, [])
+        listeners.append(listener)
+
+        async def progress(text: str):
+            for item in list(report_listeners.get(key, [])):
+                item["job"].progress = text
+                await safe_edit_text(item["status_msg"], text, reply_markup=item["markup"])
+
+        async def account_ready(acc: dict, account_data: dict):
+            if not REPORT_STREAMING:
                 return
-
-            total = len(accounts)
-            for idx, acc in enumerate(accounts, start=1):
-                base_text = f"📦({idx}/{total}) Кабинет: <b>{acc['name']}</b>\n"
-                
-                try:
-                    await status_msg.edit_text(base_text + " Cкачиваю кампании и группы...")
-                    campaigns = await get_campaigns(session, acc["account_id"])
-                    campaigns_map = {c['id']: c for c in campaigns}
-                    
-                    adsets = await get_all_adsets(session, acc["account_id"])
-                    active_adsets = [a for a in adsets if a.get("status") == "ACTIVE"]
-                    if not active_adsets: continue
-                    
-                    adsets_map = {a['id']: a for a in active_adsets}
-                    active_adset_ids = list(adsets_map.keys())
-
-                    await status_msg.edit_text(base_text + " Cкачиваю объявления...")
-                    ads = await get_all_ads_with_creatives(session, acc["account_id"], active_adset_ids)
-                    if not ads: continue
-                    
-                    ad_ids = [ad['id'] for ad in ads]
-                    await status_msg.edit_text(base_text + f" Cкачиваю статистику для {len(ad_ids)} объявлений...")
-                    
-                    insights = await get_ad_level_insights(session, acc["account_id"], ad_ids, date_preset, time_range)
-
-                    insights_map = {}
-                    for row in insights:
-                        ad_id = row['ad_id']
-                        spend = float(row.get("spend", 0))
-                        leads = sum(int(a["value"]) for a in row.get("actions", []) if a.get("action_type") == LEAD_ACTION_TYPE)
-                        clicks = sum(int(a["value"]) for a in row.get("actions", []) if a.get("action_type") == LINK_CLICK_ACTION_TYPE)
-                        ctr = float(row.get("ctr", 0))
-                        insights_map[ad_id] = {"spend": spend, "leads": leads, "clicks": clicks, "ctr": ctr}
-
-                    account_data = {}
-                    for ad in ads:
-                        ad_id = ad['id']
-                        adset_id = ad['adset_id']
-                        campaign_id = ad.get('campaign_id')
-
-                        if adset_id not in adsets_map or campaign_id not in campaigns_map:
-                            continue
-
-                        stats = insights_map.get(ad_id)
-                        if not stats or stats['spend'] == 0:
-                            continue
-                        
-                        campaign_obj = campaigns_map[campaign_id]
-                        objective = campaign_obj.get("objective", "N/A")
-
-                        if campaign_id not in account_data:
-                            objective_clean = objective.replace('OUTCOME_', '').replace('_', ' ').capitalize()
-                            account_data[campaign_id] = {
-                                "name": campaign_obj['name'],
-                                "objective": objective_clean,
-                                "adsets": {}
-                            }
-                        
-                        if adset_id not in account_data[campaign_id]['adsets']:
-                            adset_obj = adsets_map[adset_id]
-                            account_data[campaign_id]['adsets'][adset_id] = {
-                                "name": adset_obj['name'],
-                                "ads": []
-                            }
-                        
-                        ad_info = {
-                            "name": ad['name'],
-                            "thumbnail_url": ad.get('creative', {}).get('thumbnail_url'),
-                            "spend": stats['spend'],
-                            "ctr": stats['ctr'],
-                            "objective": objective
-                        }
-
-                        if "TRAFFIC" in ad_info["objective"]:
-                            ad_info["clicks"] = stats["clicks"]
-                            ad_info["cpc"] = (stats['spend'] / stats['clicks']) if stats['clicks'] > 0 else 0
-                        else:
-                            ad_info["leads"] = stats["leads"]
-                            ad_info["cpl"] = (stats['spend'] / stats['leads']) if stats['leads'] > 0 else 0
-
-                        account_data[campaign_id]['adsets'][adset_id]['ads'].append(ad_info)
-
-                    if account_data:
-                        all_accounts_data[acc['name']] = account_data
-
-                except asyncio.TimeoutError:
-                    await send_and_store(call, f"⚠️ <b>Превышен таймаут</b> при обработке кабинета <b>{acc['name']}</b>. Пропускаю его.")
-                    continue
-    
-    except aiohttp.ClientResponseError as e:
-        error_details = "Не удалось получить детали ошибки"
-        if e.content_type == 'application/json':
-            try: error_details = (await e.json()).get("error", {}).get("message", "Нет сообщения")
-            except: pass
-        else: error_details = e.reason
-        await status_msg.edit_text(f"❌ <b>Ошибка API Facebook:</b>\nКод: {e.status}\nСообщение: {error_details}")
+            for item in list(report_listeners.get(key, [])):
+                stream_account_report(item, acc, account_data)
+
+        async def account_done(acc: dict, account_data: dict):
+            # Готовые кабинеты сохраняются, чтобы после перезапуска не собирать их заново
+            for item in list(report_listeners.get(key, [])):
+                report_jobs.checkpoint(item["job"], acc['account_id'], account_data)
+
+        prefetched = report_jobs.checkpoints(job)
+        try:
+            all_accounts_data, timed_out = await report_flights.do(
+                key, lambda: collect_all_accounts_data(client, accounts, date_preset, time_range, progress,
+                                                       account_ready, prefetched, account_done)
+            )
+        finally:
+            listeners.remove(listener)
+            if not listeners:
+                report_listeners.pop(key, None)
+
+        for acc_name in timed_out:
+            await send_and_store(chat_id, f"⚠️ <b>Превышен таймаут</b> при обработке кабинета <b>{acc_name}</b>. Пропускаю его.")
+
+        if all_accounts_data:
+            # Кабинеты, ещё не отправленные потоково, досылаются в исходном порядке
+            for acc in accounts:
+                stream_account_report(listener, acc, all_accounts_data.get(acc['account_id']))
+            await asyncio.gather(*listener["pending"])
+
+    except FbApiError as e:
+        cancel_stream(listener)
+        await safe_edit_text(status_msg, f"❌ <b>Ошибка API Facebook:</b>\nКод: {e.status} ({e.code})\nСообщение: {e.message}")
         return
+    except asyncio.CancelledError:
+        cancel_stream(listener)
+        if job.status == "cancelled":
+            await safe_edit_text(status_msg, "🚫 Отчёт отменён.")
+            if menu_message_id:
+                outbound.edit_by_id(chat_id, menu_message_id, "🚫 Отчёт отменён.")
+        raise
     except Exception as e:
-        await status_msg.edit_text(f"❌ <b>Произошла неизвестная ошибка:</b>\n{type(e).__name__}: {e}")
+        cancel_stream(listener)
+        await safe_edit_text(status_msg, f"❌ <b>Произошла неизвестная ошибка:</b>\n{type(e).__name__}: {e}")
         return
-        
+
     if not all_accounts_data:
-        await status_msg.edit_text("✅ Активных кампаний с затратами за выбранный период не найдено.")
+        await safe_edit_text(status_msg, "✅ Активных кампаний с затратами за выбранный период не найдено.")
         await asyncio.sleep(5)
-        await call.message.delete()
+        if menu_message_id:
+            await outbound.delete(chat_id, menu_message_id)
         return
-    
-    try: await bot.delete_message(status_msg.chat.id, status_msg.message_id)
-    except TelegramBadRequest: pass
-
-    for acc_name, campaigns_data in all_accounts_data.items():
-        active_campaign_count = len(campaigns_data)
-        msg_lines = [
-            f"<b>🏢 Рекламный кабинет:</b> <u>{acc_name}</u>",
-            f"<b>📈 Активных кампаний:</b> {active_campaign_count}",
-            "─" * 20
-        ]
-        
-        for camp_id, camp_data in campaigns_data.items():
-            msg_lines.append(f"\n<b>🎯 Кампания:</b> {camp_data['name']}")
-            
-            for adset_id, adset_data in camp_data['adsets'].items():
-                total_spend = sum(ad['spend'] for ad in adset_data['ads'])
-                
-                adset_block = [f"  <b>↳ Группа:</b> <code>{adset_data['name']}</code>"]
-                
-                if adset_data['ads'] and "TRAFFIC" in adset_data['ads'][0]["objective"]:
-                    total_clicks = sum(ad['clicks'] for ad in adset_data['ads'])
-                    total_cpc = (total_spend / total_clicks) if total_clicks > 0 else 0
-                    adset_block.extend([
-                        f"    - <b>Цель:</b> {camp_data['objective']}",
-                        f"    - <b>Клики:</b> {total_clicks}",
-                        f"    - <b>Расход:</b> ${total_spend:.2f}",
-                        f"    - <b>CPC:</b> ${total_cpc:.2f} {cpl_label(total_cpc, 'cpc')}"
-                    ])
-                else:
-                    total_leads = sum(ad.get('leads', 0) for ad in adset_data['ads'])
-                    total_cpl = (total_spend / total_leads) if total_leads > 0 else 0
-                    adset_block.extend([
-                        f"    - <b>Цель:</b> {camp_data['objective']}",
-                        f"    - <b>Лиды:</b> {total_leads}",
-                        f"    - <b>Расход:</b> ${total_spend:.2f}",
-                        f"    - <b>CPL:</b> ${total_cpl:.2f} {cpl_label(total_cpl, 'cpl')}"
-                    ])
-
-                msg_lines.extend(adset_block)
-                
-                if adset_data['ads']:
-                    msg_lines.append("  <b>↳ Объявления:</b>")
-                    
-                    sort_key = 'cpc' if "TRAFFIC" in adset_data['ads'][0]["objective"] else 'cpl'
-                    sorted_ads = sorted(adset_data['ads'], key=lambda x: x.get(sort_key, float('inf')))
-
-                    for ad in sorted_ads:
-                        thumb_url = ad.get('thumbnail_url', '#')
-                        if "TRAFFIC" in ad["objective"]:
-                            ad_line = f'    <a href="{thumb_url}">🖼️</a> <b>{ad["name"]}</b> | CPC: ${ad["cpc"]:.2f} | CTR: {ad["ctr"]:.2f}%'
-                        else:
-                            ad_line = f'    <a href="{thumb_url}">🖼️</a> <b>{ad["name"]}</b> | CPL: ${ad["cpl"]:.2f} | CTR: {ad["ctr"]:.2f}%'
-                        msg_lines.append(ad_line)
-
-        final_report = "\n".join(msg_lines)
-        if len(final_report) > 4096:
-            for x in range(0, len(final_report), 4096):
-                await send_and_store(call, final_report[x:x+4096])
-        else:
-            await send_and_store(call, final_report)
 
-    await call.message.edit_text("✅ Отчёт завершён.")
+    await outbound.delete(status_msg.chat.id, status_msg.message_id)
+    if menu_message_id:
+        outbound.edit_by_id(chat_id, menu_message_id, "✅ Отчёт завершён.")
 
 
 # ============================
 # ===         Запуск       ===
 # ============================
 
+def webhook_config_error():
+    """Текст ошибки настройки режима вебхука или None, если всё задано."""
+    if not WEBHOOK_URL:
+        return "Для BOT_MODE=webhook задайте WEBHOOK_URL — публичный адрес бота."
+    if not WEBHOOK_SECRET:
+        return "Для BOT_MODE=webhook задайте WEBHOOK_SECRET: без него вебхук принимает обновления от кого угодно."
+    return None
+
+async def run_webhook():
+    """
+    Принимает обновления через вебхук на aiohttp до SIGTERM/SIGINT.
+
+    Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются. Вебхук
+    при остановке не удаляется: пока бот перезапускается, Telegram копит
+    обновления. Запускать только одну реплику — состояние бота локальное.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    print(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Новые обновления больше не принимаем, уже запущенные отчёты дорабатывают
+        await runner.cleanup()
+
+async def start_metrics_server():
+    """Поднимает отдельный внутренний HTTP-сервер с /metrics."""
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"Метрики доступны на {METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def warm_up_on_start():
+    """Загружает историю для рекомендаций при старте, чтобы первый /recs не ждал её."""
+    try:
+        await warm_up_history()
+    except Exception as e:
+        print(f"Ошибка обновления истории для рекомендаций: {e}")
+
 async def main():
     """Основная функция для запуска бота."""
     dp.include_router(router)
     await set_bot_commands(bot)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    open_graph_session()
+    report_jobs.register("active_campaigns", build_report)
+    await report_jobs.start()
+    scheduler_task = asyncio.create_task(run_daily_scheduler(send_daily_report))
+    warm_up_task = asyncio.create_task(warm_up_on_start())
+    try:
+        if METRICS_PORT:
+            await start_metrics_server()
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        scheduler_task.cancel()
+        warm_up_task.cancel()
+        await report_jobs.stop(SHUTDOWN_DRAIN_TIMEOUT)
+        await drain_background_reports()
+        await close_graph_session()
+        await bot.session.close()
 
 if __name__ == "__main__":
+    if BOT_MODE == "webhook" and webhook_config_error():
+        sys.exit(f"❌ {webhook_config_error()}")
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,56 @@
+import os
+import time
+from storage import connect
+
+# --- Конфигурация ---
+# Telegram не даёт удалять сообщения старше 48 часов — дольше их хранить незачем
+SENT_MESSAGES_TTL = int(os.getenv("SENT_MESSAGES_TTL", str(48 * 3600)))
+# Сколько последних сообщений на чат держим для /clear
+SENT_MESSAGES_MAX_PER_CHAT = int(os.getenv("SENT_MESSAGES_MAX_PER_CHAT", "2000"))
+
+
+class SentMessageStore:
+    """
+    ID отправленных ботом сообщений для последующей очистки через /clear.
+
+    Хранятся в локальной базе, поэтому переживают перезапуск. Записи старше
+    ttl и сверх max_per_chat на чат вытесняются.
+    """
+
+    def __init__(self, path: str = None, ttl: int = SENT_MESSAGES_TTL, max_per_chat: int = SENT_MESSAGES_MAX_PER_CHAT):
+        self.ttl = ttl
+        self.max_per_chat = max_per_chat
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent_messages ("
+            " chat_id INTEGER NOT NULL,"
+            " message_id INTEGER NOT NULL,"
+            " persistent INTEGER NOT NULL,"
+            " sent_at REAL NOT NULL,"
+            " PRIMARY KEY (chat_id, message_id))"
+        )
+
+    def add(self, chat_id: int, message_id: int, persistent: bool = False) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sent_messages (chat_id, message_id, persistent, sent_at) VALUES (?, ?, ?, ?)",
+            (chat_id, message_id, int(persistent), time.time()),
+        )
+        self.conn.execute(
+            "DELETE FROM sent_messages WHERE chat_id = ? AND message_id NOT IN"
+            " (SELECT message_id FROM sent_messages WHERE chat_id = ? ORDER BY message_id DESC LIMIT ?)",
+            (chat_id, chat_id, self.max_per_chat),
+        )
+
+    def pop_temporary(self, chat_id: int) -> list:
+        """Забирает ID временных сообщений чата, которые ещё можно удалить, и забывает их."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM sent_messages WHERE sent_at < ?", (time.time() - self.ttl,))
+            ids = [
+                row[0] for row in self.conn.execute(
+                    "SELECT message_id FROM sent_messages WHERE chat_id = ? AND persistent = 0 ORDER BY message_id",
+                    (chat_id,),
+                )
+            ]
+            self.conn.execute("DELETE FROM sent_messages WHERE chat_id = ? AND persistent = 0", (chat_id,))
+        return ids
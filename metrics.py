@@ -0,0 +1,166 @@
+import os
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+# --- Конфигурация ---
+# Отдельный внутренний порт и адрес для /metrics (0 — не поднимать). В метках есть названия
+# кабинетов, поэтому на публичное приложение вебхука /metrics не вешается
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Границы корзин гистограмм длительности, в секундах
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Границы корзин для числа строк на странице ответа
+ROWS_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 5000)
+
+HELP = {
+    "fb_request_seconds": "Длительность одной попытки запроса к Graph API",
+    "fb_requests_total": "Запросы к Graph API по эндпоинту и HTTP-статусу",
+    "fb_response_bytes_total": "Байт получено от Graph API",
+    "fb_retries_total": "Повторы запросов к Graph API по причине",
+    "fb_page_rows": "Строк на странице постраничного ответа",
+    "fb_usage_percent": "Использование квоты Meta по заголовкам (аккаунт или app)",
+    "report_phase_seconds": "Длительность этапов построения отчёта",
+    "report_account_seconds": "Время сбора данных одного кабинета",
+    "http_pool_wait_seconds": "Ожидание свободного соединения в пуле",
+    "http_connections_created_total": "Новых HTTP-соединений (с TCP/TLS-рукопожатием)",
+    "http_connections_reused_total": "Запросов по уже открытому соединению",
+    "http_pool_in_use": "Занятых соединений пула",
+    "http_pool_idle": "Свободных открытых соединений пула",
+    "http_pool_limit": "Предел соединений пула",
+    "http_pool_limit_per_host": "Предел соединений пула к одному хосту",
+}
+
+
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху — граница корзины, в которую он попадает."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for idx, bound in enumerate(self.buckets):
+            seen += self.counts[idx]
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """
+    Счётчики, значения и гистограммы в памяти процесса.
+
+    Метрика задаётся именем и набором меток; render() отдаёт всё в
+    текстовом формате Prometheus, для /stats есть доступ к гистограммам.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # Функции, обновляющие значения перед выдачей (например, загрузка пула соединений)
+        self.collectors = []
+
+    def add_collector(self, fn) -> None:
+        self.collectors.append(fn)
+
+    def collect(self) -> None:
+        for fn in self.collectors:
+            fn()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Измеряет длительность блока и кладёт её в гистограмму name."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def series(self, name: str) -> dict:
+        """Гистограммы метрики name: {метки: Histogram}."""
+        return {labels: h for (metric, labels), h in self.histograms.items() if metric == name}
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus."""
+        self.collect()
+        lines = []
+        declared = set()
+
+        def declare(name: str, kind: str):
+            if name not in declared:
+                declared.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{_label_str(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name}{_label_str(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_label_str(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_label_str(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{_label_str(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_label_str(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+def add_metrics_route(app: web.Application) -> None:
+    app.router.add_get("/metrics", metrics_handler)
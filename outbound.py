@@ -0,0 +1,268 @@
+import os
+import re
+import time
+import asyncio
+from aiogram import Bot
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from dotenv import load_dotenv
+
+# --- Конфигурация ---
+load_dotenv()
+# Минимальный интервал между сообщениями в один чат (Telegram: ~1 сообщение в секунду)
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", "1.0"))
+# Глобальный лимит сообщений в секунду (Telegram: ~30)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+# Сколько раз повторять запрос после TelegramRetryAfter
+TG_MAX_RETRIES = 5
+# Максимальная длина текста одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Максимум сообщений в одном запросе deleteMessages
+TG_DELETE_BATCH = 100
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z0-9-]+)[^>]*>")
+
+
+# --- Разбиение длинных сообщений ---
+
+def _safe_cut(text: str, max_len: int) -> int:
+    """Позиция разреза не дальше max_len, не попадающая внутрь тега или HTML-сущности."""
+    cut = max_len
+    tag_start, tag_end = text.rfind("<", 0, cut), text.rfind(">", 0, cut)
+    if tag_start > tag_end:
+        cut = tag_start
+    amp, semi = text.rfind("&", 0, cut), text.rfind(";", 0, cut)
+    if amp > semi and cut - amp <= 10:
+        cut = amp
+    space = text.rfind(" ", 0, cut)
+    if space > cut // 2:
+        cut = space + 1
+    return cut if cut > 0 else max_len
+
+def _split_long(piece: str, max_len: int) -> list:
+    parts = []
+    while len(piece) > max_len:
+        cut = _safe_cut(piece, max_len)
+        parts.append(piece[:cut])
+        piece = piece[cut:]
+    if piece:
+        parts.append(piece)
+    return parts
+
+def _update_tag_stack(stack: list, piece: str) -> None:
+    for match in _TAG_RE.finditer(piece):
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            stack.append((name, match.group(0)))
+            continue
+        for idx in range(len(stack) - 1, -1, -1):
+            if stack[idx][0] == name:
+                del stack[idx]
+                break
+
+def split_html_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Делит HTML-текст на сообщения не длиннее limit.
+
+    Режет по границам разделов (пустая строка), затем по строкам и только в
+    крайнем случае внутри строки — не разрывая теги и HTML-сущности. Теги,
+    открытые на границе, закрываются в конце части и открываются заново в
+    начале следующей, так что каждая часть — корректный HTML.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    # Запас под закрывающие/повторно открывающие теги на границах
+    budget = limit - 200
+    chunks = []
+    current = ""
+    stack = []
+
+    def closers() -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+    def flush():
+        nonlocal current
+        if current.strip():
+            chunks.append((current + closers()).strip("\n"))
+        current = "".join(tag for _, tag in stack)
+
+    def add(piece: str):
+        nonlocal current
+        if len(current) + len(piece) > budget and current.strip():
+            flush()
+        current += piece
+        _update_tag_stack(stack, piece)
+
+    for section in re.split(r"(?<=\n\n)", text):
+        if len(current) + len(section) <= budget:
+            add(section)
+            continue
+        if len(section) <= budget:
+            flush()
+            add(section)
+            continue
+        for line in section.splitlines(keepends=True):
+            for piece in _split_long(line, budget):
+                add(piece)
+    flush()
+    return chunks
+
+
+class OutboundDispatcher:
+    """
+    Единая точка отправки исходящих сообщений в Telegram.
+
+    Выдерживает интервал между запросами в один чат и общий лимит в секунду,
+    сама ждёт retry_after при флуд-ошибках. Правки одного сообщения
+    склеиваются: если статус меняется чаще, чем его можно отправить, уходит
+    только последний текст.
+    """
+
+    def __init__(self, bot: Bot, chat_interval: float = TG_CHAT_INTERVAL, global_rate: float = TG_GLOBAL_RATE):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.global_interval = 1 / global_rate
+        self._chat_next = {}
+        self._global_next = 0.0
+        # Отложенные правки: (chat_id, message_id) -> {"text", "kwargs", "futures"}
+        self._edits = {}
+        self._edit_workers = set()
+
+    async def _acquire(self, chat_id: int) -> None:
+        """Ждёт, пока можно отправить очередной запрос в чат."""
+        # Сначала очередь чата: его интервал и retry_after не сдвигают общий лимит для других чатов
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0))
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # Затем место в общем лимите, занимаемое только в момент отправки
+        now = time.monotonic()
+        slot = max(now, self._global_next)
+        self._global_next = slot + self.global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _backoff_chat(self, chat_id: int, retry_after: float) -> None:
+        self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), time.monotonic() + retry_after)
+
+    async def _call(self, chat_id: int, method, *args, **kwargs):
+        for attempt in range(TG_MAX_RETRIES + 1):
+            await self._acquire(chat_id)
+            try:
+                return await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt >= TG_MAX_RETRIES:
+                    raise
+                print(f"Telegram flood control в чате {chat_id}: жду {e.retry_after} с")
+                self._backoff_chat(chat_id, e.retry_after)
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> Message:
+        """Отправляет сообщение с соблюдением лимитов."""
+        return await self._call(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def send_long(self, chat_id: int, text: str, **kwargs) -> list:
+        """Отправляет длинный HTML-текст несколькими сообщениями; reply_markup — только к последнему."""
+        reply_markup = kwargs.pop("reply_markup", None)
+        chunks = split_html_message(text)
+        messages = []
+        for idx, chunk in enumerate(chunks):
+            markup = reply_markup if idx == len(chunks) - 1 else None
+            messages.append(await self.send(chat_id, chunk, reply_markup=markup, **kwargs))
+        return messages
+
+    async def delete(self, chat_id: int, message_id: int) -> bool:
+        """Удаляет сообщение; отложенные правки этого сообщения отбрасываются."""
+        entry = self._edits.pop((chat_id, message_id), None)
+        if entry:
+            for future in entry["futures"]:
+                if not future.done():
+                    future.set_result(False)
+        try:
+            return await self._call(chat_id, self.bot.delete_message, chat_id, message_id)
+        except TelegramBadRequest:
+            return False
+
+    async def delete_many(self, chat_id: int, message_ids: list) -> int:
+        """
+        Удаляет сообщения пачками через deleteMessages (до 100 за запрос).
+
+        Если пачка отклонена целиком, её сообщения удаляются по одному
+        параллельно (с теми же лимитами). Возвращает число сообщений, удаление
+        которых Telegram принял: уже удалённые сообщения в пачке он молча
+        пропускает, поэтому это число запрошенных, а не подтверждённых удалений.
+        """
+        for message_id in message_ids:
+            entry = self._edits.pop((chat_id, message_id), None)
+            for future in entry["futures"] if entry else ():
+                if not future.done():
+                    future.set_result(False)
+
+        accepted = 0
+        for start in range(0, len(message_ids), TG_DELETE_BATCH):
+            batch = message_ids[start:start + TG_DELETE_BATCH]
+            try:
+                # Уже удалённые сообщения Telegram молча пропускает
+                await self._call(chat_id, self.bot.delete_messages, chat_id, batch)
+                accepted += len(batch)
+            except TelegramBadRequest:
+                results = await asyncio.gather(*(self.delete(chat_id, message_id) for message_id in batch))
+                accepted += sum(results)
+        return accepted
+
+    def edit(self, message: Message, text: str, **kwargs) -> asyncio.Future:
+        """
+        Ставит правку сообщения в очередь и сразу возвращает future.
+
+        Future получает True, если правка (эта или более поздняя, поглотившая её)
+        применена, и False, если Telegram её отклонил.
+        """
+        return self.edit_by_id(message.chat.id, message.message_id, text, **kwargs)
+
+    def edit_by_id(self, chat_id: int, message_id: int, text: str, **kwargs) -> asyncio.Future:
+        """То же, что edit, но по ID чата и сообщения (например, после перезапуска бота)."""
+        key = (chat_id, message_id)
+        future = asyncio.get_running_loop().create_future()
+        entry = self._edits.get(key)
+        if entry is None:
+            self._edits[key] = {"text": text, "kwargs": kwargs, "futures": [future]}
+        else:
+            entry["text"], entry["kwargs"] = text, kwargs
+            entry["futures"].append(future)
+        if key not in self._edit_workers:
+            self._edit_workers.add(key)
+            asyncio.ensure_future(self._edit_worker(key))
+        return future
+
+    async def _edit_worker(self, key) -> None:
+        chat_id, message_id = key
+        try:
+            while key in self._edits:
+                await self._acquire(chat_id)
+                entry = self._edits.pop(key, None)
+                if entry is None:
+                    break
+                try:
+                    await self.bot.edit_message_text(entry["text"], chat_id=chat_id, message_id=message_id, **entry["kwargs"])
+                    ok = True
+                except TelegramRetryAfter as e:
+                    self._backoff_chat(chat_id, e.retry_after)
+                    # Возвращаем правку в очередь, если её ещё не сменила более новая
+                    newer = self._edits.get(key)
+                    if newer is None:
+                        self._edits[key] = entry
+                    else:
+                        newer["futures"].extend(entry["futures"])
+                    continue
+                except TelegramBadRequest:
+                    # Например, "message is not modified" или сообщение уже удалено
+                    ok = False
+                except Exception as e:
+                    print(f"Не удалось отредактировать сообщение {message_id} в чате {chat_id}: {e}")
+                    ok = False
+                for future in entry["futures"]:
+                    if not future.done():
+                        future.set_result(ok)
+        finally:
+            self._edit_workers.discard(key)
@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from analytics import warm_up_history
+from daily_report import generate_daily_report_text
+from storage import connect
+from singleflight import report_flights
+
+# --- Конфигурация ---
+load_dotenv()
+# Время ежедневного расчёта дневного отчёта по умолчанию (ЧЧ:ММ, локальное время сервера)
+DAILY_REPORT_TIME = os.getenv("DAILY_REPORT_TIME", "09:00")
+# Через сколько секунд повторить плановый расчёт после ошибки
+DAILY_RETRY_DELAY = 300
+
+
+def parse_time(value: str):
+    """Разбирает "ЧЧ:ММ" в (часы, минуты); бросает ValueError при неверном формате."""
+    hours, minutes = (int(part) for part in value.strip().split(":"))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(value)
+    return hours, minutes
+
+def report_date_for(now: datetime = None) -> str:
+    """Дата, за которую строится дневной отчёт (вчера)."""
+    return ((now or datetime.now()) - timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+class DailyReportStore:
+    """Готовые дневные отчёты, подписки чатов и расписание — в локальной базе."""
+
+    def __init__(self, path: str = None):
+        self.conn = connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS daily_reports ("
+            " report_date TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " created_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS daily_subscriptions ("
+            " chat_id INTEGER PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS daily_pushes ("
+            " report_date TEXT NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " PRIMARY KEY (report_date, chat_id));"
+            "CREATE TABLE IF NOT EXISTS bot_settings ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL);"
+        )
+
+    def get_report(self, report_date: str, since: float = None):
+        """Готовый отчёт за report_date; с since — только начатый не раньше этого времени (timestamp)."""
+        row = self.conn.execute("SELECT text, created_at FROM daily_reports WHERE report_date = ?", (report_date,)).fetchone()
+        if row is None or (since is not None and row[1] < since):
+            return None
+        return row[0]
+
+    def save_report(self, report_date: str, text: str, created_at: float = None) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO daily_reports (report_date, text, created_at) VALUES (?, ?, ?)",
+            (report_date, text, created_at or time.time()),
+        )
+        # Старые отчёты и отметки рассылки не нужны
+        cutoff = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        self.conn.execute("DELETE FROM daily_reports WHERE report_date < ?", (cutoff,))
+        self.conn.execute("DELETE FROM daily_pushes WHERE report_date < ?", (cutoff,))
+
+    def subscribe(self, chat_id: int) -> None:
+        self.conn.execute("INSERT OR IGNORE INTO daily_subscriptions (chat_id) VALUES (?)", (chat_id,))
+
+    def unsubscribe(self, chat_id: int) -> None:
+        self.conn.execute("DELETE FROM daily_subscriptions WHERE chat_id = ?", (chat_id,))
+
+    def subscribers(self) -> list:
+        return [row[0] for row in self.conn.execute("SELECT chat_id FROM daily_subscriptions")]
+
+    def unpushed(self, report_date: str) -> list:
+        """Подписанные чаты, которым отчёт за report_date ещё не разослан."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT chat_id FROM daily_subscriptions WHERE chat_id NOT IN"
+            " (SELECT chat_id FROM daily_pushes WHERE report_date = ?)", (report_date,))]
+
+    def mark_pushed(self, report_date: str, chat_id: int) -> None:
+        self.conn.execute("INSERT OR IGNORE INTO daily_pushes (report_date, chat_id) VALUES (?, ?)", (report_date, chat_id))
+
+    def get_schedule(self) -> str:
+        row = self.conn.execute("SELECT value FROM bot_settings WHERE key = 'daily_report_time'").fetchone()
+        return row[0] if row else DAILY_REPORT_TIME
+
+    def set_schedule(self, value: str) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES ('daily_report_time', ?)", (value,))
+
+
+daily_store = DailyReportStore()
+# Срабатывает при смене расписания, чтобы планировщик пересчитал время запуска
+schedule_changed = asyncio.Event()
+
+async def build_and_store_daily_report(started_after: float = None) -> str:
+    """
+    Считает дневной отчёт и сохраняет его как готовую копию за вчера.
+
+    Одновременные запросы (кнопка в нескольких чатах, плановый расчёт)
+    присоединяются к одному расчёту. С started_after расчёт, начатый
+    раньше этого времени, не подходит — после него считается новый.
+    """
+    report_date = report_date_for()
+
+    async def build() -> str:
+        started = time.time()
+        text = await generate_daily_report_text()
+        daily_store.save_report(report_date, text, created_at=started)
+        return text
+
+    while True:
+        text = await report_flights.do(("daily", report_date), build, refresh=True)
+        if started_after is None or daily_store.get_report(report_date, since=started_after) is not None:
+            return text
+
+def scheduled_at(now: datetime = None) -> datetime:
+    """Время планового расчёта сегодня."""
+    now = now or datetime.now()
+    hours, minutes = parse_time(daily_store.get_schedule())
+    return now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+
+def next_run_at(now: datetime = None) -> datetime:
+    now = now or datetime.now()
+    run_at = scheduled_at(now)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at
+
+async def push_daily_report(push) -> None:
+    """
+    Рассылает отчёт за вчера подписанным чатам, которым он ещё не ушёл.
+
+    Берётся только копия, начатая не раньше сегодняшнего планового времени:
+    отчёт, посчитанный по кнопке сразу после полуночи, мог застать
+    неустоявшиеся данные.
+    """
+    report_date = report_date_for()
+    due = scheduled_at().timestamp()
+    text = daily_store.get_report(report_date, since=due) or await build_and_store_daily_report(started_after=due)
+    for chat_id in daily_store.unpushed(report_date):
+        try:
+            await push(chat_id, text)
+            daily_store.mark_pushed(report_date, chat_id)
+        except Exception as e:
+            print(f"Не удалось отправить дневной отчёт в чат {chat_id}: {e}")
+
+async def run_daily_scheduler(push):
+    """
+    Бесконечный цикл: в заданное время считает дневной отчёт и рассылает его,
+    затем обновляет историю для рекомендаций.
+
+    push(chat_id, text) отправляет готовый отчёт одному подписанному чату.
+    Отчёт всегда пересчитывается в плановое время (или берётся копия,
+    посчитанная после него). Если бот не работал в плановое время, при
+    запуске недоставленная сегодняшняя рассылка уходит сразу.
+    """
+    # При запуске (и после ошибки расчёта) проверяем, не пропущена ли сегодняшняя рассылка
+    catch_up = True
+    while True:
+        schedule_changed.clear()
+        now = datetime.now()
+        missed = catch_up and now >= scheduled_at(now) and daily_store.unpushed(report_date_for(now))
+        catch_up = False
+        if not missed:
+            try:
+                await asyncio.wait_for(schedule_changed.wait(), timeout=(next_run_at(now) - now).total_seconds())
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+        try:
+            await push_daily_report(push)
+        except Exception as e:
+            print(f"Ошибка планового расчёта дневного отчёта: {e}")
+            await asyncio.sleep(DAILY_RETRY_DELAY)
+            catch_up = True
+            continue
+
+        # История для рекомендаций докачивается после рассылки, чтобы не задерживать отчёт
+        try:
+            await warm_up_history()
+        except Exception as e:
+            print(f"Ошибка обновления истории для рекомендаций: {e}")
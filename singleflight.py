@@ -0,0 +1,76 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+
+# --- Конфигурация ---
+load_dotenv()
+# Сколько секунд готовый отчёт отдаётся повторным запросам без пересчёта
+REPORT_RESULT_TTL = int(os.getenv("REPORT_RESULT_TTL", "300"))
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные вычисления.
+
+    Пока вычисление по ключу идёт, остальные запросившие ждут его результат,
+    а не запускают своё. Успешный результат ещё ttl секунд отдаётся из
+    памяти. Ошибки не кэшируются. Если все ожидающие отменены, вычисление
+    тоже отменяется, и следующий запрос по ключу запускает новое, а не
+    присоединяется к отменяемому.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._results = {}
+        # Сколько корутин ждёт каждое идущее вычисление
+        self._waiters = {}
+
+    async def do(self, key, fn, ttl: float = REPORT_RESULT_TTL, refresh: bool = False):
+        """
+        Возвращает результат fn() для ключа key.
+
+        refresh=True пропускает кэш результатов, но всё равно присоединяется
+        к уже идущему вычислению.
+        """
+        if not refresh and key in self._results:
+            result, expires_at = self._results[key]
+            if time.monotonic() < expires_at:
+                return result
+            del self._results[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+
+            def on_done(done_task, key=key, ttl=ttl):
+                if self._inflight.get(key) is done_task:
+                    del self._inflight[key]
+                if not done_task.cancelled() and done_task.exception() is None and ttl > 0:
+                    self._results[key] = (done_task.result(), time.monotonic() + ttl)
+
+            task.add_done_callback(on_done)
+        # Отмена одного ожидающего не должна отменять общее вычисление
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # Результат больше никому не нужен — прерываем работу (и её HTTP-запросы)
+                if not task.done():
+                    task.cancel()
+                    # До завершения отмены ключ свободен: новый запрос не должен получить CancelledError
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+
+    def is_running(self, key) -> bool:
+        return key in self._inflight
+
+    def invalidate(self) -> None:
+        self._results.clear()
+
+
+report_flights = SingleFlight()
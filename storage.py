@@ -0,0 +1,16 @@
+import os
+import sqlite3
+from dotenv import load_dotenv
+
+# --- Конфигурация ---
+load_dotenv()
+# Локальная база для кэшей и состояния бота (без внешних сервисов)
+BOT_DB_PATH = os.getenv("BOT_DB_PATH", "bot_data.sqlite3")
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    """Открывает соединение с локальной базой бота."""
+    conn = sqlite3.connect(path or BOT_DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import asyncio
+from fb_api import GRAPH_URL, FbApiClient
+from cache import StructureCache, StructureMirror
+
+# --- Конфигурация ---
+# Способ загрузки структуры кабинета: "delta" — инкрементальная синхронизация
+# по updated_time, "flat" — три списочных запроса, "nested" — один запрос
+# с вложенным раскрытием полей.
+STRUCTURE_LOADER = os.getenv("STRUCTURE_LOADER", "delta")
+# Запас (в секундах) при запросе изменений, чтобы не потерять объекты на границе
+DELTA_SYNC_OVERLAP = 300
+
+# Размеры страниц вложенных рёбер для nested-загрузчика
+NESTED_CAMPAIGNS_LIMIT = 50
+NESTED_ADSETS_LIMIT = 50
+NESTED_ADS_LIMIT = 100
+
+ACTIVE_FILTER = json.dumps([{"field": "effective_status", "operator": "IN", "value": ["ACTIVE"]}])
+
+
+# --- Плоская загрузка ---
+
+async def get_campaigns(client: FbApiClient, account_id: str):
+    """Получает список кампаний для аккаунта."""
+    url = f"{GRAPH_URL}/act_{account_id}/campaigns"
+    params = {"fields": "id,name,status,objective", "limit": 500}
+    return await client.get_all(url, params)
+
+async def get_all_adsets(client: FbApiClient, account_id: str):
+    """Получает все группы объявлений для аккаунта."""
+    url = f"{GRAPH_URL}/act_{account_id}/adsets"
+    params = {"fields": "id,name,campaign_id,status", "limit": 500}
+    return await client.get_all(url, params)
+
+async def get_all_ads_with_creatives(client: FbApiClient, account_id: str, active_adset_ids: list):
+    """Получает все активные объявления для указанных групп с их креативами."""
+    url = f"{GRAPH_URL}/act_{account_id}/ads"
+    filtering = [
+        {'field': 'adset.id', 'operator': 'IN', 'value': active_adset_ids},
+        {'field': 'effective_status', 'operator': 'IN', 'value': ['ACTIVE']}
+    ]
+    params = {
+        "fields": "id,name,adset_id,campaign_id,creative{thumbnail_url}",
+        "filtering": json.dumps(filtering),
+        "limit": 1000
+    }
+    return await client.get_all(url, params)
+
+async def load_structure_flat(client: FbApiClient, account_id: str) -> dict:
+    """Загружает кампании, группы и объявления тремя списочными запросами."""
+    # Кампании и группы не зависят друг от друга — качаем параллельно
+    campaigns, adsets = await asyncio.gather(
+        get_campaigns(client, account_id),
+        get_all_adsets(client, account_id),
+    )
+    structure = {
+        "campaigns": {c['id']: c for c in campaigns},
+        "adsets": {a['id']: a for a in adsets if a.get("status") == "ACTIVE"},
+        "ads": [],
+    }
+    if structure["adsets"]:
+        structure["ads"] = await get_all_ads_with_creatives(client, account_id, list(structure["adsets"]))
+    return structure
+
+
+# --- Вложенная загрузка ---
+
+async def iter_edge(client: FbApiClient, edge: dict):
+    """Обходит вложенное ребро ответа (data + paging), дозагружая его страницы по paging.next."""
+    while edge:
+        for row in edge.get("data", []):
+            yield row
+        next_url = edge.get("paging", {}).get("next")
+        edge = await client.get_url(next_url) if next_url else None
+
+def nested_structure_fields() -> str:
+    """Поле fields для загрузки дерева кабинета одним запросом."""
+    ads = (
+        f"ads.limit({NESTED_ADS_LIMIT}).filtering({ACTIVE_FILTER})"
+        "{id,name,adset_id,campaign_id,creative{thumbnail_url}}"
+    )
+    adsets = f"adsets.limit({NESTED_ADSETS_LIMIT}).filtering({ACTIVE_FILTER}){{id,name,campaign_id,status,{ads}}}"
+    return f"campaigns.limit({NESTED_CAMPAIGNS_LIMIT}).filtering({ACTIVE_FILTER}){{id,name,status,objective,{adsets}}}"
+
+async def load_structure_nested(client: FbApiClient, account_id: str) -> dict:
+    """
+    Загружает дерево кабинета одним запросом с вложенным раскрытием полей.
+
+    Неактивные кампании, группы и объявления отсекаются на стороне Meta;
+    вложенные страницы дозагружаются по их собственным paging.next.
+    """
+    node = await client.get(f"{GRAPH_URL}/act_{account_id}", {"fields": nested_structure_fields()})
+    structure = {"campaigns": {}, "adsets": {}, "ads": []}
+    async for campaign in iter_edge(client, node.get("campaigns")):
+        adsets_edge = campaign.pop("adsets", None)
+        structure["campaigns"][campaign["id"]] = campaign
+        async for adset in iter_edge(client, adsets_edge):
+            ads_edge = adset.pop("ads", None)
+            if adset.get("status") != "ACTIVE":
+                continue
+            structure["adsets"][adset["id"]] = adset
+            async for ad in iter_edge(client, ads_edge):
+                structure["ads"].append(ad)
+    return structure
+
+
+# --- Инкрементальная синхронизация ---
+
+MIRROR_FIELDS = {
+    "campaigns": "id,name,status,effective_status,objective,updated_time",
+    "adsets": "id,name,campaign_id,status,effective_status,updated_time",
+    "ads": "id,name,adset_id,campaign_id,status,effective_status,updated_time,creative{thumbnail_url}",
+}
+# Статусы объектов, которые держим в локальной копии
+LIVE_STATUSES = {
+    "campaigns": ["ACTIVE", "PAUSED", "IN_PROCESS", "WITH_ISSUES"],
+    "adsets": ["ACTIVE", "PAUSED", "CAMPAIGN_PAUSED", "IN_PROCESS", "WITH_ISSUES"],
+    "ads": ["ACTIVE", "PAUSED", "CAMPAIGN_PAUSED", "ADSET_PAUSED", "PENDING_REVIEW", "DISAPPROVED",
+            "PREAPPROVED", "PENDING_BILLING_INFO", "IN_PROCESS", "WITH_ISSUES"],
+}
+# При дельта-запросе нужны и удалённые/архивные, чтобы убрать их из копии
+DEAD_STATUSES = ["ARCHIVED", "DELETED"]
+# Статусы объявления, при которых оно активно, если активны его группа и кампания
+AD_RUNNABLE_STATUSES = {"ACTIVE", "CAMPAIGN_PAUSED", "ADSET_PAUSED"}
+
+structure_mirror = StructureMirror()
+
+async def get_updated_objects(client: FbApiClient, account_id: str, edge: str, since: float = None):
+    """
+    Получает объекты ребра (campaigns/adsets/ads) со статусами и updated_time.
+
+    Без since — все живые объекты; с since — только изменённые после него, включая архивные.
+    """
+    url = f"{GRAPH_URL}/act_{account_id}/{edge}"
+    statuses = LIVE_STATUSES[edge]
+    filtering = []
+    if since is not None:
+        statuses = statuses + DEAD_STATUSES
+        filtering.append({"field": "updated_time", "operator": "GREATER_THAN", "value": int(since)})
+    filtering.append({"field": "effective_status", "operator": "IN", "value": statuses})
+    params = {"fields": MIRROR_FIELDS[edge], "filtering": json.dumps(filtering), "limit": 500}
+    return await client.get_all(url, params)
+
+def active_view(mirror: dict) -> dict:
+    """Строит из полной копии структуру в формате load_account_structure."""
+    campaigns = {c_id: c for c_id, c in mirror["campaigns"].items() if c.get("status") == "ACTIVE"}
+    adsets = {
+        a_id: a for a_id, a in mirror["adsets"].items()
+        if a.get("status") == "ACTIVE" and a.get("campaign_id") in campaigns
+    }
+    # effective_status объявления не обновляется при смене статуса родителя,
+    # поэтому активность родителей проверяем по текущей копии
+    ads = [
+        ad for ad in mirror["ads"].values()
+        if ad.get("status") == "ACTIVE"
+        and ad.get("effective_status") in AD_RUNNABLE_STATUSES
+        and ad.get("adset_id") in adsets
+    ]
+    return {"campaigns": campaigns, "adsets": adsets, "ads": ads}
+
+async def load_structure_delta(client: FbApiClient, account_id: str) -> dict:
+    """
+    Загружает структуру инкрементально.
+
+    Первый раз скачивается вся живая структура, дальше — только объекты с
+    updated_time новее отметки прошлой синхронизации. Изменения (в том числе
+    переходы в PAUSED/ARCHIVED) сливаются в локальную копию.
+    """
+    mirror, watermark = structure_mirror.get(account_id)
+    since = watermark - DELTA_SYNC_OVERLAP if mirror is not None else None
+    sync_started = time.time()
+
+    edges = ("campaigns", "adsets", "ads")
+    updates = await asyncio.gather(*(get_updated_objects(client, account_id, edge, since) for edge in edges))
+
+    if mirror is None:
+        mirror = {edge: {} for edge in edges}
+    for edge, objects in zip(edges, updates):
+        for obj in objects:
+            if obj.get("effective_status") in DEAD_STATUSES or obj.get("status") in DEAD_STATUSES:
+                mirror[edge].pop(obj["id"], None)
+            else:
+                mirror[edge][obj["id"]] = obj
+
+    structure_mirror.put(account_id, mirror, sync_started)
+    return active_view(mirror)
+
+
+# --- Общая точка входа ---
+
+LOADERS = {
+    "delta": load_structure_delta,
+    "flat": load_structure_flat,
+    "nested": load_structure_nested,
+}
+
+structure_cache = StructureCache()
+
+async def load_account_structure(client: FbApiClient, account_id: str, loader: str = None, use_cache: bool = True) -> dict:
+    """
+    Возвращает структуру кабинета: {"campaigns": {id: ...}, "adsets": {id: ...}, "ads": [...]}.
+
+    В adsets попадают только активные группы, в ads — активные объявления.
+    Свежая структура берётся из дискового кэша, иначе загружается и кэшируется.
+    """
+    if use_cache:
+        cached = structure_cache.get(account_id)
+        if cached is not None:
+            return cached
+    structure = await LOADERS[loader or STRUCTURE_LOADER](client, account_id)
+    structure_cache.put(account_id, structure)
+    return structure
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from datetime import date, datetime, timedelta
+from fb_api import GRAPH_URL, AdStats, FbApiClient, FbPaginator, extract_actions, should_use_async_insights
+from storage import connect
+
+# --- Конфигурация ---
+# Включает локальное хранилище дневной статистики для отчётов за диапазон дат
+INSIGHTS_WAREHOUSE = os.getenv("INSIGHTS_WAREHOUSE", "1") == "1"
+# Через сколько дней день считается закрытым (окно атрибуции Meta) и больше не перекачивается
+INSIGHTS_ATTRIBUTION_DAYS = int(os.getenv("INSIGHTS_ATTRIBUTION_DAYS", "7"))
+# Длинные диапазоны докачиваются кусками по столько дней
+INSIGHTS_FETCH_CHUNK_DAYS = int(os.getenv("INSIGHTS_FETCH_CHUNK_DAYS", "30"))
+# Сколько кусков одного кабинета качается одновременно
+INSIGHTS_FETCH_CONCURRENCY = int(os.getenv("INSIGHTS_FETCH_CONCURRENCY", "2"))
+# Размер страницы Insights (максимум Graph API)
+INSIGHTS_PAGE_LIMIT = 1000
+# Сколько последних записей помнит журнал изменений
+WAREHOUSE_CHANGES_KEPT = 1000
+
+
+def parse_day(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def day_range(since: date, until: date):
+    day = since
+    while day <= until:
+        yield day
+        day += timedelta(days=1)
+
+def split_into_spans(days: list, max_len: int) -> list:
+    """Группирует отсортированные дни в непрерывные отрезки (since, until) не длиннее max_len."""
+    spans = []
+    for day in days:
+        if spans and (day - spans[-1][1]).days == 1 and (day - spans[-1][0]).days < max_len:
+            spans[-1][1] = day
+        else:
+            spans.append([day, day])
+    return [tuple(span) for span in spans]
+
+
+class InsightsWarehouse:
+    """
+    Локальное хранилище дневной статистики по объявлениям.
+
+    Дни старше окна атрибуции замораживаются и больше не запрашиваются;
+    для отчёта за любой диапазон докачиваются только недостающие и ещё
+    открытые дни, а сам отчёт считается агрегированием в SQLite.
+    """
+
+    def __init__(self, path: str = None, attribution_days: int = INSIGHTS_ATTRIBUTION_DAYS):
+        self.path = path
+        self.attribution_days = attribution_days
+        # Растёт при каждой записи; журнал (версия, кабинет, since, until) позволяет читателям
+        # с копией данных в памяти перечитать только изменённое
+        self.version = 0
+        self.changes = deque(maxlen=WAREHOUSE_CHANGES_KEPT)
+        self.conn = connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS ad_insights_daily ("
+            " account_id TEXT NOT NULL,"
+            " ad_id TEXT NOT NULL,"
+            " day TEXT NOT NULL,"
+            " spend REAL NOT NULL,"
+            " leads INTEGER NOT NULL,"
+            " link_clicks INTEGER NOT NULL,"
+            " clicks INTEGER NOT NULL,"
+            " impressions INTEGER NOT NULL,"
+            " PRIMARY KEY (account_id, day, ad_id));"
+            "CREATE TABLE IF NOT EXISTS insights_days ("
+            " account_id TEXT NOT NULL,"
+            " day TEXT NOT NULL,"
+            " frozen INTEGER NOT NULL,"
+            " fetched_at REAL NOT NULL,"
+            " PRIMARY KEY (account_id, day));"
+        )
+
+    def is_closed(self, day: date, today: date = None) -> bool:
+        today = today or date.today()
+        return (today - day).days > self.attribution_days
+
+    def days_to_fetch(self, account_id: str, since: date, until: date) -> list:
+        """Дни диапазона, которых нет в хранилище или которые ещё не заморожены."""
+        frozen = {
+            row[0] for row in self.conn.execute(
+                "SELECT day FROM insights_days WHERE account_id = ? AND frozen = 1 AND day BETWEEN ? AND ?",
+                (account_id, since.isoformat(), until.isoformat()),
+            )
+        }
+        return [day for day in day_range(since, until) if day.isoformat() not in frozen]
+
+    @staticmethod
+    def to_values(account_id: str, rows) -> list:
+        """Превращает строки Insights в компактные кортежи для store (ответ API целиком в памяти не держится)."""
+        return [
+            (
+                account_id,
+                row["ad_id"],
+                row["date_start"],
+                float(row.get("spend", 0)),
+                *extract_actions(row.get("actions")),
+                int(row.get("clicks", 0)),
+                int(row.get("impressions", 0)),
+            )
+            for row in rows
+        ]
+
+    def store(self, account_id: str, since: date, until: date, rows: list = None, values: list = None) -> None:
+        """
+        Заменяет данные кабинета за отрезок [since, until] строками с time_increment=1.
+
+        Вместо rows можно передать уже готовые кортежи values (см. to_values).
+        """
+        if values is None:
+            values = self.to_values(account_id, rows or [])
+        today = date.today()
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "DELETE FROM ad_insights_daily WHERE account_id = ? AND day BETWEEN ? AND ?",
+                (account_id, since.isoformat(), until.isoformat()),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ad_insights_daily"
+                " (account_id, ad_id, day, spend, leads, link_clicks, clicks, impressions)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                values,
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO insights_days (account_id, day, frozen, fetched_at) VALUES (?, ?, ?, ?)",
+                ((account_id, day.isoformat(), int(self.is_closed(day, today)), now) for day in day_range(since, until)),
+            )
+        self.version += 1
+        self.changes.append((self.version, account_id, since, until))
+
+    def aggregate(self, account_id: str, since: date, until: date, ad_ids=None) -> dict:
+        """
+        Суммирует статистику по объявлениям за диапазон.
+
+        Возвращает {ad_id: AdStats} — как insights_map в отчёте.
+        """
+        rows = self.conn.execute(
+            "SELECT ad_id, SUM(spend), SUM(leads), SUM(link_clicks), SUM(clicks), SUM(impressions)"
+            " FROM ad_insights_daily WHERE account_id = ? AND day BETWEEN ? AND ? GROUP BY ad_id",
+            (account_id, since.isoformat(), until.isoformat()),
+        )
+        wanted = set(ad_ids) if ad_ids is not None else None
+        result = {}
+        for ad_id, spend, leads, link_clicks, clicks, impressions in rows:
+            if wanted is not None and ad_id not in wanted:
+                continue
+            result[ad_id] = AdStats(spend, leads, link_clicks, (clicks / impressions * 100) if impressions else 0)
+        return result
+
+    def synced_at(self, day: date) -> float:
+        """Когда в последний раз скачивались данные за day (по любому кабинету); 0 — ни разу."""
+        row = self.conn.execute("SELECT MAX(fetched_at) FROM insights_days WHERE day = ?", (day.isoformat(),)).fetchone()
+        return row[0] or 0
+
+    def changes_since(self, version: int):
+        """Записи журнала новее version или None, если журнал их уже не помнит."""
+        if version == self.version:
+            return []
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        return [change for change in self.changes if change[0] > version]
+
+    def read_daily(self, since: date, until: date, account_id: str = None, origin: date = None) -> list:
+        """
+        Дневные строки за [since, until] по всем кабинетам или одному.
+
+        Строка: (account_id, ad_id, номер дня от origin (по умолчанию since), spend, leads,
+        link_clicks, clicks, impressions). Читает через отдельное соединение,
+        поэтому безопасно вызывать из другого потока.
+        """
+        sql = ("SELECT account_id, ad_id, CAST(julianday(day) - julianday(?) AS INTEGER),"
+               " spend, leads, link_clicks, clicks, impressions"
+               " FROM ad_insights_daily WHERE day BETWEEN ? AND ?")
+        params = [(origin or since).isoformat(), since.isoformat(), until.isoformat()]
+        if account_id is not None:
+            sql += " AND account_id = ?"
+            params.append(account_id)
+        conn = connect(self.path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+
+warehouse = InsightsWarehouse()
+
+async def fetch_daily_ad_insights(client: FbApiClient, account_id: str, since: date, until: date, ad_count: int = 0, on_progress=None) -> FbPaginator:
+    """Итератор по дневной статистике всех объявлений кабинета за отрезок (страницы читаются по мере обхода)."""
+    url = f"{GRAPH_URL}/act_{account_id}/insights"
+    params = {
+        "fields": "ad_id,spend,actions,clicks,impressions",
+        "level": "ad",
+        "time_increment": 1,
+        "time_range": json.dumps({"since": since.isoformat(), "until": until.isoformat()}),
+        "limit": INSIGHTS_PAGE_LIMIT,
+    }
+    if should_use_async_insights(ad_count, {"since": since.isoformat(), "until": until.isoformat()}):
+        return await client.run_async_insights(account_id, params, on_progress)
+    return client.paginate(url, params)
+
+async def sync_account_range(client: FbApiClient, account_id: str, since: date, until: date, ad_count: int = 0, on_progress=None) -> None:
+    """
+    Докачивает в хранилище недостающие и незакрытые дни диапазона.
+
+    Куски качаются не больше INSIGHTS_FETCH_CONCURRENCY одновременно; каждая
+    страница ответа сразу превращается в кортежи, так что в памяти не копятся
+    разобранные JSON-строки всего куска.
+    """
+    days = warehouse.days_to_fetch(account_id, since, until)
+    spans = split_into_spans(days, INSIGHTS_FETCH_CHUNK_DAYS)
+    semaphore = asyncio.Semaphore(INSIGHTS_FETCH_CONCURRENCY)
+
+    async def fetch_span(span_since: date, span_until: date):
+        async with semaphore:
+            values, page = [], []
+            async for row in await fetch_daily_ad_insights(client, account_id, span_since, span_until, ad_count, on_progress):
+                page.append(row)
+                if len(page) >= INSIGHTS_PAGE_LIMIT:
+                    values += warehouse.to_values(account_id, page)
+                    page = []
+            values += warehouse.to_values(account_id, page)
+            warehouse.store(account_id, span_since, span_until, values=values)
+
+    await asyncio.gather(*(fetch_span(*span) for span in spans))
+
+async def get_range_insights(client: FbApiClient, account_id: str, time_range: dict, ad_ids=None, on_progress=None) -> dict:
+    """Статистика по объявлениям за time_range из локального хранилища (с докачкой)."""
+    since, until = parse_day(time_range["since"]), parse_day(time_range["until"])
+    await sync_account_range(client, account_id, since, until, len(ad_ids or ()), on_progress)
+    return warehouse.aggregate(account_id, since, until, ad_ids)